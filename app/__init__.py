@@ -9,6 +9,20 @@ from flask_mail import Mail
 from flask_moment import Moment
 from flask_babel import Babel, lazy_gettext as _l
 from logging.handlers import SMTPHandler, RotatingFileHandler
+from app.last_seen import LastSeenTracker
+from app.pubsub import PubSub
+from app.tasks import TaskQueue
+from app.timeline import Timeline
+from app.translate import Translator
+from app.language import LanguageDetector
+from app.mailer import MailDispatcher
+from app.search import Search
+from app.fragments import FragmentCache
+from app.http_cache import HttpCache
+from app.engine_profile import EngineProfile
+from app.metrics import Metrics
+from app.avatars import AvatarCache
+from app.identity import IdentityCache
 
 def get_locale():
     # Flask object provides a high-level interface to work with the Accept-Language header containing browser's preferences
@@ -17,6 +31,7 @@ def get_locale():
 
 # global scope
 db = SQLAlchemy() # creates an instance of the extension that is not attached to the application
+engine_profile = EngineProfile() # SQLite pragmas or connection pool settings
 migrate = Migrate()
 login = LoginManager()
 login.login_view = 'auth.login' # the function/endpoint name for the login view
@@ -24,17 +39,44 @@ login.login_message = _l('Please log in to access this page.')
 mail = Mail()
 moment = Moment()
 babel = Babel()
+last_seen = LastSeenTracker()
+pubsub = PubSub() # notifications for open event streams, see main.notification_stream
+tasks = TaskQueue() # background jobs such as image processing
+timeline = Timeline() # precomputed home timelines, see User.following_posts
+translator = Translator() # cached, batched calls to the translation service
+language_detector = LanguageDetector() # the language of new posts
+mailer = MailDispatcher() # queued delivery of outgoing mail
+post_search = Search() # full-text index of posts, see main.search
+fragment_cache = FragmentCache() # rendered _post.html fragments
+http_cache = HttpCache() # cache headers for pages and uploads
+metrics = Metrics() # request, SQL and template timings, see main.prometheus_metrics
+avatar_cache = AvatarCache() # resized avatars, see main.avatar
+identity_cache = IdentityCache() # the logged-in users, see load_user
 
 # factory function
 def create_app(config_class=Config):
     app = Flask(__name__)  # an instance of class Flask
     app.config.from_object(config_class)
+    engine_profile.init_app(app) # before db.init_app(), which creates the engine
     db.init_app(app) # binds the SQLAlchemy instance to the application
+    engine_profile.tune_engines(app, db)
     migrate.init_app(app, db)
     login.init_app(app)
     mail.init_app(app)
     moment.init_app(app)
     babel.init_app(app, locale_selector=get_locale)
+    last_seen.init_app(app)
+    tasks.init_app(app)
+    timeline.init_app(app)
+    translator.init_app(app)
+    language_detector.init_app(app)
+    mailer.init_app(app)
+    post_search.init_app(app)
+    fragment_cache.init_app(app)
+    http_cache.init_app(app)
+    metrics.init_app(app)
+    avatar_cache.init_app(app)
+    identity_cache.init_app(app)
 
     from app.errors import bp as errors_bp
     app.register_blueprint(errors_bp) # connects the errors blueprint to the application
@@ -48,14 +90,16 @@ def create_app(config_class=Config):
     from app.cli import bp as cli_bp
     app.register_blueprint(cli_bp)
 
-    with app.app_context():
-        db.create_all()
+    # the schema comes from `flask db upgrade` and the default boards from `flask seed`
+    # (or both from `flask init-db`), so creating the app does not touch the database.
+    # DATABASE_AUTO_INIT does it on startup instead, for throwaway development databases
+    if app.config.get('DATABASE_AUTO_INIT'):
+        with app.app_context():
+            from app.models import Board
+            db.create_all()
+            Board.seed_defaults()
+            db.session.commit()
 
-        boards = ["Casual", "Movies", "Music", "Video Games", "Books"]
-        for board in boards:
-            if not Board.query.filter_by(name=board).first():
-                db.session.add(Board(name=board))
-        db.session.commit()
     # creates a SMTPHandler instance, sets its level so that it only reports errors and not warnings,
     # informational or debugging messages, and attaches it to the app.logger object from Flask
     if not app.debug and not app.testing:
@@ -91,4 +135,3 @@ def create_app(config_class=Config):
     return app
 
 from app import models # reference to the app package
-from app.models import Board
\ No newline at end of file
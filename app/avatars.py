@@ -0,0 +1,101 @@
+from functools import lru_cache
+import hashlib
+import os
+import tempfile
+import threading
+
+
+# resized avatars for /avatar/<user_id>/<size>. A requested size is rounded up to the next of
+# AVATAR_SIZES, so every page asks for one of a few files. They are made from the original
+# upload on the first request and kept in AVATAR_CACHE_PATH under a name derived from the
+# upload, so a new avatar gets new files; once the directory grows past AVATAR_CACHE_MAX_BYTES
+# the files read least recently are removed
+class AvatarCache:
+    def __init__(self, app=None):
+        self.app = None
+        self._lock = threading.Lock()
+        self._bytes = None  # size of the cache directory, counted on first use
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('AVATAR_SIZES', (32, 64, 128, 256))
+        app.config.setdefault('AVATAR_CACHE_PATH', 'cache/avatars')
+        app.config.setdefault('AVATAR_CACHE_MAX_BYTES', 64 * 1024 * 1024)
+        app.config.setdefault('AVATAR_CACHE_FORMAT', 'WEBP')
+        app.config.setdefault('AVATAR_CACHE_QUALITY', 85)
+        self.app = app
+        self._bytes = None
+
+    # the smallest of AVATAR_SIZES that is at least `size`, the largest one otherwise
+    def bucket(self, size):
+        sizes = sorted(self.app.config['AVATAR_SIZES'])
+        return next((s for s in sizes if s >= size), sizes[-1])
+
+    @property
+    def directory(self):
+        return os.path.abspath(self.app.config['AVATAR_CACHE_PATH'])
+
+    # the path of the resized file, made now if it is not cached
+    def get(self, avatar, size):
+        name = '{}_{}.{}'.format(hashlib.blake2b(avatar.original_path.encode('utf-8'), digest_size=12).hexdigest(),
+                                 size, self.app.config['AVATAR_CACHE_FORMAT'].lower())
+        path = os.path.join(self.directory, name)
+        try:
+            os.utime(path) # the modification time orders the files for eviction
+            return path
+        except FileNotFoundError:
+            pass
+        self._store(self._resize(avatar.original_path, size), path)
+        return path
+
+    def _resize(self, original_path, size):
+        from PIL import Image as Image_pil, ImageOps
+        config = self.app.config
+        with Image_pil.open(os.path.join(self.app.static_folder, original_path)) as original:
+            original.draft('RGB', (size, size))
+            image = ImageOps.exif_transpose(original)
+            image.thumbnail((size, size))
+            if image.mode not in ('RGB', 'RGBA'):
+                image = image.convert('RGBA' if 'transparency' in image.info or image.mode in ('LA', 'PA') else 'RGB')
+            data = tempfile.SpooledTemporaryFile()
+            image.save(data, config['AVATAR_CACHE_FORMAT'], quality=config['AVATAR_CACHE_QUALITY'])
+        data.seek(0)
+        return data
+
+    def _store(self, data, path):
+        os.makedirs(self.directory, exist_ok=True)
+        # written aside and renamed, so a concurrent request never reads half a file
+        with tempfile.NamedTemporaryFile(dir=self.directory, suffix='.part', delete=False) as tmp:
+            tmp.write(data.read())
+        os.replace(tmp.name, path)
+        with self._lock:
+            if self._bytes is None:
+                self._bytes = sum(entry.stat().st_size for entry in self._files())
+            else:
+                self._bytes += os.path.getsize(path)
+            if self._bytes > self.app.config['AVATAR_CACHE_MAX_BYTES']:
+                self._evict(keep=path)
+
+    def _files(self):
+        return [entry for entry in os.scandir(self.directory) if entry.is_file() and not entry.name.endswith('.part')]
+
+    # removes the least recently read files until the cache is down to 90% of its limit
+    def _evict(self, keep):
+        entries = sorted((entry.stat().st_mtime, entry.path, entry.stat().st_size)
+                         for entry in self._files() if entry.path != keep)
+        self._bytes = sum(size for _, _, size in entries) + os.path.getsize(keep)
+        for _, path, size in entries:
+            if self._bytes <= self.app.config['AVATAR_CACHE_MAX_BYTES'] * 0.9:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError: # removed by another process
+                pass
+            self._bytes -= size
+
+
+# the Gravatar hash of an email address, computed once per address
+@lru_cache(maxsize=4096)
+def gravatar_digest(email):
+    return hashlib.md5(email.lower().encode('utf-8')).hexdigest()
@@ -1,9 +1,31 @@
 from flask import Blueprint
 import os
 import click
+from app import db
+from app.models import User, Post, Board
 
 bp = Blueprint('cli', __name__, cli_group=None)
 
+# flask init-db
+@bp.cli.command('init-db')
+def init_db():
+    """Create the tables and the default boards on a new database."""
+    from flask_migrate import stamp
+    db.create_all()
+    added = Board.seed_defaults()
+    db.session.commit()
+    stamp() # the tables are current, later migrations start from here
+    click.echo('Database created, {} boards added'.format(added))
+
+# flask seed
+@bp.cli.command()
+def seed():
+    """Add the default boards that are missing."""
+    added = Board.seed_defaults()
+    db.session.commit()
+    click.echo('{} boards added'.format(added))
+
+
 @bp.cli.group()
 def translate():
     """Translation and localization commands."""
@@ -37,3 +59,65 @@ def init(lang):
             'pybabel init -i messages.pot -d app/translations -l ' + lang):
         raise RuntimeError('init command failed')
     os.remove('messages.pot')
+
+
+@bp.cli.group()
+def counters():
+    """Denormalized counter commands."""
+    pass
+
+# flask counters reconcile
+@counters.command()
+def reconcile():
+    """Recompute follower, following, unread message and reply counters."""
+    drifted = User.reconcile_follow_counters()
+    unread_drifted = User.reconcile_unread_counters()
+    replies_drifted = Post.reconcile_reply_counts()
+    db.session.commit()
+    click.echo('{} users had drifted follow counters'.format(drifted))
+    click.echo('{} users had drifted unread message counters'.format(unread_drifted))
+    click.echo('{} posts had drifted reply counts'.format(replies_drifted))
+
+
+@bp.cli.group()
+def images():
+    """Uploaded image commands."""
+    pass
+
+# flask images requeue
+@images.command()
+def requeue():
+    """Queue the processing of uploads left pending by a restart or a crash."""
+    from app.images import requeue_pending_blobs
+    queued = requeue_pending_blobs()
+    click.echo('{} uploads queued for processing'.format(queued))
+
+
+@bp.cli.group()
+def timeline():
+    """Home timeline commands."""
+    pass
+
+# flask timeline rebuild
+@timeline.command()
+def rebuild():
+    """Rebuild every home timeline from the follow graph."""
+    from app import timeline as home_timeline
+    home_timeline.rebuild()
+    db.session.commit()
+    click.echo('Home timelines rebuilt')
+
+
+@bp.cli.group()
+def search():
+    """Full-text search commands."""
+    pass
+
+# flask search reindex
+@search.command()
+def reindex():
+    """Rebuild the search index from every post."""
+    from app import post_search
+    indexed = post_search.reindex()
+    db.session.commit()
+    click.echo('{} posts indexed'.format(indexed))
@@ -0,0 +1,66 @@
+import sqlalchemy as sa
+
+
+# engine settings for the database in use. DATABASE_PROFILE = 'tuned' (the default) applies:
+#   SQLite - WAL journal so readers do not block the writer, synchronous=NORMAL, a busy
+#            timeout instead of failing with "database is locked", a memory-mapped file
+#            and a larger page cache, set on every new connection
+#   others - a sized connection pool with overflow, pre-ping and recycling of old connections
+# 'default' leaves SQLAlchemy's defaults. SQLALCHEMY_ENGINE_OPTIONS still wins over both
+class EngineProfile:
+    def __init__(self, app=None):
+        self.app = None
+        if app is not None:
+            self.init_app(app)
+
+    # sets the engine options, so it runs before db.init_app() creates the engine
+    def init_app(self, app):
+        config = app.config
+        config.setdefault('DATABASE_PROFILE', 'tuned')
+        config.setdefault('SQLITE_BUSY_TIMEOUT', 5000)
+        config.setdefault('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)
+        config.setdefault('SQLITE_CACHE_SIZE', 64 * 1024)
+        config.setdefault('DATABASE_POOL_SIZE', 10)
+        config.setdefault('DATABASE_MAX_OVERFLOW', 20)
+        config.setdefault('DATABASE_POOL_RECYCLE', 1800)
+        if config['DATABASE_PROFILE'] not in ('tuned', 'default'):
+            raise ValueError('Unknown DATABASE_PROFILE {}'.format(config['DATABASE_PROFILE']))
+        self.app = app
+        if config['DATABASE_PROFILE'] == 'default' or self.is_sqlite(app):
+            return
+        options = dict(config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+        options.setdefault('pool_size', config['DATABASE_POOL_SIZE'])
+        options.setdefault('max_overflow', config['DATABASE_MAX_OVERFLOW'])
+        options.setdefault('pool_recycle', config['DATABASE_POOL_RECYCLE'])
+        options.setdefault('pool_pre_ping', True)
+        config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+
+    # hooks the per-connection settings on the engines created by db.init_app()
+    def tune_engines(self, app, db):
+        if app.config['DATABASE_PROFILE'] == 'default':
+            return
+        with app.app_context():
+            for engine in db.engines.values():
+                if engine.dialect.name == 'sqlite':
+                    sa.event.listen(engine, 'connect', self._sqlite_pragmas(app.config, engine.url))
+
+    @staticmethod
+    def is_sqlite(app):
+        return sa.engine.make_url(app.config['SQLALCHEMY_DATABASE_URI']).get_backend_name() == 'sqlite'
+
+    @staticmethod
+    def _sqlite_pragmas(config, url):
+        in_memory = url.database in (None, '', ':memory:') or 'mode=memory' in str(url)
+        pragmas = ['synchronous = NORMAL',
+                   'busy_timeout = {}'.format(int(config['SQLITE_BUSY_TIMEOUT'])),
+                   'cache_size = -{}'.format(int(config['SQLITE_CACHE_SIZE'])), # negative: in KiB
+                   'temp_store = MEMORY']
+        if not in_memory:
+            pragmas = ['journal_mode = WAL', 'mmap_size = {}'.format(int(config['SQLITE_MMAP_SIZE']))] + pragmas
+
+        def on_connect(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for pragma in pragmas:
+                cursor.execute('PRAGMA ' + pragma)
+            cursor.close()
+        return on_connect
@@ -0,0 +1,112 @@
+from collections import OrderedDict
+import hashlib
+import threading
+from flask import g, render_template
+from markupsafe import Markup
+
+
+# caches the HTML of _post.html per post. Posts do not change once published, so a
+# fragment only depends on the locale and on what is shown around the body: the author's
+# name and avatar, the images and their processing state, the parent post and the number
+# of replies. All of it
+# goes into the key, so a new avatar, a renamed author or a processed image simply misses
+# and the stale fragment falls out of the LRU.
+# FRAGMENT_CACHE selects where fragments are kept:
+#   'memory' - an LRU of FRAGMENT_CACHE_SIZE fragments in this process (the default)
+#   'redis'  - shared by every process through REDIS_URL, expiring after FRAGMENT_CACHE_TTL
+#   None     - no caching
+class FragmentCache:
+    def __init__(self, app=None):
+        self.app = None
+        self.backend = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('FRAGMENT_CACHE', 'memory')
+        app.config.setdefault('FRAGMENT_CACHE_SIZE', 2000)
+        app.config.setdefault('FRAGMENT_CACHE_TTL', 24 * 60 * 60)
+        backends = {'memory': MemoryFragments, 'redis': RedisFragments, None: None}
+        if app.config['FRAGMENT_CACHE'] not in backends:
+            raise ValueError('Unknown FRAGMENT_CACHE {}'.format(app.config['FRAGMENT_CACHE']))
+        self.app = app
+        backend = backends[app.config['FRAGMENT_CACHE']]
+        self.backend = backend(app) if backend else None
+        self.hits = self.misses = 0
+        app.add_template_global(self.render_post)
+
+    # used by the templates in place of {% include '_post.html' %}
+    def render_post(self, post):
+        if self.backend is None:
+            return Markup(render_template('_post.html', post=post))
+        key = self.post_key(post)
+        html = self.backend.get(key)
+        with self._lock:
+            if html is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if html is None:
+            html = render_template('_post.html', post=post)
+            self.backend.set(key, html)
+        return Markup(html)
+
+    @staticmethod
+    def post_key(post):
+        parent = post.parent
+        version = (post.author.username, post.avatar_url, post.language, post.reply_count,
+                   tuple((image.id, image.status, image.thumbnail_path) for image in post.images),
+                   (parent.id, parent.author.username, parent.body) if parent else None)
+        digest = hashlib.blake2b(repr(version).encode('utf-8'), digest_size=12).hexdigest()
+        return 'fragment:{}:{}:{}:{}'.format(post.kind, post.id, g.locale, digest)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'backend': self.app.config['FRAGMENT_CACHE'], 'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': self.hits / lookups if lookups else None,
+                    'size': len(self.backend) if isinstance(self.backend, MemoryFragments) else None}
+
+
+class MemoryFragments:
+    def __init__(self, app):
+        self.size = app.config['FRAGMENT_CACHE_SIZE']
+        self._lock = threading.Lock()
+        self._fragments = OrderedDict()
+
+    def __len__(self):
+        return len(self._fragments)
+
+    def get(self, key):
+        with self._lock:
+            html = self._fragments.get(key)
+            if html is not None:
+                self._fragments.move_to_end(key)
+            return html
+
+    def set(self, key, html):
+        with self._lock:
+            self._fragments[key] = html
+            self._fragments.move_to_end(key)
+            while len(self._fragments) > self.size:
+                self._fragments.popitem(last=False)
+
+
+class RedisFragments:
+    def __init__(self, app):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('FRAGMENT_CACHE = "redis" needs the redis package')
+        self.ttl = app.config['FRAGMENT_CACHE_TTL']
+        self.client = redis.Redis.from_url(app.config['REDIS_URL'])
+
+    def get(self, key):
+        html = self.client.get(key)
+        return html.decode('utf-8') if html is not None else None
+
+    def set(self, key, html):
+        self.client.setex(key, self.ttl, html)
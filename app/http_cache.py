@@ -0,0 +1,91 @@
+from datetime import timezone
+import hashlib
+import time
+from flask import current_app, request, session, make_response
+from flask_login import current_user
+import sqlalchemy as sa
+
+
+# conditional GETs for the post pages. A page is identified by a validator made from
+# what can change it without the URL changing: the newest post in its scope, the locale
+# and the viewer (their id and unread message count, and a bucket of the CSRF token
+# lifetime for pages with forms), and site-wide markers of what changes around the posts:
+# the newest post anywhere (a reply changes the count shown under its parent, which may be
+# in another scope), the newest image and the number still being processed, the newest
+# avatar and the last profile edit. Computing it takes a few indexed lookups, so a client
+# that already has the page gets a 304 before anything is rendered
+class HttpCache:
+    def __init__(self, app=None):
+        self.app = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('CONDITIONAL_GET', True)
+        app.config.setdefault('IMMUTABLE_STATIC_PREFIXES', ('uploads/', 'avatars/'))
+        app.config.setdefault('IMMUTABLE_MAX_AGE', 365 * 24 * 60 * 60)
+        self.app = app
+        app.after_request(self._static_headers)
+
+    # uploads are stored under unique names, so browsers can keep them without revalidating
+    def _static_headers(self, response):
+        filename = (request.view_args or {}).get('filename', '')
+        if request.endpoint == 'static' and response.status_code == 200 \
+                and filename.startswith(tuple(self.app.config['IMMUTABLE_STATIC_PREFIXES'])):
+            response.cache_control.public = True
+            response.cache_control.max_age = self.app.config['IMMUTABLE_MAX_AGE']
+            response.cache_control.immutable = True
+            response.cache_control.no_cache = None
+        return response
+
+
+# returns (etag, last modified) for a page listing the posts of `query`, in one query
+def page_validators(query, *extra):
+    from app import db
+    from app.models import Post, Image, Avatar, User
+    newest = query.order_by(None).order_by(Post.timestamp.desc(), Post.id.desc()).limit(1)
+    last_modified, newest_id, *site = db.session.execute(sa.select(
+        newest.with_only_columns(Post.timestamp).scalar_subquery(),
+        newest.with_only_columns(Post.id).scalar_subquery(),
+        sa.select(sa.func.max(Post.id)).scalar_subquery(),
+        sa.select(sa.func.max(Image.id)).scalar_subquery(),
+        sa.select(sa.func.count(Image.id)).where(Image.status == 'pending').scalar_subquery(),
+        sa.select(sa.func.max(Avatar.id)).scalar_subquery(),
+        sa.select(sa.func.max(User.updated_at)).scalar_subquery())).one()
+    viewer = None
+    if current_user.is_authenticated:
+        viewer = (current_user.id, current_user.unread_message_count(), _csrf_bucket())
+    parts = (request.full_path, str(request.accept_languages), viewer, newest_id,
+             last_modified.isoformat() if last_modified else None, repr(site)) + extra
+    etag = hashlib.blake2b(repr(parts).encode('utf-8'), digest_size=16).hexdigest()
+    if last_modified is not None and last_modified.tzinfo is None:
+        last_modified = last_modified.replace(tzinfo=timezone.utc)
+    return etag, last_modified
+
+
+# a 304 response if the client's copy of the page is current, None if the page must be rendered
+def not_modified(etag, last_modified):
+    if not current_app.config['CONDITIONAL_GET'] or request.method != 'GET' or '_flashes' in session:
+        return None
+    if etag not in request.if_none_match:
+        return None
+    return cacheable(make_response('', 304), etag, last_modified)
+
+
+def cacheable(response, etag, last_modified):
+    response = make_response(response)
+    if not current_app.config['CONDITIONAL_GET'] or request.method != 'GET':
+        return response
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.cache_control.private = True
+    response.cache_control.no_cache = True # always revalidated, which is cheap
+    response.vary.add('Cookie')
+    return response
+
+
+def _csrf_bucket():
+    # the forms on a page carry a CSRF token that expires, a cached page must not outlive it
+    limit = current_app.config.get('WTF_CSRF_TIME_LIMIT', 3600) or 3600
+    return int(time.time() // (limit / 2))
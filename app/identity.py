@@ -0,0 +1,94 @@
+from collections import OrderedDict
+import threading
+import time
+from flask import g
+from flask_login import current_user
+import sqlalchemy as sa
+import sqlalchemy.orm as so
+
+
+# the logged-in user without a SELECT per request (IDENTITY_CACHE = True). The columns of
+# a loaded user are kept for IDENTITY_CACHE_TTL seconds in an LRU of IDENTITY_CACHE_SIZE
+# users, and current_user is rebuilt from them as a detached User: enough for the navbar,
+# the page validators and the read-only views. A view that writes through current_user
+# calls bind() first, which loads the user into the session. A commit that changes a
+# user's row or avatar drops their entry (see models.py); other processes only find out
+# when the entry expires, hence the short TTL
+class IdentityCache:
+    def __init__(self, app=None):
+        self.app = None
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # user id -> (expiry time, column values)
+        self._generation = 0  # bumped by every invalidation
+        self.hits = 0
+        self.misses = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('IDENTITY_CACHE', False)
+        app.config.setdefault('IDENTITY_CACHE_TTL', 30)
+        app.config.setdefault('IDENTITY_CACHE_SIZE', 10000)
+        self.app = app
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+    # used by login.user_loader
+    def load(self, user_id):
+        from app import db
+        from app.models import User
+        if not self.app.config['IDENTITY_CACHE']:
+            return db.session.get(User, user_id)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return self._detached(User, entry[1])
+            self.misses += 1
+            generation = self._generation
+        user = db.session.get(User, user_id)
+        if user is not None:
+            values = {attr.key: getattr(user, attr.key) for attr in sa.inspect(User).column_attrs}
+            with self._lock:
+                # a commit that changed the user while it was read must not be undone
+                if generation == self._generation:
+                    self._entries[user_id] = (now + self.app.config['IDENTITY_CACHE_TTL'], values)
+                    self._entries.move_to_end(user_id)
+                    while len(self._entries) > self.app.config['IDENTITY_CACHE_SIZE']:
+                        self._entries.popitem(last=False)
+        return user
+
+    def invalidate(self, *user_ids):
+        with self._lock:
+            self._generation += 1
+            for user_id in user_ids:
+                self._entries.pop(user_id, None)
+
+    # makes current_user an instance of the request's session, to be called before a
+    # view changes it or attaches it to new rows. Costs the SELECT the cache saved
+    def bind(self):
+        from app import db
+        from app.models import User
+        user = current_user._get_current_object()
+        if not user.is_authenticated or not sa.inspect(user).detached:
+            return user
+        user = db.session.get(User, user.id) or user
+        g._login_user = user # where Flask-Login keeps current_user
+        return user
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else None,
+                    'size': len(self._entries)}
+
+    @staticmethod
+    def _detached(model, values):
+        instance = sa.inspect(model).class_manager.new_instance()
+        for key, value in values.items():
+            so.attributes.set_committed_value(instance, key, value)
+        so.make_transient_to_detached(instance)
+        return instance
@@ -0,0 +1,194 @@
+from flask import current_app
+from app import db, metrics, tasks
+from app.models import Image, Avatar, Blob
+from upload import sniff_image, FORMAT_EXTENSIONS, UploadRejected
+import hashlib
+import json
+import mmap
+import os
+import tempfile
+import sqlalchemy as sa
+
+CHUNK_SIZE = 64 * 1024
+
+
+# streams the upload to the blob store while hashing it and returns its Blob with one more
+# reference taken, or None for an empty file field. Content that is already stored is not
+# written again, so a re-posted image shares the file, the variants and the processing of
+# the first upload. The request stream is read exactly once: the format and size are sniffed
+# from the first chunk and anything that is not a supported image, or has more than
+# MAX_IMAGE_PIXELS pixels, is rejected with UploadRejected before it is decoded
+@metrics.timed('upload_store')
+def store_upload(file):
+    head = file.stream.read(CHUNK_SIZE)
+    if not head:
+        return None
+    file_ext, size = _check_image(head)
+    upload_dir = current_app.config['BLOB_UPLOAD_PATH']
+    os.makedirs(upload_dir, exist_ok=True)
+    digest = hashlib.sha256()
+    with tempfile.NamedTemporaryFile(dir=upload_dir, suffix='.part', delete=False) as tmp:
+        chunk = head
+        while chunk:
+            digest.update(chunk)
+            tmp.write(chunk)
+            chunk = file.stream.read(CHUNK_SIZE)
+    if size is None:
+        # the JPEG metadata did not fit in the first chunk, look further into the saved file
+        try:
+            with open(tmp.name, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                _check_image(mm, size_required=True)
+        except UploadRejected:
+            os.remove(tmp.name)
+            raise
+    sha256 = digest.hexdigest()
+
+    blob = db.session.scalar(sa.select(Blob).where(Blob.sha256 == sha256))
+    if blob is None:
+        blob = Blob(sha256=sha256, original_path=f'{current_app.config["BLOB_STATIC_PATH"]}{sha256}{file_ext}')
+        try:
+            with db.session.begin_nested():
+                db.session.add(blob)
+        except sa.exc.IntegrityError: # the same content was stored by a concurrent request
+            blob = db.session.scalar(sa.select(Blob).where(Blob.sha256 == sha256))
+    stored_path = os.path.join(upload_dir, os.path.basename(blob.original_path))
+    if os.path.exists(stored_path):
+        os.remove(tmp.name)
+    else:
+        os.replace(tmp.name, stored_path)
+    blob.ref_count = Blob.ref_count + 1 # incremented in SQL so concurrent uploads do not lose counts
+    db.session.flush()
+    return blob
+
+
+# returns the extension to store the image with and its (width, height), None if not known yet
+def _check_image(header, size_required=False):
+    sniffed = sniff_image(header)
+    if sniffed is None:
+        raise UploadRejected('not a supported image')
+    image_format, width, height = sniffed
+    file_ext = FORMAT_EXTENSIONS[image_format]
+    if file_ext not in current_app.config['UPLOAD_EXTENSIONS']:
+        raise UploadRejected('{} images are not accepted'.format(image_format))
+    if width is None:
+        if size_required:
+            raise UploadRejected('the image size could not be read')
+        return file_ext, None
+    if width * height > current_app.config['MAX_IMAGE_PIXELS']:
+        raise UploadRejected('the image is {}x{} pixels, which is too large'.format(width, height))
+    return file_ext, (width, height)
+
+
+# points an Image or Avatar at its blob, taking over whatever processing is already done
+def attach_blob(row, blob):
+    row.blob = blob
+    row.original_path = blob.original_path
+    for name, value in blob.processed_fields().items():
+        setattr(row, name, value)
+
+
+# drops one reference and deletes the files and the blob once nothing uses them
+def release_blob(blob):
+    blob.ref_count = Blob.ref_count - 1
+    db.session.flush()
+    if blob.ref_count <= 0:
+        for path in blob.file_paths():
+            _remove_static_file(path)
+        db.session.delete(blob)
+
+
+# removes the files of an Image or Avatar that is going away
+def delete_upload(row):
+    if row.blob is not None:
+        release_blob(row.blob)
+    else: # uploaded before blobs existed, the files belong to this row alone
+        for path in row.file_paths():
+            _remove_static_file(path)
+
+
+def _remove_static_file(path):
+    try:
+        os.remove(os.path.join(current_app.static_folder, path))
+    except FileNotFoundError:
+        pass
+
+
+# writes the resized variants next to the original and returns them, smallest first, as
+# dicts with name, path (relative to the static folder), width and height. Sizes come from
+# IMAGE_VARIANT_SIZES (longest side in px); variants are never upscaled, a size larger than
+# the original gives one variant at the original size
+@metrics.timed('image_variants')
+def save_image_variants(original_path):
+    from PIL import Image as Image_pil, ImageOps # only the workers that process images need Pillow
+    config = current_app.config
+    image_format = config['IMAGE_VARIANT_FORMAT']
+    base, extension = os.path.splitext(original_path)
+    if image_format:
+        extension = '.' + image_format.lower()
+    variants = []
+    largest = max(config['IMAGE_VARIANT_SIZES'].values())
+    # the decoder reads straight from a memory-mapped file; for JPEGs draft() lets it decode
+    # at a reduced scale that is still at least as large as the biggest variant
+    with open(os.path.join(current_app.static_folder, original_path), 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, Image_pil.open(mm) as original:
+        image_format = image_format or original.format
+        original.draft('RGB', (largest, largest))
+        save_options = {'quality': config['IMAGE_VARIANT_QUALITY']}
+        if not config['IMAGE_STRIP_METADATA']:
+            save_options.update({k: original.info[k] for k in ('exif', 'icc_profile') if k in original.info})
+        # phone photos are stored sideways with an EXIF orientation, which stripping would lose
+        image = _convert_mode(ImageOps.exif_transpose(original), image_format)
+        for size_name, size in sorted(config['IMAGE_VARIANT_SIZES'].items(), key=lambda item: item[1]):
+            if variants and max(variants[-1]['width'], variants[-1]['height']) >= max(image.size):
+                break
+            variant_path = f'{base}_{size_name}{extension}'
+            image_copy = image.copy()
+            image_copy.thumbnail((size, size))
+            image_copy.save(os.path.join(current_app.static_folder, variant_path), image_format, **save_options)
+            variants.append({'name': size_name, 'path': variant_path,
+                             'width': image_copy.width, 'height': image_copy.height})
+    return variants
+
+
+def _convert_mode(image, image_format):
+    if image_format.upper() in ('JPEG', 'JPG'):
+        return image.convert('RGB') if image.mode != 'RGB' else image
+    if image.mode in ('RGB', 'RGBA'):
+        return image
+    has_alpha = image.mode in ('LA', 'PA') or 'transparency' in image.info
+    return image.convert('RGBA' if has_alpha else 'RGB')
+
+
+# background job: makes the variants of a blob once and copies the result onto every
+# Image and Avatar that uses it. Rows added while the blob was being processed get
+# another job, which finds the blob ready and only copies
+def process_blob(id):
+    blob = db.session.get(Blob, id)
+    if blob is None: # every row using it was deleted before it was processed
+        return
+    if blob.status == 'pending':
+        try:
+            variants = save_image_variants(blob.original_path)
+        except (OSError, ValueError):
+            current_app.logger.exception('Could not process blob %s', blob.sha256)
+            blob.status = 'failed'
+        else:
+            blob.thumbnail_path = variants[0]['path']
+            blob.variants_json = json.dumps(variants)
+            blob.status = 'ready'
+    for model in (Image, Avatar):
+        db.session.execute(sa.update(model).where(model.blob_id == blob.id).values(**blob.processed_fields()))
+    db.session.commit()
+
+
+# queues process_blob again for the blobs a restart or a crash left behind: still pending,
+# or processed while some of their rows were not updated yet. For `flask images requeue`,
+# to be run after a deploy or a crash; returns how many blobs were queued
+def requeue_pending_blobs():
+    unfinished = [Blob.status == 'pending']
+    for model in (Image, Avatar):
+        unfinished.append(sa.select(model.id).where(model.blob_id == Blob.id, model.status != Blob.status).exists())
+    blob_ids = db.session.scalars(sa.select(Blob.id).where(sa.or_(*unfinished)).order_by(Blob.id)).all()
+    for blob_id in blob_ids:
+        tasks.enqueue(process_blob, blob_id)
+    return len(blob_ids)
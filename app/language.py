@@ -0,0 +1,90 @@
+from collections import OrderedDict
+import hashlib
+import re
+import threading
+import sqlalchemy as sa
+
+# links and mentions say nothing about the language of a post
+NOISE = re.compile(r'https?://\S+|www\.\S+|@\w+')
+
+
+# language detection for new posts. langdetect and its language profiles are loaded once,
+# on the first detection, or when the application starts with LANGUAGE_DETECTION_PRELOAD
+# (see preload()); detection is seeded so the same text always gets the same language,
+# and results are memoized by text hash.
+# Bodies with fewer than LANGUAGE_DETECTION_MIN_LETTERS letters (empty, emoji, links)
+# are not detected at all and get '' like text langdetect cannot place
+class LanguageDetector:
+    def __init__(self, app=None):
+        self.app = None
+        self._factory = None
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()  # text hash -> language
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('LANGUAGE_DETECTION', 'sync')
+        app.config.setdefault('LANGUAGE_DETECTION_SEED', 0)
+        app.config.setdefault('LANGUAGE_DETECTION_MIN_LETTERS', 3)
+        app.config.setdefault('LANGUAGE_DETECTION_CACHE_SIZE', 4096)
+        app.config.setdefault('LANGUAGE_DETECTION_PRELOAD', False)
+        if app.config['LANGUAGE_DETECTION'] not in ('sync', 'background'):
+            raise ValueError('Unknown LANGUAGE_DETECTION {}'.format(app.config['LANGUAGE_DETECTION']))
+        self.app = app
+        with self._lock:
+            self._cache.clear()
+            if self._factory is not None:
+                self._factory.set_seed(app.config['LANGUAGE_DETECTION_SEED'])
+        if app.config['LANGUAGE_DETECTION_PRELOAD']:
+            self.preload()
+
+    # loads the profiles now instead of on the first detection, e.g. in a server that
+    # imports the app before forking its workers, so they share the loaded profiles
+    def preload(self):
+        with self._lock:
+            if self._factory is None:
+                from langdetect.detector_factory import DetectorFactory, PROFILES_DIRECTORY
+                factory = DetectorFactory()
+                factory.load_profile(PROFILES_DIRECTORY)
+                factory.set_seed(self.app.config['LANGUAGE_DETECTION_SEED'])
+                self._factory = factory
+            return self._factory
+
+    @property
+    def deferred(self):
+        return self.app.config['LANGUAGE_DETECTION'] == 'background'
+
+    # returns a language code such as 'en', or '' when the text has no recognizable language
+    def detect(self, text):
+        text = NOISE.sub(' ', text or '')
+        if sum(c.isalpha() for c in text) < self.app.config['LANGUAGE_DETECTION_MIN_LETTERS']:
+            return ''
+        key = hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+        from langdetect.lang_detect_exception import LangDetectException
+        detector = (self._factory or self.preload()).create()
+        detector.append(text)
+        try:
+            language = detector.detect()
+        except LangDetectException:
+            language = ''
+        with self._lock:
+            self._cache[key] = language
+            while len(self._cache) > self.app.config['LANGUAGE_DETECTION_CACHE_SIZE']:
+                self._cache.popitem(last=False)
+        return language
+
+
+# background job: fills in the language of a post published with LANGUAGE_DETECTION = 'background'
+def detect_post_language(id):
+    from app import db, language_detector
+    from app.models import Post
+    body = db.session.scalar(sa.select(Post.body).where(Post.id == id, Post.language.is_(None)))
+    if body is None: # deleted, or detected already
+        return
+    db.session.execute(sa.update(Post).where(Post.id == id).values(language=language_detector.detect(body)))
+    db.session.commit()
@@ -0,0 +1,89 @@
+from datetime import datetime, timezone
+import atexit
+import threading
+import time
+import sqlalchemy as sa
+
+
+# keeps User.last_seen up to date without a commit per request: activity is recorded
+# in memory, throttled to once per LAST_SEEN_INTERVAL seconds per user and written
+# in bulk UPDATEs by a background flusher (and once more when the process exits)
+class LastSeenTracker:
+    def __init__(self, app=None):
+        self.app = None
+        self._lock = threading.Lock()
+        self._pending = {}  # user id -> last_seen value waiting to be written
+        self._recorded = {}  # user id -> monotonic time of the last accepted record
+        self._thread = None
+        self._stop = threading.Event()
+        self._atexit_registered = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('LAST_SEEN_INTERVAL', 60)
+        app.config.setdefault('LAST_SEEN_FLUSH_INTERVAL', 10)
+        app.config.setdefault('LAST_SEEN_BACKGROUND_FLUSH', True)
+        self.app = app
+        with self._lock:
+            self._pending.clear()
+            self._recorded.clear()
+        if not self._atexit_registered:
+            atexit.register(self.shutdown)
+            self._atexit_registered = True
+
+    # returns True if the activity will be written, False if it was throttled
+    def record(self, user_id, when=None):
+        now = time.monotonic()
+        with self._lock:
+            last = self._recorded.get(user_id)
+            if last is not None and now - last < self.app.config['LAST_SEEN_INTERVAL']:
+                return False
+            self._recorded[user_id] = now
+            self._pending[user_id] = when or datetime.now(timezone.utc)
+        self._ensure_flusher()
+        return True
+
+    # writes every pending last_seen in a single executemany UPDATE and returns the number of users
+    def flush(self):
+        from app import db
+        from app.models import User
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            # forget users whose throttle window is over so the dict does not grow forever
+            cutoff = time.monotonic() - self.app.config['LAST_SEEN_INTERVAL']
+            self._recorded = {k: v for k, v in self._recorded.items() if v > cutoff}
+        if not pending:
+            return 0
+        with self.app.app_context():
+            db.session.execute(sa.update(User), [{'id': user_id, 'last_seen': last_seen}
+                                                 for user_id, last_seen in pending.items()])
+            db.session.commit()
+        return len(pending)
+
+    def shutdown(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self.app is not None:
+            self._safe_flush()
+
+    def _safe_flush(self):
+        try:
+            self.flush()
+        except Exception:
+            self.app.logger.exception('Could not flush last_seen updates')
+
+    def _ensure_flusher(self):
+        if not self.app.config['LAST_SEEN_BACKGROUND_FLUSH'] or self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name='last-seen-flusher', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.app.config['LAST_SEEN_FLUSH_INTERVAL']):
+            self._safe_flush()
@@ -0,0 +1,127 @@
+import atexit
+import queue
+import smtplib
+import threading
+import time
+
+
+# delivers outgoing mail from a bounded queue. MAIL_WORKERS threads each keep one SMTP
+# connection open across messages (closed after MAIL_IDLE_TIMEOUT seconds without mail),
+# so a burst of messages neither starts a thread per message nor logs in once per message.
+# A full queue makes senders wait up to MAIL_QUEUE_TIMEOUT seconds, after which the message
+# is dropped. Failed deliveries are retried MAIL_RETRIES times with an exponential backoff.
+# MAIL_DISPATCH = 'sync' sends in the calling thread instead
+class MailDispatcher:
+    def __init__(self, app=None):
+        self.app = None
+        self._queue = None
+        self._workers = []
+        self._lock = threading.Lock()
+        self._atexit_registered = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('MAIL_DISPATCH', 'thread')
+        app.config.setdefault('MAIL_WORKERS', 2)
+        app.config.setdefault('MAIL_QUEUE_SIZE', 100)
+        app.config.setdefault('MAIL_QUEUE_TIMEOUT', 5)
+        app.config.setdefault('MAIL_RETRIES', 3)
+        app.config.setdefault('MAIL_RETRY_BACKOFF', 1)
+        app.config.setdefault('MAIL_IDLE_TIMEOUT', 30)
+        if app.config['MAIL_DISPATCH'] not in ('thread', 'sync'):
+            raise ValueError('Unknown MAIL_DISPATCH {}'.format(app.config['MAIL_DISPATCH']))
+        self.shutdown() # workers of a previous application
+        self.app = app
+        self._queue = queue.Queue(maxsize=app.config['MAIL_QUEUE_SIZE'])
+        if not self._atexit_registered:
+            atexit.register(self.shutdown)
+            self._atexit_registered = True
+
+    # returns False if the message was dropped because the queue stayed full
+    def send(self, msg):
+        if self.app.config['MAIL_DISPATCH'] == 'sync':
+            self._close(self._deliver(None, msg))
+            return True
+        self._ensure_workers()
+        try:
+            self._queue.put(msg, timeout=self.app.config['MAIL_QUEUE_TIMEOUT'])
+        except queue.Full:
+            self.app.logger.error('Mail queue is full, dropped message to %s', ', '.join(msg.send_to))
+            return False
+        return True
+
+    # blocks until every queued message has been delivered or given up on
+    def join(self):
+        if self._queue is not None:
+            self._queue.join()
+
+    # delivers what is queued, then stops the workers
+    def shutdown(self, timeout=None):
+        with self._lock:
+            workers, self._workers = self._workers, []
+        for _ in workers:
+            try: # a queue nobody empties must not hang the exit
+                self._queue.put(None, timeout=self.app.config['MAIL_QUEUE_TIMEOUT'])
+            except queue.Full:
+                self.app.logger.error('Mail queue is full at shutdown, %d messages are lost', self._queue.qsize())
+                break
+        for worker in workers:
+            worker.join(timeout)
+
+    def _ensure_workers(self):
+        with self._lock:
+            self._workers = [worker for worker in self._workers if worker.is_alive()]
+            while len(self._workers) < self.app.config['MAIL_WORKERS']:
+                worker = threading.Thread(target=self._run, args=(self.app, self._queue),
+                                          name='mail-{}'.format(len(self._workers)), daemon=True)
+                worker.start()
+                self._workers.append(worker)
+
+    def _run(self, app, q):
+        with app.app_context():
+            connection = None
+            try:
+                while True:
+                    try:
+                        msg = q.get(timeout=app.config['MAIL_IDLE_TIMEOUT'] if connection else None)
+                    except queue.Empty: # quiet for a while, let the server go
+                        connection = self._close(connection)
+                        continue
+                    try:
+                        if msg is None:
+                            return
+                        connection = self._deliver(connection, msg)
+                    except Exception: # a malformed message, dropped so the worker carries on
+                        app.logger.exception('Could not send mail to %s', ', '.join(msg.send_to))
+                    finally:
+                        q.task_done()
+            finally:
+                self._close(connection)
+
+    # sends over the given connection, opening a new one when there is none or it broke.
+    # Returns the connection to reuse, None if the message could not be sent
+    def _deliver(self, connection, msg):
+        from app import mail
+        config = self.app.config
+        for attempt in range(config['MAIL_RETRIES'] + 1):
+            try:
+                if connection is None:
+                    connection = mail.connect().__enter__() # left open, closed by _close()
+                connection.send(msg)
+                return connection
+            except (smtplib.SMTPException, OSError):
+                connection = self._close(connection)
+                if attempt == config['MAIL_RETRIES']:
+                    self.app.logger.exception('Could not send mail to %s', ', '.join(msg.send_to))
+                    return None
+                time.sleep(config['MAIL_RETRY_BACKOFF'] * 2 ** attempt)
+
+    @staticmethod
+    def _close(connection):
+        if connection is not None:
+            try:
+                connection.__exit__(None, None, None)
+            except (smtplib.SMTPException, OSError):
+                pass
+        return None
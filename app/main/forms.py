@@ -1,6 +1,7 @@
+from flask import request
 from flask_wtf import FlaskForm
 from flask_wtf.file import FileField, MultipleFileField
-from wtforms import StringField, SubmitField, TextAreaField
+from wtforms import StringField, SubmitField, TextAreaField, HiddenField
 from wtforms.validators import DataRequired, ValidationError, Length
 import sqlalchemy as sa
 from app import db
@@ -41,4 +42,15 @@ class MessageForm(FlaskForm):
 
 class AvatarUploadForm(FlaskForm):
     avatar = FileField(_l('Upload your avatar'))
-    submit = SubmitField(_l('Submit'))
\ No newline at end of file
+    submit = SubmitField(_l('Submit'))
+
+
+# submitted with GET, so the fields come from the query string and there is no CSRF token
+class SearchForm(FlaskForm):
+    q = StringField(_l('Search'), validators=[DataRequired()])
+    board = HiddenField()
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('formdata', request.args)
+        kwargs.setdefault('meta', {'csrf': False})
+        super().__init__(*args, **kwargs)
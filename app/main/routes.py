@@ -1,44 +1,49 @@
 from datetime import datetime, timezone
-from flask import render_template, flash, redirect, url_for, request, g, current_app
+from flask import render_template, flash, redirect, url_for, request, g, current_app, Response, abort, send_file
 from flask_login import current_user, login_required
 from flask_babel import _, get_locale
-from werkzeug.utils import secure_filename
 import sqlalchemy as sa
-from langdetect import detect, LangDetectException
-from PIL import Image as Image_pil
-from upload import validate_image, file_exist
-from app import db
-from app.main.forms import EditProfileForm, EmptyForm, PostForm, MessageForm, AvatarUploadForm
+from upload import UploadRejected
+from app import db, last_seen, pubsub, tasks, language_detector, post_search, fragment_cache, metrics, avatar_cache, \
+    identity_cache
+from app.main.forms import EditProfileForm, EmptyForm, PostForm, MessageForm, AvatarUploadForm, SearchForm
 from app.models import User, Post, Message, Notification, Image, Board, Avatar
-from app.translate import translate
+from app.translate import translate, translate_many
+from app.post_list import load_posts, load_messages
+from app.pagination import keyset_paginate
+from app.http_cache import page_validators, not_modified, cacheable
+from app.images import store_upload, attach_blob, delete_upload, process_blob
+from app.language import detect_post_language
 from app.main import bp
-from sqlalchemy.orm import joinedload
 import os
-import uuid
+import json
+import queue
+import time
 
 
 @bp.before_request
 def before_request(): # executed right before the view function
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.now(timezone.utc)
-        db.session.commit()
+        last_seen.record(current_user.id) # written later in bulk, see app/last_seen.py
     g.locale = str(get_locale())
 
 
 @bp.route('/', methods=['GET', 'POST'])
 @bp.route('/index', methods=['GET', 'POST'])  #decorator creates an association between the URL given as an argument and the function
 def index():
-    page = request.args.get('page', 1, type=int)
-    # query = sa.select(Post).order_by(Post.timestamp.desc())
-    query = sa.select(Post).options(joinedload(Post.images)).order_by(Post.timestamp.desc())
-    posts = db.paginate(query, page=page,
-                        per_page=current_app.config['POSTS_PER_PAGE'], error_out=False)
-    next_url = url_for('main.index', page=posts.next_num) \
+    etag, last_modified = page_validators(sa.select(Post))
+    unchanged = not_modified(etag, last_modified)
+    if unchanged:
+        return unchanged
+    # authors, avatars, images and parent posts are loaded for the whole page by load_posts()
+    posts = keyset_paginate(sa.select(Post), Post, current_app.config['POSTS_PER_PAGE'],
+                            before=request.args.get('before'), after=request.args.get('after'))
+    next_url = url_for('main.index', after=posts.next_cursor) \
         if posts.has_next else None
-    prev_url = url_for('main.index', page=posts.prev_num) \
+    prev_url = url_for('main.index', before=posts.prev_cursor) \
         if posts.has_prev else None
-    return render_template('index.html', title=_('Home'), posts=posts.items, next_url=next_url,
-                           prev_url=prev_url) #converts a template into a complete HTML page
+    return cacheable(render_template('index.html', title=_('Home'), posts=load_posts(posts.items), next_url=next_url,
+                                     prev_url=prev_url), etag, last_modified) #converts a template into a complete HTML page
 
 
 @bp.route('/board/<string:board_name>', methods=['GET', 'POST'])
@@ -46,63 +51,54 @@ def board_posts(board_name):
     form = PostForm()
     board = Board.query.filter_by(name=board_name).first_or_404()
     if form.validate_on_submit():
-        try:
-            language = detect(form.post.data)
-        except LangDetectException:
-            language = ''
-        post = Post(body=form.post.data, author=current_user, board=board, language=language)
+        post = Post(body=form.post.data, author=identity_cache.bind(), board=board,
+                    language=detect_language(form.post.data))
         db.session.add(post)
         db.session.flush()
-        if form.image.data:
-            for file in form.image.data:
-                if file_exist(file.stream) == 'Ok':
-                    given_filename = secure_filename(
-                        file.filename)  # ensures the uploaded file's name is safe for the system
-                    file_ext = os.path.splitext(given_filename)[1]  # takes the file's extension
-                    if file_ext == '':
-                        file_ext = '.' + os.path.splitext(given_filename)[0]
-                    filename = str(uuid.uuid4())  # assigns a unique name for a file
-                    orig_path = os.path.join(current_app.config['UPLOAD_PATH'], f'{filename}{file_ext}')
-                    file.save(orig_path)
-                    db_orig_path = f'{current_app.config["STATIC_PATH"]}{filename}{file_ext}'  # static path to write in database
-                    file_variants = save_image_variants(file, current_app.config['UPLOAD_PATH'], current_app.config['STATIC_PATH'], filename, file_ext)
-                    image = Image(post=post, thumbnail_path=file_variants['thumbnail'],
-                                  original_path=db_orig_path, user_id=current_user.id)  # automatically sets post_id
-                    db.session.add(image)
+        blob_ids = save_post_images(form.image.data, post)
         db.session.commit()
+        enqueue_image_processing(blob_ids)
+        enqueue_language_detection(post)
         if form.image.data == [] and form.post.data == '':
             return redirect(url_for('main.board_posts', board_name=board_name))
         flash(_('Your reply is published!'))
         return redirect(url_for('main.board_posts', board_name=board_name))
 
-    page = request.args.get('page', 1, type=int)
-    query = board.posts.order_by(Post.timestamp.desc())
-    posts = db.paginate(query, page=page, per_page=current_app.config['POSTS_PER_PAGE'],
-                        error_out=False)  # Pagination object
-    next_url = url_for('main.board_posts', board_name=board_name, page=posts.next_num) \
+    query = sa.select(Post).where(Post.board_id == board.id)
+    etag, last_modified = page_validators(query)
+    unchanged = not_modified(etag, last_modified)
+    if unchanged:
+        return unchanged
+    posts = keyset_paginate(query, Post, current_app.config['POSTS_PER_PAGE'],
+                            before=request.args.get('before'), after=request.args.get('after'))
+    next_url = url_for('main.board_posts', board_name=board_name, after=posts.next_cursor) \
         if posts.has_next else None
-    prev_url = url_for('main.board_posts', board_name=board_name, page=posts.prev_num) \
+    prev_url = url_for('main.board_posts', board_name=board_name, before=posts.prev_cursor) \
         if posts.has_prev else None
-    return render_template('board_posts.html', title= board_name, board=board, form=form, posts=posts.items,
-                           next_url=next_url, prev_url=prev_url)
+    return cacheable(render_template('board_posts.html', title= board_name, board=board, form=form,
+                                     posts=load_posts(posts.items), next_url=next_url, prev_url=prev_url),
+                     etag, last_modified)
 
 
 @bp.route('/user/<username>')
 @login_required # Flask-Login's function, allows only registered users, otherwise redirects to the login page
 def user(username):
     user = db.first_or_404(sa.select(User).where(User.username == username)) # sends a 404 error back to the client in the case that there are no results
-    page = request.args.get('page', 1, type=int)
-    query = user.posts.select().order_by(Post.timestamp.desc())
-    posts = db.paginate(query, page=page,
-                        per_page=current_app.config['POSTS_PER_PAGE'],
-                        error_out=False)
-    next_url = url_for('main.user', username=user.username, page=posts.next_num) \
+    # the profile box changes without new posts
+    etag, last_modified = page_validators(user.posts.select(), user.about_me, user.last_seen, user.followers_total,
+                                          user.following_total, current_user.is_authenticated and current_user.is_following(user))
+    unchanged = not_modified(etag, last_modified)
+    if unchanged:
+        return unchanged
+    posts = keyset_paginate(user.posts.select(), Post, current_app.config['POSTS_PER_PAGE'],
+                            before=request.args.get('before'), after=request.args.get('after'))
+    next_url = url_for('main.user', username=user.username, after=posts.next_cursor) \
         if posts.has_next else None
-    prev_url = url_for('main.user', username=user.username, page=posts.prev_num) \
+    prev_url = url_for('main.user', username=user.username, before=posts.prev_cursor) \
         if posts.has_prev else None
     form = EmptyForm()
-    return render_template('user.html', user=user, posts=posts.items, form=form,
-                           next_url=next_url, prev_url=prev_url)
+    return cacheable(render_template('user.html', user=user, posts=load_posts(posts.items), form=form,
+                                     next_url=next_url, prev_url=prev_url), etag, last_modified)
 
 
 @bp.route('/edit_profile', methods=['GET', 'POST'])
@@ -110,8 +106,10 @@ def user(username):
 def edit_profile():
     form = EditProfileForm(current_user.username)
     if form.validate_on_submit():
+        identity_cache.bind()
         current_user.username = form.username.data
         current_user.about_me = form.about_me.data
+        current_user.updated_at = datetime.now(timezone.utc) # cached pages show the old name
         db.session.commit()
         flash(_('Changes have been saved'))
         return redirect(url_for('main.edit_profile'))
@@ -134,7 +132,7 @@ def follow(username):
         if user == current_user:
             flash(_('You cannot follow yourself!'))
             return redirect(url_for('main.user', username=username))
-        current_user.follow(user)
+        identity_cache.bind().follow(user)
         db.session.commit()
         flash(_('You are following %(username)s!', username=username))
         return redirect(url_for('main.user', username=username))
@@ -155,7 +153,7 @@ def unfollow(username):
         if user == current_user:
             flash(_('You cannot unfollow yourself!'))
             return redirect(url_for('main.user', username=username))
-        current_user.unfollow(user)
+        identity_cache.bind().unfollow(user)
         db.session.commit()
         flash(_('You are not following %(username)s', username=username))
         return redirect(url_for('main.user', username=username))
@@ -163,11 +161,68 @@ def unfollow(username):
         return redirect(url_for('main.index'))
 
 
+@bp.route('/search')
+def search():
+    form = SearchForm()
+    if not form.validate():
+        return redirect(url_for('main.index'))
+    board = None
+    if form.board.data:
+        board = db.first_or_404(sa.select(Board).where(Board.name == form.board.data))
+    page = max(request.args.get('page', 1, type=int), 1)
+    # the index gives the ids of one page in order of relevance, the posts are loaded by primary key
+    ids, has_next = post_search.query(form.q.data, board.id if board else None, page)
+    posts = db.session.scalars(sa.select(Post).where(Post.id.in_(ids))).all() if ids else []
+    posts.sort(key=lambda post: ids.index(post.id))
+    next_url = url_for('main.search', q=form.q.data, board=form.board.data, page=page + 1) \
+        if has_next else None
+    prev_url = url_for('main.search', q=form.q.data, board=form.board.data, page=page - 1) \
+        if page > 1 else None
+    return render_template('search.html', title=_('Search'), form=form, board=board,
+                           posts=load_posts(posts), next_url=next_url, prev_url=prev_url)
+
+
+@bp.route('/thread/<int:post_id>')
+def thread(post_id):
+    # the post with its ancestors and replies, loaded by a single query
+    thread = Post.thread(post_id, current_app.config['THREAD_DEPTH'], current_app.config['THREAD_MAX_POSTS'])
+    if not thread:
+        abort(404)
+    top = thread[0][1]
+    posts = load_posts([post for post, _ in thread])
+    # replies are indented under their parent, up to a point
+    indents = [min(level - top, current_app.config['THREAD_MAX_INDENT']) for _, level in thread]
+    return render_template('thread.html', title=_('Thread'), posts=list(zip(posts, indents)), post_id=post_id)
+
+
 @bp.route('/translate', methods=['POST'])
-# returns a dictionary with data that the client has submitted in JSON format
+# returns a dictionary with data that the client has submitted in JSON format.
+# Either one text: {text, source_language, dest_language} -> {text}
+# or a batch of posts: {post_ids, dest_language} -> {translations: {post id: text}}
 def translate_text():
-    data = request.get_json()
-    return {'text': translate(data['text'], data['source_language'], data['dest_language'])}
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get('dest_language'), str):
+        abort(400)
+    if 'post_ids' not in data:
+        if not isinstance(data.get('text'), str):
+            abort(400)
+        text = translate(data['text'], data.get('source_language'), data['dest_language'])
+        db.session.commit() # keeps the translation for other readers
+        return {'text': text}
+    post_ids = data['post_ids']
+    if not isinstance(post_ids, list) or not all(type(post_id) is int for post_id in post_ids):
+        abort(400)
+    posts = db.session.execute(sa.select(Post.id, Post.body, Post.language).where(
+        Post.id.in_(post_ids[:current_app.config['TRANSLATION_MAX_POSTS']]))).all()
+    by_language = {}
+    for post in posts:
+        by_language.setdefault(post.language, []).append(post)
+    translations = {}
+    for language, group in by_language.items(): # one call per source language
+        texts = translate_many([post.body for post in group], language, data['dest_language'])
+        translations.update({str(post.id): text for post, text in zip(group, texts)})
+    db.session.commit()
+    return {'translations': translations}
 
 
 @bp.route('/send_message/<recipient>', methods=['GET', 'POST'])
@@ -176,11 +231,10 @@ def send_message(recipient):
     user = db.first_or_404(sa.select(User).where(User.username == recipient))
     form = MessageForm()
     if form.validate_on_submit():
-        msg = Message(author=current_user, recipient=user,
+        msg = Message(author=identity_cache.bind(), recipient=user,
                       body=form.message.data)
         db.session.add(msg)
-        user.add_notification('unread_message_count',
-                              user.unread_message_count())
+        user.add_notification('unread_message_count', user.add_unread_message())
         db.session.commit()
         flash(_('Your message has been sent'))
         return redirect(url_for('main.user', username=recipient))
@@ -191,51 +245,127 @@ def send_message(recipient):
 @bp.route('/messages')
 @login_required
 def messages():
+    identity_cache.bind()
     current_user.last_message_read_time = datetime.now(timezone.utc)
+    current_user.unread_messages = 0
     current_user.add_notification('unread_message_count', 0)
     db.session.commit()
-    page = request.args.get('page', 1, type=int)
-    query = current_user.messages_received.select().order_by(
-        Message.timestamp.desc())
-    messages = db.paginate(query, page=page,
-                           per_page=current_app.config['POSTS_PER_PAGE'],
-                           error_out=False)
-    next_url = url_for('main.messages', page=messages.next_num) \
+    messages = keyset_paginate(current_user.messages_received.select(), Message,
+                               current_app.config['POSTS_PER_PAGE'],
+                               before=request.args.get('before'), after=request.args.get('after'))
+    next_url = url_for('main.messages', after=messages.next_cursor) \
         if messages.has_next else None
-    prev_url = url_for('main.messages', page=messages.prev_num) \
+    prev_url = url_for('main.messages', before=messages.prev_cursor) \
         if messages.has_prev else None
-    return render_template('messages.html', messages=messages.items,
+    return render_template('messages.html', messages=load_messages(messages.items),
                            next_url=next_url, prev_url=prev_url)
 
+@bp.route('/stats/fragment_cache')
+def fragment_cache_stats(): # hit and miss counters of this process, for sizing FRAGMENT_CACHE_SIZE
+    if not metrics.authorized(): # the same readers as /metrics
+        abort(403)
+    return fragment_cache.stats()
+
+@bp.route('/metrics')
+def prometheus_metrics(): # totals of this process in the Prometheus text format, see app/metrics.py
+    if not metrics.enabled:
+        abort(404)
+    if not metrics.authorized():
+        abort(403)
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
 @bp.route('/notifications')
 @login_required
-def notifications():
+def notifications(): # JSON poll, used by browsers without EventSource or when the stream is disabled
     since = request.args.get('since', 0.0, type=float)
     query = current_user.notifications.select().where(
         Notification.timestamp > since).order_by(Notification.timestamp.asc())
     notifications = db.session.scalars(query)
-    return [{
-        'name': n.name,
-        'data': n.get_data(),
-        'timestamp': n.timestamp
-    } for n in notifications]
-
-
-def save_image_variants(uploaded_image, output_dir, static_path, filename, extension):
-    sizes = {
-        'thumbnail': (150, 150), # size for thumbnail
-    }
-
-    image = Image_pil.open(uploaded_image)
-    variants = {}
-    for size_name, dimensions in sizes.items():
-        path = os.path.join(output_dir, f"{filename}_{size_name}{extension}")
-        image_copy = image.copy()
-        image_copy.thumbnail(dimensions)
-        image_copy.save(path)
-        variant_path = f'{static_path}{filename}_{size_name}{extension}'
-        variants[size_name] = variant_path
-    return variants
+    return [n.to_dict() for n in notifications]
+
+
+@bp.route('/notifications/stream')
+@login_required
+def notification_stream():
+    # resumes from ?since= on the first connection and from Last-Event-ID when EventSource reconnects
+    since = max(request.args.get('since', 0.0, type=float),
+                request.headers.get('Last-Event-ID', 0.0, type=float))
+    user_id = current_user.id
+    # subscribe before reading the backlog so nothing published in between is lost
+    messages = pubsub.subscribe(user_id)
+    query = current_user.notifications.select().where(
+        Notification.timestamp > since).order_by(Notification.timestamp.asc())
+    backlog = [n.to_dict() for n in db.session.scalars(query)]
+    timeout = current_app.config['NOTIFICATION_STREAM_TIMEOUT']
+    keepalive = current_app.config['NOTIFICATION_STREAM_KEEPALIVE']
+
+    # runs after the request context is gone and never touches the database,
+    # an idle stream only waits on its queue
+    def stream():
+        last = since
+        try:
+            for message in backlog:
+                last = message['timestamp']
+                yield event_stream_message(message)
+            deadline = time.monotonic() + timeout
+            while (remaining := deadline - time.monotonic()) > 0:
+                try:
+                    message = messages.get(timeout=min(keepalive, remaining))
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                if message['timestamp'] > last:
+                    last = message['timestamp']
+                    yield event_stream_message(message)
+        finally:
+            pubsub.unsubscribe(user_id, messages)
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+def event_stream_message(message):
+    return 'id: {}\ndata: {}\n\n'.format(message['timestamp'], json.dumps(message))
+
+
+# only the originals are stored while handling the request, thumbnails are made in the background;
+# returns the blobs that still need processing
+def save_post_images(files, post):
+    pending = set()
+    for file in files or []:
+        try:
+            blob = store_upload(file)
+        except UploadRejected as e:
+            current_app.logger.info('Rejected upload %s: %s', file.filename, e)
+            flash(_('%(filename)s is not a supported image', filename=file.filename))
+            continue
+        if blob is None: # empty file field
+            continue
+        image = Image(post=post, user_id=current_user.id) # automatically sets post_id
+        attach_blob(image, blob)
+        db.session.add(image)
+        if blob.status == 'pending':
+            pending.add(blob.id)
+    return pending
+
+
+# to be called after the commit, so the rows are visible to the workers
+def enqueue_image_processing(blob_ids):
+    for blob_id in blob_ids:
+        tasks.enqueue(process_blob, blob_id)
+
+
+# None leaves the language to a background job, started by enqueue_language_detection() after commit
+def detect_language(body):
+    if language_detector.deferred:
+        return None
+    return language_detector.detect(body)
+
+
+def enqueue_language_detection(post):
+    if language_detector.deferred:
+        tasks.enqueue(detect_post_language, sa.inspect(post).identity[0])
 
 
 @bp.route('/reply/<board_id>/<post_id>/<post_author>', methods=['GET', 'POST'])
@@ -243,29 +373,14 @@ def save_image_variants(uploaded_image, output_dir, static_path, filename, exten
 def reply(board_id, post_id, post_author):
     form = PostForm()
     if form.validate_on_submit():
-        try:
-            language = detect(form.post.data)
-        except LangDetectException:
-            language = ''
-        post = Post(body=form.post.data, author=current_user, parent_post=post_id, board_id=board_id, language=language)
+        post = Post(body=form.post.data, author=identity_cache.bind(), parent_post=post_id, board_id=board_id,
+                    language=detect_language(form.post.data))
         db.session.add(post)
         db.session.flush()
-        if form.image.data:
-            for file in form.image.data:
-                if file_exist(file.stream) == 'Ok':
-                    given_filename = secure_filename(file.filename) # ensures the uploaded file's name is safe for the system
-                    file_ext = os.path.splitext(given_filename)[1] # takes the file's extension
-                    if file_ext == '':
-                        file_ext = '.' + os.path.splitext(given_filename)[0]
-                    filename = str(uuid.uuid4()) # assigns a unique name for a file
-                    orig_path = os.path.join(current_app.config['UPLOAD_PATH'], f'{filename}{file_ext}')
-                    file.save(orig_path)
-                    db_orig_path = f'{current_app.config["STATIC_PATH"]}{filename}{file_ext}' # static path to write in database
-                    file_variants = save_image_variants(file, current_app.config['UPLOAD_PATH'], current_app.config['STATIC_PATH'], filename, file_ext)
-                    image = Image(post=post, thumbnail_path=file_variants['thumbnail'],
-                                original_path=db_orig_path, user_id=current_user.id ) # automatically sets post_id
-                    db.session.add(image)
+        blob_ids = save_post_images(form.image.data, post)
         db.session.commit()
+        enqueue_image_processing(blob_ids)
+        enqueue_language_detection(post)
         board = db.session.scalar(sa.select(Board).where(Board.id == board_id))
         if form.image.data == [] and form.post.data == '':
             return redirect(url_for('main.board_posts', board_name=board.name))
@@ -274,6 +389,27 @@ def reply(board_id, post_id, post_author):
     return render_template('reply.html', title='Reply', form=form, recipient=post_author)
 
 
+@bp.route('/avatar/<int:user_id>/<int:size>')
+def avatar(user_id, size):
+    user = db.first_or_404(sa.select(User).where(User.id == user_id))
+    avatar_img = db.session.scalar(sa.select(Avatar).where(Avatar.user_id == user_id))
+    # no upload, a size between the buckets or an older upload: off to the current URL
+    if avatar_img is None or size != avatar_cache.bucket(size) or request.args.get('v') != str(avatar_img.id):
+        return redirect(user.avatar_from(avatar_img, size))
+    try:
+        path = avatar_cache.get(avatar_img, avatar_cache.bucket(size))
+    except (OSError, ValueError):
+        current_app.logger.exception('Could not resize avatar %s', avatar_img.id)
+        return redirect(url_for('static', filename=avatar_img.thumbnail()))
+    response = send_file(path, mimetype='image/' + current_app.config['AVATAR_CACHE_FORMAT'].lower())
+    # the URL names the upload and the size, so the image behind it never changes
+    response.cache_control.public = True
+    response.cache_control.max_age = current_app.config['IMMUTABLE_MAX_AGE']
+    response.cache_control.immutable = True
+    response.cache_control.no_cache = None
+    return response
+
+
 @bp.route('/avatar_upload', methods=['GET', 'POST'])
 @login_required
 def avatar_upload():
@@ -281,32 +417,27 @@ def avatar_upload():
     if form.validate_on_submit():
         if form.avatar.data:
             file = form.avatar.data
-            if file_exist(file.stream) == 'Ok':
-                given_filename = secure_filename(file.filename) # ensures the uploaded file's name is safe for the system
-                file_ext = os.path.splitext(given_filename)[1] # takes the file's extension
-                if file_ext == '':
-                    file_ext = '.' + os.path.splitext(given_filename)[0]
-
+            try:
+                blob = store_upload(file)
+            except UploadRejected as e:
+                current_app.logger.info('Rejected upload %s: %s', file.filename, e)
+                flash(_('%(filename)s is not a supported image', filename=file.filename))
+                blob = None
+            if blob is not None:
                 avatar_to_delete = Avatar.query.filter_by(user_id=current_user.id).first()
                 if avatar_to_delete:
-                    thumb_delete_path = os.path.join(current_app.config['AVATAR_DELETE_PATH'], avatar_to_delete.thumbnail_path)
-                    orig_delete_path = os.path.join(current_app.config['AVATAR_DELETE_PATH'],
-                                                     avatar_to_delete.original_path)
-                    os.remove(thumb_delete_path)
-                    os.remove(orig_delete_path)
+                    delete_upload(avatar_to_delete) # the files go once no other upload shares them
                     db.session.delete(avatar_to_delete)
                     db.session.flush()
-                filename = str(uuid.uuid4()) # assigns a unique name for a file
-                orig_path = os.path.join(current_app.config['AVATAR_UPLOAD_PATH'], f'{filename}{file_ext}')
-                file.save(orig_path)
-                db_orig_path = f'{current_app.config["AVATAR_STATIC_PATH"]}{filename}{file_ext}' # static path to write in database
-                file_variants = save_image_variants(file, current_app.config['AVATAR_UPLOAD_PATH'], current_app.config['AVATAR_STATIC_PATH'], filename, file_ext)
-                avatar = Avatar(user_id=current_user.id, thumbnail_path=file_variants['thumbnail'],
-                                original_path=db_orig_path)
+                avatar = Avatar(user_id=current_user.id)
+                attach_blob(avatar, blob)
                 db.session.add(avatar)
+                blob_ids = {blob.id} if blob.status == 'pending' else set()
                 db.session.commit()
+                enqueue_image_processing(blob_ids)
                 flash(_('Your avatar has been updated!'))
                 return redirect(url_for('main.user', username=current_user.username))
+        return redirect(url_for('main.avatar_upload'))
     else:
         return render_template('avatar_upload.html', title='Avatar Upload', form=form)
 
@@ -0,0 +1,202 @@
+import cProfile
+import functools
+import os
+import random
+import threading
+import time
+from flask import before_render_template, template_rendered, g, has_request_context, request
+from flask_login import current_user
+import sqlalchemy as sa
+
+# upper bounds of the request duration histogram, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+# opt-in instrumentation (METRICS = True). Every request records its endpoint, status and
+# wall time, and the number and time of the SQL statements it ran; templates record their
+# render time and image uploads their processing time. The totals of this process are
+# served at /metrics in the Prometheus text format, to the users in ADMINS or a scraper
+# sending "Authorization: Bearer METRICS_TOKEN". Requests slower than METRICS_SLOW_REQUEST
+# seconds are logged, and with METRICS_PROFILE_DIR set a METRICS_PROFILE_SAMPLE share of the
+# requests runs under cProfile, the slow ones leaving their stats in that directory
+class Metrics:
+    def __init__(self, app=None):
+        self.app = None
+        self._lock = threading.Lock()
+        self.reset()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('METRICS', False)
+        app.config.setdefault('METRICS_TOKEN', None)
+        app.config.setdefault('METRICS_SLOW_REQUEST', 1.0)
+        app.config.setdefault('METRICS_PROFILE_DIR', None)
+        app.config.setdefault('METRICS_PROFILE_SAMPLE', 0.01)
+        self.app = app
+        self.reset()
+        if not app.config['METRICS']:
+            return
+        from app import db
+        with app.app_context():
+            for engine in db.engines.values():
+                sa.event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+                sa.event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        before_render_template.connect(self._before_render_template, app)
+        template_rendered.connect(self._template_rendered, app)
+
+    @property
+    def enabled(self):
+        return self.app is not None and self.app.config['METRICS']
+
+    def reset(self):
+        with self._lock:
+            self._requests = {}  # (endpoint, method, status) -> count
+            self._durations = {}  # endpoint -> [count per bucket..., sum, count]
+            self._sql = {}  # endpoint -> [statements, seconds]
+            self._templates = {}  # template -> [renders, seconds]
+            self._operations = {}  # operation -> [count, seconds]
+
+    # decorator recording the run time of a function under `operation`
+    def timed(self, operation):
+        def decorator(f):
+            @functools.wraps(f)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return f(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return f(*args, **kwargs)
+                finally:
+                    self.observe(operation, time.perf_counter() - start)
+            return wrapper
+        return decorator
+
+    def observe(self, operation, seconds):
+        with self._lock:
+            totals = self._operations.setdefault(operation, [0, 0.0])
+            totals[0] += 1
+            totals[1] += seconds
+
+    # the users in ADMINS, or the bearer of METRICS_TOKEN
+    def authorized(self):
+        token = self.app.config['METRICS_TOKEN']
+        if token and request.headers.get('Authorization') == 'Bearer ' + token:
+            return True
+        admins = self.app.config.get('ADMINS') or []
+        if isinstance(admins, str):
+            admins = [email.strip() for email in admins.split(',')]
+        return current_user.is_authenticated and current_user.email in admins
+
+    def _before_request(self):
+        g._metrics = {'start': time.perf_counter(), 'statements': 0, 'sql': 0.0, 'profiler': None}
+        if self.app.config['METRICS_PROFILE_DIR'] and random.random() < self.app.config['METRICS_PROFILE_SAMPLE']:
+            g._metrics['profiler'] = cProfile.Profile()
+            g._metrics['profiler'].enable()
+
+    def _after_request(self, response):
+        current = g.pop('_metrics', None)
+        if current is None:
+            return response
+        profiler = current['profiler']
+        if profiler is not None:
+            profiler.disable()
+        seconds = time.perf_counter() - current['start']
+        endpoint = request.endpoint or ''
+        with self._lock:
+            key = (endpoint, request.method, response.status_code)
+            self._requests[key] = self._requests.get(key, 0) + 1
+            histogram = self._durations.setdefault(endpoint, [0] * len(BUCKETS) + [0.0, 0])
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    histogram[i] += 1
+            histogram[-2] += seconds
+            histogram[-1] += 1
+            sql = self._sql.setdefault(endpoint, [0, 0.0])
+            sql[0] += current['statements']
+            sql[1] += current['sql']
+        if seconds >= self.app.config['METRICS_SLOW_REQUEST']:
+            self.app.logger.warning('Slow request %s %s: %.3fs, %d SQL statements in %.3fs', request.method,
+                                    request.full_path, seconds, current['statements'], current['sql'])
+            if profiler is not None:
+                os.makedirs(self.app.config['METRICS_PROFILE_DIR'], exist_ok=True)
+                profiler.dump_stats(os.path.join(self.app.config['METRICS_PROFILE_DIR'], '{}-{}.prof'.format(
+                    time.strftime('%Y%m%d-%H%M%S'), endpoint or 'unknown')))
+        return response
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('metrics_start', []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get('metrics_start')
+        if not starts:
+            return
+        seconds = time.perf_counter() - starts.pop()
+        # statements of background jobs and CLI commands belong to no request
+        if has_request_context() and '_metrics' in g:
+            g._metrics['statements'] += 1
+            g._metrics['sql'] += seconds
+
+    def _before_render_template(self, sender, template, context, **extra):
+        g.setdefault('_template_starts', []).append(time.perf_counter())
+
+    def _template_rendered(self, sender, template, context, **extra):
+        starts = g.get('_template_starts')
+        if not starts:
+            return
+        seconds = time.perf_counter() - starts.pop()
+        with self._lock:
+            totals = self._templates.setdefault(template.name or '', [0, 0.0])
+            totals[0] += 1
+            totals[1] += seconds
+
+    # the totals in the Prometheus text exposition format
+    def render(self):
+        from app import fragment_cache
+        lines = []
+
+        def family(name, kind, help):
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, kind))
+
+        def sample(name, labels, value):
+            text = ','.join('{}="{}"'.format(k, _escape(v)) for k, v in labels.items())
+            lines.append('{}{{{}}} {}'.format(name, text, value) if text else '{} {}'.format(name, value))
+
+        with self._lock:
+            family('mybubble_requests_total', 'counter', 'Requests handled, by endpoint, method and status.')
+            for (endpoint, method, status), count in sorted(self._requests.items()):
+                sample('mybubble_requests_total', {'endpoint': endpoint, 'method': method, 'status': status}, count)
+            family('mybubble_request_duration_seconds', 'histogram', 'Wall time of requests, by endpoint.')
+            for endpoint, histogram in sorted(self._durations.items()):
+                for bound, count in zip(BUCKETS, histogram):
+                    sample('mybubble_request_duration_seconds_bucket', {'endpoint': endpoint, 'le': bound}, count)
+                sample('mybubble_request_duration_seconds_bucket', {'endpoint': endpoint, 'le': '+Inf'}, histogram[-1])
+                sample('mybubble_request_duration_seconds_sum', {'endpoint': endpoint}, histogram[-2])
+                sample('mybubble_request_duration_seconds_count', {'endpoint': endpoint}, histogram[-1])
+            family('mybubble_sql_statements_total', 'counter', 'SQL statements run by requests, by endpoint.')
+            for endpoint, (statements, _) in sorted(self._sql.items()):
+                sample('mybubble_sql_statements_total', {'endpoint': endpoint}, statements)
+            family('mybubble_sql_duration_seconds_total', 'counter', 'Time spent in SQL by requests, by endpoint.')
+            for endpoint, (_, seconds) in sorted(self._sql.items()):
+                sample('mybubble_sql_duration_seconds_total', {'endpoint': endpoint}, seconds)
+            family('mybubble_template_render_seconds', 'summary', 'Render time of templates, by template.')
+            for template, (count, seconds) in sorted(self._templates.items()):
+                sample('mybubble_template_render_seconds_sum', {'template': template}, seconds)
+                sample('mybubble_template_render_seconds_count', {'template': template}, count)
+            family('mybubble_operation_seconds', 'summary', 'Run time of instrumented operations such as uploads.')
+            for operation, (count, seconds) in sorted(self._operations.items()):
+                sample('mybubble_operation_seconds_sum', {'operation': operation}, seconds)
+                sample('mybubble_operation_seconds_count', {'operation': operation}, count)
+        if fragment_cache.backend is not None:
+            stats = fragment_cache.stats()
+            family('mybubble_fragment_cache_lookups_total', 'counter', 'Rendered post lookups, by result.')
+            sample('mybubble_fragment_cache_lookups_total', {'result': 'hit'}, stats['hits'])
+            sample('mybubble_fragment_cache_lookups_total', {'result': 'miss'}, stats['misses'])
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
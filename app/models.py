@@ -1,19 +1,19 @@
-from app import db, login
+from app import db, login, pubsub, timeline, avatar_cache, identity_cache
+from app.avatars import gravatar_digest
 from datetime import datetime, timezone
 from typing import Optional
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask import current_app, url_for
 from flask_login import UserMixin
-from hashlib import md5
 from time import time
+from collections import Counter, defaultdict
 import json
-import jwt
 import sqlalchemy as sa
 import sqlalchemy.orm as so
 
 @login.user_loader
 def load_user(id):
-    return db.session.get(User, int(id))
+    return identity_cache.load(int(id)) # a detached copy when IDENTITY_CACHE is on
 
 followers = sa.Table(
     'followers',
@@ -22,7 +22,9 @@ followers = sa.Table(
     sa.Column('follower_id', sa.Integer, sa.ForeignKey('user.id'),
               primary_key=True),
     sa.Column('followed_id', sa.Integer, sa.ForeignKey('user.id'),
-              primary_key=True)
+              primary_key=True),
+    # the primary key starts with follower_id; this one finds the followers of a user
+    sa.Index('ix_followers_followed_id_follower_id', 'followed_id', 'follower_id')
 )
 
 # defines the initial database structure (schema)
@@ -35,13 +37,21 @@ class User(UserMixin, db.Model):
     posts: so.WriteOnlyMapped['Post'] = so.relationship(back_populates='author')
     about_me: so.Mapped[Optional[str]] = so.mapped_column(sa.String(140))
     last_seen: so.Mapped[Optional[datetime]] = so.mapped_column(default=lambda: datetime.now(timezone.utc))
+    updated_at: so.Mapped[Optional[datetime]] = so.mapped_column(index=True) # last profile edit, see page_validators
     following: so.WriteOnlyMapped['User'] = so.relationship( # the users a given user is following
         secondary=followers, primaryjoin=(followers.c.follower_id==id), # the user must match the follower_id attribute of the association table
         secondaryjoin=(followers.c.followed_id==id), back_populates='followers') # the user on the other side must match the followed_id attribute
     followers: so.WriteOnlyMapped['User'] = so.relationship( # the users that follow a given user
         secondary=followers, primaryjoin=(followers.c.followed_id==id),
         secondaryjoin=(followers.c.follower_id==id), back_populates='following')
+    # maintained by follow()/unfollow() so profile pages do not count the followers table,
+    # `flask counters reconcile` recomputes them
+    followers_total: so.Mapped[int] = so.mapped_column(default=0, server_default='0')
+    following_total: so.Mapped[int] = so.mapped_column(default=0, server_default='0')
     last_message_read_time: so.Mapped[Optional[datetime]]
+    # messages received since last_message_read_time, counted by add_unread_message() and reset
+    # by main.messages so pages do not count the messages table; `flask counters reconcile` recomputes it
+    unread_messages: so.Mapped[int] = so.mapped_column(default=0, server_default='0')
     messages_sent: so.WriteOnlyMapped['Message'] = so.relationship(
         foreign_keys='Message.sender_id', back_populates='author')
     messages_received: so.WriteOnlyMapped['Message'] = so.relationship(
@@ -59,21 +69,33 @@ class User(UserMixin, db.Model):
         return check_password_hash(self.password_hash, password)
 
     def avatar(self, size):
-        user_id = self.id
-        avatar_img = Avatar.query.filter_by(user_id=user_id).first()
+        avatar_img = db.session.scalar(sa.select(Avatar).where(Avatar.user_id == self.id))
+        return self.avatar_from(avatar_img, size)
+
+    # builds the avatar URL from an Avatar row that was already loaded (None means no upload),
+    # so lists of posts can resolve every avatar without a query per user. Uploads are served
+    # resized to `size` by main.avatar; the avatar id in the URL changes with the upload, so
+    # browsers can keep the image for good
+    def avatar_from(self, avatar_img, size):
         if avatar_img:
-            return url_for('static', filename=avatar_img.thumbnail_path)
-        digest = md5(self.email.lower().encode('utf-8')).hexdigest() # encodes the email string as bytes before passing it on to the hash function
-        return f'https://www.gravatar.com/avatar/{digest}?d=identicon&s={size}'
+            return url_for('main.avatar', user_id=self.id, size=avatar_cache.bucket(size), v=avatar_img.id)
+        return f'https://www.gravatar.com/avatar/{gravatar_digest(self.email)}?d=identicon&s={size}'
 
     # SQLAlchemy ORM allows working with the following and followers relationships as if they were lists
+    # the counters are changed in SQL (column + 1) so concurrent follows do not overwrite each other
     def follow(self, user):
         if not self.is_following(user):
             self.following.add(user)
+            self.following_total = User.following_total + 1
+            user.followers_total = User.followers_total + 1
+            timeline.follow(self.id, user.id)
 
     def unfollow(self, user):
         if self.is_following(user):
             self.following.remove(user)
+            self.following_total = User.following_total - 1
+            user.followers_total = User.followers_total - 1
+            timeline.unfollow(self.id, user.id)
 
     def is_following(self, user):
         query = self.following.select().where(User.id==user.id)
@@ -81,32 +103,50 @@ class User(UserMixin, db.Model):
 
     # these methods return the follower and following counts for the user
     def followers_count(self):
-        query = sa.select(sa.func.count()).select_from(self.followers.select().subquery())
-        return db.session.scalar(query)
+        return self.followers_total
 
     def following_count(self):
-        # SQLAlchemy requires the inner query to be converted to a sub-query by calling the subquery()
-        query = sa.select(sa.func.count()).select_from(self.following.select().subquery())
-        return db.session.scalar(query)
-
+        return self.following_total
+
+    # recomputes every user's counters from the followers table in one UPDATE and
+    # returns how many users had drifted
+    @staticmethod
+    def reconcile_follow_counters():
+        followers_actual = (sa.select(sa.func.count()).select_from(followers)
+                            .where(followers.c.followed_id == User.id).scalar_subquery())
+        following_actual = (sa.select(sa.func.count()).select_from(followers)
+                            .where(followers.c.follower_id == User.id).scalar_subquery())
+        drifted = db.session.scalar(sa.select(sa.func.count(User.id)).where(sa.or_(
+            User.followers_total != followers_actual, User.following_total != following_actual)))
+        db.session.execute(sa.update(User).values(followers_total=followers_actual,
+                                                  following_total=following_actual))
+        return drifted
+
+    # recomputes every user's unread message counter in one UPDATE and returns how many had drifted
+    @staticmethod
+    def reconcile_unread_counters():
+        unread_actual = (sa.select(sa.func.count(Message.id)).where(
+            Message.recipient_id == User.id,
+            sa.or_(User.last_message_read_time.is_(None), Message.timestamp > User.last_message_read_time))
+            .scalar_subquery())
+        drifted = db.session.scalar(sa.select(sa.func.count(User.id)).where(User.unread_messages != unread_actual))
+        db.session.execute(sa.update(User).values(unread_messages=unread_actual))
+        return drifted
+
+    # the home timeline: the user's own posts and those of the users they follow, newest first
     def following_posts(self):
-        # creates two references to the User model allowing to
-        # refer to users independently as authors and as followers
-        Author = so.aliased(User)
-        Follower = so.aliased(User)
-        return (sa.select(Post).join(Post.author.of_type(Author)) # select() defines the entity that needs to be obtained
-                .join(Author.followers.of_type(Follower), isouter=True) # join() is a database operation that combines rows from two tables, according to a given criteria
-                .where(sa.or_(Follower.id==self.id, Author.id==self.id,)) # filters the items in the joined table that have a given user as a follower and as an author
-                .group_by(Post).order_by(Post.timestamp.desc())) # eliminates any duplicates of the provided argument (Post) and then sorts them
+        return timeline.query(self.id)
 
     # returns a JWT token as a string
     def get_reset_password_token(self, expires_in=600):
+        import jwt
         return jwt.encode(
             {'reset_password': self.id, 'exp': time() + expires_in},
             current_app.config['SECRET_KEY'], algorithm='HS256')
 
     @staticmethod # it can be invoked directly from the class
     def verify_reset_password_token(token):
+        import jwt
         try:
             # the value of the reset_password key from the token's payload is the ID of the user
             id = jwt.decode(token, current_app.config['SECRET_KEY'], algorithms=['HS256'])['reset_password']
@@ -114,18 +154,31 @@ class User(UserMixin, db.Model):
             return
         return db.session.get(User, id)
 
+    # read from the loaded user, so the navbar and the page validators cost no query
     def unread_message_count(self):
-        last_read_time = self.last_message_read_time or datetime(1900, 1, 1)
-        query = sa.select(Message).where(Message.recipient == self,
-                                         Message.timestamp > last_read_time)
-        return db.session.scalar(sa.select(sa.func.count()).select_from(
-            query.subquery()))
+        return self.unread_messages
+
+    # counts one more unread message in SQL, so concurrent senders do not lose counts, and
+    # returns the new count for the notification
+    def add_unread_message(self):
+        statement = sa.update(User).where(User.id == self.id).values(unread_messages=User.unread_messages + 1) \
+            .execution_options(synchronize_session=False)
+        if db.session.get_bind().dialect.update_returning:
+            count = db.session.scalar(statement.returning(User.unread_messages))
+        else:
+            db.session.execute(statement)
+            count = db.session.scalar(sa.select(User.unread_messages).where(User.id == self.id))
+        so.attributes.set_committed_value(self, 'unread_messages', count)
+        db.session.info.setdefault('identities', set()).add(self.id) # not seen by the flush, see forget_identities
+        return count
 
     def add_notification(self, name, data):
         db.session.execute(self.notifications.delete().where(
             Notification.name == name))
-        n = Notification(name=name, payload_json=json.dumps(data), user=self)
+        n = Notification(name=name, payload_json=json.dumps(data), user=self, timestamp=time())
         db.session.add(n)
+        # pushed to open notification streams once the session commits, see publish_notifications()
+        db.session.info.setdefault('notifications', []).append((self, n.to_dict()))
         return n
 
 
@@ -133,28 +186,129 @@ class Post(db.Model):
     id: so.Mapped[int] = so.mapped_column(primary_key=True)
     body: so.Mapped[str] = so.mapped_column(sa.String(140))
     timestamp: so.Mapped[datetime] = so.mapped_column(index=True, default=lambda: datetime.now(timezone.utc)) # index is useful for retrieving posts in chronological order
-    user_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id), index=True) # the use of a foreign key "user_id" on the "many" side "post"
+    user_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id)) # the use of a foreign key "user_id" on the "many" side "post"
     language: so.Mapped[Optional[str]] = so.mapped_column(sa.String(5))
     parent_post: so.Mapped[Optional[int]] = so.mapped_column(sa.ForeignKey('post.id', name='fk_parent_post'), index=True)
     board_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey('board.id', name='fk_board_id'), nullable=False)
+    # direct replies, maintained by count_replies() so lists can show it without counting,
+    # `flask counters reconcile` recomputes it
+    reply_count: so.Mapped[int] = so.mapped_column(default=0, server_default='0')
 
     author: so.Mapped[User] = so.relationship(back_populates='posts')
     board: so.Mapped['Board'] = so.relationship('Board', back_populates="posts")
     images: so.Mapped[list['Image']] = so.relationship(back_populates='post', cascade='all, delete-orphan')
 
+    # board and profile pages read a range of these in (timestamp, id) order, with no sort
+    __table_args__ = (sa.Index('ix_post_board_id_timestamp_id', 'board_id', 'timestamp', 'id'),
+                      sa.Index('ix_post_user_id_timestamp', 'user_id', 'timestamp'))
+
     def __repr__(self):
         return '<Post {}>'.format(self.body)
 
-    def parent(self, id): # method which returns a parent post object
-        parent_post = db.first_or_404(sa.select(Post).where(Post.id == id))
-        return parent_post
+    # the thread around a post in one query: its ancestors up to `depth` levels up and its replies
+    # down to `depth` levels, found by recursive CTEs that follow ix_post_parent_post, at most
+    # `limit` posts (the deepest replies are left out first). Returns (post, level) pairs in reading
+    # order, the post itself at level 0 and its ancestors at negative levels, or [] if there is no post
+    @staticmethod
+    def thread(post_id, depth=20, limit=500):
+        ancestors = sa.select(Post.id, Post.parent_post, sa.literal(0).label('level')) \
+            .where(Post.id == post_id).cte('ancestors', recursive=True)
+        parent = so.aliased(Post)
+        ancestors = ancestors.union_all(
+            sa.select(parent.id, parent.parent_post, ancestors.c.level - 1)
+            .join(ancestors, parent.id == ancestors.c.parent_post).where(ancestors.c.level > -depth))
+        descendants = sa.select(Post.id, sa.literal(0).label('level')) \
+            .where(Post.id == post_id).cte('descendants', recursive=True)
+        child = so.aliased(Post)
+        descendants = descendants.union_all(
+            sa.select(child.id, descendants.c.level + 1)
+            .join(descendants, child.parent_post == descendants.c.id).where(descendants.c.level < depth))
+        levels = sa.union_all(sa.select(ancestors.c.id, ancestors.c.level).where(ancestors.c.level < 0),
+                              sa.select(descendants.c.id, descendants.c.level)).subquery()
+        rows = db.session.execute(sa.select(Post, levels.c.level).join(levels, Post.id == levels.c.id)
+                                  .order_by(sa.func.abs(levels.c.level), Post.timestamp, Post.id).limit(limit)).all()
+        # ancestors from the top down, then the replies depth-first, oldest first at every level
+        ancestors = sorted((row for row in rows if row.level < 0), key=lambda row: row.level)
+        replies = defaultdict(list)
+        for row in rows: # already in timestamp order
+            if row.level > 0:
+                replies[row.Post.parent_post].append(row)
+        thread = [(row.Post, row.level) for row in ancestors]
+        stack = [row for row in rows if row.level == 0]
+        while stack:
+            row = stack.pop()
+            thread.append((row.Post, row.level))
+            stack.extend(reversed(replies[row.Post.id]))
+        return thread
+
+    # recomputes every post's reply count in one UPDATE and returns how many had drifted
+    @staticmethod
+    def reconcile_reply_counts():
+        replies = so.aliased(Post)
+        replies_actual = sa.select(sa.func.count(replies.id)).where(replies.parent_post == Post.id).scalar_subquery()
+        drifted = db.session.scalar(sa.select(sa.func.count(Post.id)).where(Post.reply_count != replies_actual))
+        db.session.execute(sa.update(Post).values(reply_count=replies_actual))
+        return drifted
+
+
+# counts replies in SQL in the transaction that adds or deletes them, so concurrent replies
+# do not overwrite each other's counts
+@sa.event.listens_for(db.session, 'after_flush')
+def count_replies(session, flush_context):
+    changes = Counter()
+    for obj in session.new:
+        if isinstance(obj, Post) and obj.parent_post:
+            changes[int(obj.parent_post)] += 1
+    for obj in session.deleted:
+        if isinstance(obj, Post) and obj.parent_post:
+            changes[int(obj.parent_post)] -= 1
+    for parent_id, change in changes.items():
+        if change:
+            session.connection().execute(sa.update(Post.__table__).where(Post.__table__.c.id == parent_id)
+                                         .values(reply_count=Post.__table__.c.reply_count + change))
+            parent = session.identity_map.get(session.identity_key(Post, parent_id))
+            if parent is not None:
+                session.expire(parent, ['reply_count'])
+
+# the SQLite full-text index of post bodies lives and dies with the post table, see app/search.py
+sa.event.listen(Post.__table__, 'after_create', sa.DDL(
+    'CREATE VIRTUAL TABLE IF NOT EXISTS post_fts USING fts5(body, board_id UNINDEXED)').execute_if(dialect='sqlite'))
+sa.event.listen(Post.__table__, 'after_drop', sa.DDL('DROP TABLE IF EXISTS post_fts').execute_if(dialect='sqlite'))
+
+# one row per post in each follower's home timeline, written when the post is published
+# (fan-out on write) so User.following_posts() is a range scan, see app/timeline.py
+class TimelineEntry(db.Model):
+    user_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id), primary_key=True)
+    post_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(Post.id), primary_key=True)
+    timestamp: so.Mapped[datetime] # copy of Post.timestamp, so the index alone gives the order
+
+    __table_args__ = (sa.Index('ix_timeline_entry_user_id_timestamp', 'user_id', 'timestamp', 'post_id'),)
+
+    def __repr__(self):
+        return '<TimelineEntry {} {}>'.format(self.user_id, self.post_id)
+
+
+# translations kept across restarts and shared between processes, see app/translate.py
+class Translation(db.Model):
+    id: so.Mapped[int] = so.mapped_column(primary_key=True)
+    text_hash: so.Mapped[str] = so.mapped_column(sa.String(64)) # sha256 of the original text
+    source_language: so.Mapped[str] = so.mapped_column(sa.String(10))
+    dest_language: so.Mapped[str] = so.mapped_column(sa.String(10))
+    text: so.Mapped[str] = so.mapped_column(sa.Text)
+    timestamp: so.Mapped[datetime] = so.mapped_column(default=lambda: datetime.now(timezone.utc))
+
+    __table_args__ = (sa.UniqueConstraint('text_hash', 'source_language', 'dest_language',
+                                          name='uq_translation_key'),)
+
+    def __repr__(self):
+        return '<Translation {} {}>'.format(self.text_hash[:8], self.dest_language)
+
 
 class Message(db.Model):
     id: so.Mapped[int] = so.mapped_column(primary_key=True)
     sender_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id),
                                                  index=True)
-    recipient_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id),
-                                                    index=True)
+    recipient_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id))
     body: so.Mapped[str] = so.mapped_column(sa.String(140))
     timestamp: so.Mapped[datetime] = so.mapped_column(
         index=True, default=lambda: datetime.now(timezone.utc))
@@ -165,6 +319,8 @@ class Message(db.Model):
         foreign_keys='Message.recipient_id',
         back_populates='messages_received')
 
+    __table_args__ = (sa.Index('ix_message_recipient_id_timestamp', 'recipient_id', 'timestamp'),)
+
     def __repr__(self):
         return '<Message {}>'.format(self.body)
 
@@ -172,45 +328,164 @@ class Message(db.Model):
 class Notification(db.Model):
     id: so.Mapped[int] = so.mapped_column(primary_key=True)
     name: so.Mapped[str] = so.mapped_column(sa.String(128), index=True)
-    user_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id),
-                                               index=True)
+    user_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id))
     timestamp: so.Mapped[float] = so.mapped_column(index=True, default=time)
     payload_json: so.Mapped[str] = so.mapped_column(sa.Text)
 
     user: so.Mapped[User] = so.relationship(back_populates='notifications')
 
+    # add_notification() replaces a user's notification by name
+    __table_args__ = (sa.Index('ix_notification_user_id_name', 'user_id', 'name'),)
+
     def get_data(self):
         return json.loads(str(self.payload_json))
 
+    # the format sent to the browser by both the JSON poll and the event stream
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'data': self.get_data(),
+            'timestamp': self.timestamp
+        }
+
+
+@sa.event.listens_for(db.session, 'after_commit')
+def publish_notifications(session):
+    for user, message in session.info.pop('notifications', []):
+        # the user is expired by the commit, but its identity is known without a query
+        pubsub.publish(sa.inspect(user).identity[0], message)
+
+
+@sa.event.listens_for(db.session, 'after_soft_rollback')
+def discard_notifications(session, previous_transaction):
+    session.info.pop('notifications', None)
+
+
+# profile edits, password resets, follows, read messages and new avatars change what the
+# cached identity of a user shows, so it is dropped once they are committed
+@sa.event.listens_for(db.session, 'after_flush')
+def collect_identities(session, flush_context):
+    changed = {obj.id for obj in session.dirty if isinstance(obj, User) and session.is_modified(obj)}
+    for obj in list(session.new) + list(session.deleted):
+        if isinstance(obj, Avatar):
+            changed.add(obj.user_id)
+    if changed:
+        session.info.setdefault('identities', set()).update(changed)
 
-class Image(db.Model):
+
+@sa.event.listens_for(db.session, 'after_commit')
+def forget_identities(session):
+    user_ids = session.info.pop('identities', None)
+    if user_ids:
+        identity_cache.invalidate(*user_ids)
+
+
+@sa.event.listens_for(db.session, 'after_soft_rollback')
+def discard_identities(session, previous_transaction):
+    session.info.pop('identities', None)
+
+
+# shared by uploads that are resized in the background, see app/images.py
+class ProcessedImageMixin:
+    # the original stands in for the thumbnail until it has been processed
+    def thumbnail(self):
+        return self.thumbnail_path if self.status == 'ready' else self.original_path
+
+    def get_variants(self):
+        return json.loads(self.variants_json) if self.variants_json else []
+
+    # every stored file of the upload, relative to the static folder
+    def file_paths(self):
+        paths = [self.original_path] + [v['path'] for v in self.get_variants()]
+        if self.thumbnail_path and self.thumbnail_path not in paths: # uploads processed before variants existed
+            paths.append(self.thumbnail_path)
+        return paths
+
+    # the value of an <img srcset> attribute listing every variant by width
+    def srcset(self):
+        return ', '.join('{} {}w'.format(url_for('static', filename=v['path']), v['width'])
+                         for v in self.get_variants())
+
+
+# an uploaded file stored once under its SHA-256, shared by every Image and Avatar with the same
+# content. Processing results are kept here and copied onto the rows, see app/images.py
+class Blob(ProcessedImageMixin, db.Model):
+    id: so.Mapped[int] = so.mapped_column(primary_key=True)
+    sha256: so.Mapped[str] = so.mapped_column(sa.String(64), index=True, unique=True)
+    original_path: so.Mapped[str] = so.mapped_column(sa.String(255))
+    thumbnail_path: so.Mapped[Optional[str]] = so.mapped_column(sa.String(255))
+    status: so.Mapped[str] = so.mapped_column(sa.String(16), default='pending') # pending, ready or failed
+    variants_json: so.Mapped[Optional[str]] = so.mapped_column(sa.Text)
+    ref_count: so.Mapped[int] = so.mapped_column(default=0) # Image and Avatar rows pointing here
+    timestamp: so.Mapped[datetime] = so.mapped_column(default=lambda: datetime.now(timezone.utc))
+
+    def __repr__(self):
+        return '<Blob {}>'.format(self.sha256)
+
+    # the fields copied onto the rows that use this blob
+    def processed_fields(self):
+        return {'status': self.status, 'thumbnail_path': self.thumbnail_path,
+                'variants_json': self.variants_json}
+
+
+class Image(ProcessedImageMixin, db.Model):
     id: so.Mapped[int] = so.mapped_column(primary_key=True)
     post_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(Post.id), index=True)
-    thumbnail_path: so.Mapped[str] = so.mapped_column(sa.String(255))
+    thumbnail_path: so.Mapped[Optional[str]] = so.mapped_column(sa.String(255)) # filled in by the background worker
     original_path: so.Mapped[str] = so.mapped_column(sa.String(255))
+    status: so.Mapped[str] = so.mapped_column(sa.String(16), default='pending', index=True) # pending, ready or failed
+    variants_json: so.Mapped[Optional[str]] = so.mapped_column(sa.Text) # resized copies, see get_variants()
+    blob_id: so.Mapped[Optional[int]] = so.mapped_column(sa.ForeignKey(Blob.id, name='fk_image_blob_id'), index=True) # None for old uploads
     user_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id), index=True)
     post: so.Mapped['Post'] = so.relationship(back_populates='images')
+    blob: so.Mapped[Optional[Blob]] = so.relationship()
     timestamp: so.Mapped[datetime] = so.mapped_column(index=True, default=lambda: datetime.now(timezone.utc))
 
     def __repr__(self):
         return '<Image {}>'.format(self.id)
 
 
-class Avatar(db.Model):
+class Avatar(ProcessedImageMixin, db.Model):
     id: so.Mapped[int] = so.mapped_column(primary_key=True)
-    thumbnail_path: so.Mapped[str] = so.mapped_column(sa.String(255))
+    thumbnail_path: so.Mapped[Optional[str]] = so.mapped_column(sa.String(255)) # filled in by the background worker
     original_path: so.Mapped[str] = so.mapped_column(sa.String(255))
-    user_id: so.Mapped[int] = so.mapped_column(db.ForeignKey(User.id))
+    status: so.Mapped[str] = so.mapped_column(sa.String(16), default='pending') # pending, ready or failed
+    variants_json: so.Mapped[Optional[str]] = so.mapped_column(sa.Text) # resized copies, see get_variants()
+    blob_id: so.Mapped[Optional[int]] = so.mapped_column(sa.ForeignKey(Blob.id, name='fk_avatar_blob_id'), index=True) # None for old uploads
+    user_id: so.Mapped[int] = so.mapped_column(db.ForeignKey(User.id), index=True)
+    blob: so.Mapped[Optional[Blob]] = so.relationship()
     timestamp: so.Mapped[datetime] = so.mapped_column(index=True, default=lambda: datetime.now(timezone.utc))
 
     def __repr__(self):
         return '<Avatar {}>'.format(self.name)
 
 
+DEFAULT_BOARDS = ['Casual', 'Movies', 'Music', 'Video Games', 'Books']
+
+
 class Board(db.Model):
     id: so.Mapped[int] = so.mapped_column(primary_key=True)
     name: so.Mapped[str] = so.mapped_column(sa.String(50), unique=True, nullable=False)
     posts: so.Mapped[list['Post']] = so.relationship('Post', back_populates="board", lazy="dynamic")
 
     def __repr__(self):
-        return 'Board {}'.format(self.name)
\ No newline at end of file
+        return 'Board {}'.format(self.name)
+
+    # adds the default boards that are missing with a single INSERT, so it can run any number
+    # of times and from several processes at once. Returns the number of boards added
+    @staticmethod
+    def seed_defaults(names=None):
+        names = names or DEFAULT_BOARDS
+        dialect = db.session.get_bind().dialect.name
+        if dialect in ('sqlite', 'postgresql'):
+            if dialect == 'sqlite':
+                from sqlalchemy.dialects.sqlite import insert
+            else:
+                from sqlalchemy.dialects.postgresql import insert
+            statement = insert(Board).values([{'name': name} for name in names]) \
+                .on_conflict_do_nothing(index_elements=['name'])
+        else:
+            defaults = sa.values(sa.column('name', sa.String(50)), name='defaults').data([(name,) for name in names])
+            statement = sa.insert(Board).from_select(['name'], sa.select(defaults.c.name).where(
+                ~sa.select(Board.id).where(Board.name == defaults.c.name).exists()))
+        return db.session.execute(statement).rowcount
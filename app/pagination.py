@@ -0,0 +1,54 @@
+from datetime import datetime, timezone
+import sqlalchemy as sa
+from app import db
+
+
+# a page of a listing ordered newest first by (timestamp, id);
+# attribute names follow Flask-SQLAlchemy's Pagination where they make sense
+class KeysetPage:
+    def __init__(self, items, has_next, has_prev):
+        self.items = items
+        self.has_next = has_next
+        self.has_prev = has_prev
+        # "next" goes to older items, "prev" back to newer ones
+        self.next_cursor = encode_cursor(items[-1]) if has_next else None
+        self.prev_cursor = encode_cursor(items[0]) if has_prev else None
+
+
+def encode_cursor(item):
+    timestamp = item.timestamp
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return '{}_{}'.format(timestamp.isoformat(), item.id)
+
+
+# returns (timestamp, id) or None if the cursor is missing or malformed
+def decode_cursor(cursor):
+    if not cursor:
+        return None
+    timestamp, _, id = cursor.rpartition('_')
+    try:
+        return datetime.fromisoformat(timestamp), int(id)
+    except ValueError:
+        return None
+
+
+# keyset (cursor) pagination over query, which must select model and may carry filters
+# but no ORDER BY. Every page is a single range scan of the (timestamp, id) order
+# fetching per_page + 1 rows, so there is no OFFSET and no COUNT(*)
+def keyset_paginate(query, model, per_page, before=None, after=None):
+    key = sa.tuple_(model.timestamp, model.id)
+    before, after = decode_cursor(before), decode_cursor(after)
+    if before is not None:
+        # walking back towards newer items: read them in ascending order and flip
+        rows = db.session.scalars(query.where(key > before).order_by(
+            model.timestamp.asc(), model.id.asc()).limit(per_page + 1)).all()
+        has_prev = len(rows) > per_page
+        items = rows[:per_page][::-1]
+        return KeysetPage(items, has_next=bool(items), has_prev=has_prev)
+    if after is not None:
+        query = query.where(key < after)
+    rows = db.session.scalars(query.order_by(
+        model.timestamp.desc(), model.id.desc()).limit(per_page + 1)).all()
+    items = rows[:per_page]
+    return KeysetPage(items, has_next=len(rows) > per_page, has_prev=after is not None and bool(items))
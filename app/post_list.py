@@ -0,0 +1,73 @@
+from collections import defaultdict
+import sqlalchemy as sa
+from app import db
+from app.models import User, Post, Image, Avatar
+
+# _post.html shows avatars at this size
+POST_AVATAR_SIZE = 120
+
+
+class PostView:
+    # everything _post.html needs for one post or message, resolved up front
+    # so that rendering a page does not touch the database
+    def __init__(self, item, author, avatar_url, images=None, parent=None, kind='post'):
+        self.kind = kind # 'post' or 'message', their ids overlap
+        self.id = item.id
+        self.body = item.body
+        self.timestamp = item.timestamp
+        self.language = getattr(item, 'language', None)
+        self.board_id = getattr(item, 'board_id', None)
+        self.parent_post = getattr(item, 'parent_post', None)
+        self.reply_count = getattr(item, 'reply_count', 0)
+        self.author = author
+        self.avatar_url = avatar_url
+        self.images = images or []
+        self.parent = parent
+
+    def __repr__(self):
+        return '<PostView {}>'.format(self.id)
+
+
+def _load_users(user_ids):
+    if not user_ids:
+        return {}
+    return {u.id: u for u in db.session.scalars(sa.select(User).where(User.id.in_(user_ids)))}
+
+
+def _load_avatar_urls(users, size):
+    if not users:
+        return {}
+    avatars = {a.user_id: a for a in db.session.scalars(
+        sa.select(Avatar).where(Avatar.user_id.in_(users.keys())))}
+    return {user_id: user.avatar_from(avatars.get(user_id), size) for user_id, user in users.items()}
+
+
+# loads authors, avatars, images and parent posts for a whole page of posts
+# in a constant number of queries (one per kind of object) and returns PostView objects
+def load_posts(posts, avatar_size=POST_AVATAR_SIZE):
+    posts = list(posts)
+    if not posts:
+        return []
+    parent_ids = {p.parent_post for p in posts if p.parent_post}
+    parents = {}
+    if parent_ids:
+        parents = {p.id: p for p in db.session.scalars(sa.select(Post).where(Post.id.in_(parent_ids)))}
+    users = _load_users({p.user_id for p in posts} | {p.user_id for p in parents.values()})
+    avatar_urls = _load_avatar_urls(users, avatar_size)
+    images = defaultdict(list)
+    # in the order of ix_image_post_id, so no sort
+    query = sa.select(Image).where(Image.post_id.in_([p.id for p in posts])).order_by(Image.post_id, Image.id)
+    for image in db.session.scalars(query):
+        images[image.post_id].append(image)
+
+    parent_views = {p.id: PostView(p, users[p.user_id], avatar_urls[p.user_id]) for p in parents.values()}
+    return [PostView(p, users[p.user_id], avatar_urls[p.user_id], images=images[p.id],
+                     parent=parent_views.get(p.parent_post)) for p in posts]
+
+
+# the same for private messages, which have no images or parents
+def load_messages(messages, avatar_size=POST_AVATAR_SIZE):
+    messages = list(messages)
+    users = _load_users({m.sender_id for m in messages})
+    avatar_urls = _load_avatar_urls(users, avatar_size)
+    return [PostView(m, users[m.sender_id], avatar_urls[m.sender_id], kind='message') for m in messages]
@@ -0,0 +1,42 @@
+import queue
+import threading
+
+
+# in-process publish/subscribe of notifications, keyed by user id.
+# Every open notification stream holds a bounded queue; a subscriber that falls
+# behind loses messages rather than blocking the publisher, and resumes from the
+# database with its last seen timestamp when it reconnects.
+# Publications only reach streams served by the same process
+class PubSub:
+    def __init__(self, maxsize=100):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._subscribers = {}  # user id -> set of queues
+
+    def subscribe(self, user_id):
+        q = queue.Queue(maxsize=self.maxsize)
+        with self._lock:
+            self._subscribers.setdefault(user_id, set()).add(q)
+        return q
+
+    def unsubscribe(self, user_id, q):
+        with self._lock:
+            subscribers = self._subscribers.get(user_id)
+            if subscribers is not None:
+                subscribers.discard(q)
+                if not subscribers:
+                    del self._subscribers[user_id]
+
+    def publish(self, user_id, message):
+        with self._lock:
+            subscribers = list(self._subscribers.get(user_id, ()))
+        for q in subscribers:
+            try:
+                q.put_nowait(message)
+            except queue.Full:
+                pass
+        return len(subscribers)
+
+    def subscriber_count(self, user_id):
+        with self._lock:
+            return len(self._subscribers.get(user_id, ()))
@@ -0,0 +1,229 @@
+from collections import Counter
+import math
+import re
+import threading
+import sqlalchemy as sa
+
+TOKEN = re.compile(r'\w+')
+
+
+def tokenize(text):
+    return TOKEN.findall((text or '').lower())
+
+
+# full-text search of post bodies. SEARCH_BACKEND selects the index:
+#   'sqlite'        - an FTS5 table next to the posts, written in the same transaction
+#                     (the default when the database is SQLite)
+#   'memory'        - an inverted index inside this process, loaded from the posts on the
+#                     first search and kept current after each commit (the default otherwise)
+#   'elasticsearch' - the index at ELASTICSEARCH_URL, needs the elasticsearch package
+# posts are indexed as they are inserted and removed as they are deleted; every
+# query returns post ids in order of relevance, a page at a time, read from the index alone
+class Search:
+    def __init__(self, app=None):
+        self.app = None
+        self._backend = None
+        self._listening = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SEARCH_BACKEND', None)
+        app.config.setdefault('SEARCH_RESULTS_PER_PAGE', 10)
+        if app.config['SEARCH_BACKEND'] not in (None, 'sqlite', 'memory', 'elasticsearch'):
+            raise ValueError('Unknown SEARCH_BACKEND {}'.format(app.config['SEARCH_BACKEND']))
+        self.app = app
+        self._backend = None
+        if not self._listening:
+            from app import db
+            sa.event.listen(db.session, 'after_flush', self._after_flush)
+            sa.event.listen(db.session, 'after_commit', self._after_commit)
+            sa.event.listen(db.session, 'after_soft_rollback', self._after_soft_rollback)
+            self._listening = True
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            name = self.app.config['SEARCH_BACKEND']
+            if name is None:
+                from app import db
+                with self.app.app_context():
+                    name = 'sqlite' if db.engine.dialect.name == 'sqlite' else 'memory'
+            backends = {'sqlite': SQLiteSearch, 'memory': MemorySearch, 'elasticsearch': ElasticsearchSearch}
+            self._backend = backends[name](self.app)
+        return self._backend
+
+    # returns (post ids of the page, best match first, True if there is a next page)
+    def query(self, text, board_id=None, page=1, per_page=None):
+        per_page = per_page or self.app.config['SEARCH_RESULTS_PER_PAGE']
+        if not tokenize(text):
+            return [], False
+        ids = self.backend.query(text, board_id, (page - 1) * per_page, per_page + 1)
+        return ids[:per_page], len(ids) > per_page
+
+    # rebuilds the index from every post, for `flask search reindex`; returns the number of posts
+    def reindex(self):
+        from app import db
+        return self.backend.reindex(db.session)
+
+    def _after_flush(self, session, flush_context):
+        from app.models import Post
+        for obj in session.new:
+            if isinstance(obj, Post):
+                self.backend.add(session, obj.id, obj.body, obj.board_id)
+        for obj in session.deleted:
+            if isinstance(obj, Post):
+                self.backend.remove(session, obj.id)
+
+    def _after_commit(self, session):
+        for callback in session.info.pop('search', []):
+            callback()
+
+    def _after_soft_rollback(self, session, previous_transaction):
+        session.info.pop('search', None)
+
+
+def _defer(session, callback):
+    # applied once the transaction commits, dropped if it rolls back
+    session.info.setdefault('search', []).append(callback)
+
+
+class SQLiteSearch:
+    # post_fts is created with the post table, see models.py
+    def __init__(self, app):
+        self.app = app
+
+    def add(self, session, post_id, body, board_id):
+        session.connection().execute(sa.text('INSERT INTO post_fts (rowid, body, board_id) VALUES (:id, :body, :board_id)'),
+                                     {'id': post_id, 'body': body, 'board_id': board_id})
+
+    def remove(self, session, post_id):
+        session.connection().execute(sa.text('DELETE FROM post_fts WHERE rowid = :id'), {'id': post_id})
+
+    def query(self, text, board_id, offset, limit):
+        from app import db
+        # every word is quoted so the input cannot use FTS5 query syntax; words are ANDed
+        match = ' '.join('"{}"'.format(token) for token in tokenize(text))
+        sql = 'SELECT rowid FROM post_fts WHERE post_fts MATCH :match'
+        if board_id is not None:
+            sql += ' AND board_id = :board_id'
+        sql += ' ORDER BY rank LIMIT :limit OFFSET :offset'
+        return db.session.scalars(sa.text(sql), {'match': match, 'board_id': board_id,
+                                                 'limit': limit, 'offset': offset}).all()
+
+    def reindex(self, session):
+        session.execute(sa.text('DELETE FROM post_fts'))
+        result = session.execute(sa.text('INSERT INTO post_fts (rowid, body, board_id) '
+                                         'SELECT id, body, board_id FROM post'))
+        return result.rowcount
+
+
+class MemorySearch:
+    def __init__(self, app):
+        self.app = app
+        self._lock = threading.Lock()
+        self._postings = None  # token -> {post id: occurrences}
+        self._documents = {}  # post id -> (board id, number of tokens, distinct tokens)
+
+    def add(self, session, post_id, body, board_id):
+        _defer(session, lambda: self._add(post_id, body, board_id))
+
+    def remove(self, session, post_id):
+        _defer(session, lambda: self._remove(post_id))
+
+    # BM25 over the posts containing every word of the query
+    def query(self, text, board_id, offset, limit):
+        self._ensure_loaded()
+        tokens = set(tokenize(text))
+        with self._lock:
+            postings = [self._postings.get(token, {}) for token in tokens]
+            if not all(postings):
+                return []
+            postings.sort(key=len)
+            candidates = set(postings[0]).intersection(*postings[1:])
+            if board_id is not None:
+                candidates = {id for id in candidates if self._documents[id][0] == board_id}
+            total = len(self._documents)
+            average = sum(document[1] for document in self._documents.values()) / total
+            scores = {}
+            for posting in postings:
+                idf = math.log(1 + (total - len(posting) + 0.5) / (len(posting) + 0.5))
+                for id in candidates:
+                    tf = posting[id]
+                    length = self._documents[id][1]
+                    scores[id] = scores.get(id, 0) + idf * tf * 2.2 / (tf + 1.2 * (0.25 + 0.75 * length / average))
+        return sorted(scores, key=lambda id: (-scores[id], -id))[offset:offset + limit]
+
+    def reindex(self, session):
+        with self._lock:
+            self._postings = None
+            self._documents = {}
+        self._ensure_loaded()
+        return len(self._documents)
+
+    def _ensure_loaded(self):
+        from app import db
+        from app.models import Post
+        with self._lock:
+            if self._postings is not None:
+                return
+            self._postings = {}
+        for id, body, board_id in db.session.execute(sa.select(Post.id, Post.body, Post.board_id)):
+            self._add(id, body, board_id)
+
+    def _add(self, post_id, body, board_id):
+        tokens = Counter(tokenize(body))
+        with self._lock:
+            if self._postings is None: # not loaded yet, the post will be read with the others
+                return
+            self._documents[post_id] = (board_id, sum(tokens.values()), tuple(tokens))
+            for token, count in tokens.items():
+                self._postings.setdefault(token, {})[post_id] = count
+
+    def _remove(self, post_id):
+        with self._lock:
+            document = self._documents.pop(post_id, None) if self._postings is not None else None
+            if document is None:
+                return
+            for token in document[2]:
+                posting = self._postings[token]
+                del posting[post_id]
+                if not posting:
+                    del self._postings[token]
+
+
+class ElasticsearchSearch:
+    INDEX = 'posts'
+
+    def __init__(self, app):
+        try:
+            from elasticsearch import Elasticsearch
+        except ImportError:
+            raise RuntimeError('SEARCH_BACKEND = "elasticsearch" needs the elasticsearch package')
+        if not app.config.get('ELASTICSEARCH_URL'):
+            raise RuntimeError('SEARCH_BACKEND = "elasticsearch" needs ELASTICSEARCH_URL')
+        self.app = app
+        self.client = Elasticsearch(app.config['ELASTICSEARCH_URL'])
+
+    def add(self, session, post_id, body, board_id):
+        _defer(session, lambda: self.client.index(index=self.INDEX, id=post_id,
+                                                  document={'body': body, 'board_id': board_id}))
+
+    def remove(self, session, post_id):
+        _defer(session, lambda: self.client.options(ignore_status=404).delete(index=self.INDEX, id=post_id))
+
+    def query(self, text, board_id, offset, limit):
+        query = {'bool': {'must': {'match': {'body': {'query': text, 'operator': 'and'}}}}}
+        if board_id is not None:
+            query['bool']['filter'] = {'term': {'board_id': board_id}}
+        result = self.client.search(index=self.INDEX, query=query, from_=offset, size=limit, source=False)
+        return [int(hit['_id']) for hit in result['hits']['hits']]
+
+    def reindex(self, session):
+        from elasticsearch.helpers import bulk
+        from app.models import Post
+        self.client.options(ignore_status=404).indices.delete(index=self.INDEX)
+        rows = session.execute(sa.select(Post.id, Post.body, Post.board_id))
+        indexed, _ = bulk(self.client, ({'_index': self.INDEX, '_id': id, 'body': body, 'board_id': board_id}
+                                        for id, body, board_id in rows))
+        return indexed
@@ -0,0 +1,67 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+
+# a small background job queue. TASK_BACKEND selects where jobs run:
+#   'thread' - a pool of TASK_WORKERS threads inside the web process (the default,
+#              a local stand-in until a Redis-backed queue is wired to REDIS_URL)
+#   'sync'   - inline in the calling thread, handy for the shell and for tests
+# jobs get an application context and their own database session
+class TaskQueue:
+    def __init__(self, app=None):
+        self.app = None
+        self._executor = None
+        self._lock = threading.Lock()
+        self._futures = set()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('TASK_BACKEND', 'thread')
+        app.config.setdefault('TASK_WORKERS', 2)
+        if app.config['TASK_BACKEND'] not in ('thread', 'sync'):
+            raise ValueError('Unknown TASK_BACKEND {}'.format(app.config['TASK_BACKEND']))
+        self.app = app
+
+    def enqueue(self, func, *args, **kwargs):
+        if self.app.config['TASK_BACKEND'] == 'sync':
+            self._run(self.app, func, args, kwargs)
+            return None
+        future = self._get_executor().submit(self._run, self.app, func, args, kwargs)
+        with self._lock:
+            self._futures.add(future)
+        future.add_done_callback(self._discard)
+        return future
+
+    # blocks until every job queued so far has finished
+    def join(self):
+        while True:
+            with self._lock:
+                futures = list(self._futures)
+            if not futures:
+                return
+            for future in futures:
+                future.exception()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.app.config['TASK_WORKERS'],
+                                                    thread_name_prefix='task')
+            return self._executor
+
+    def _discard(self, future):
+        with self._lock:
+            self._futures.discard(future)
+
+    @staticmethod
+    def _run(app, func, args, kwargs):
+        from app import db
+        with app.app_context():
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                app.logger.exception('Background task %s failed', func.__name__)
+                db.session.rollback()
+            finally:
+                db.session.remove()
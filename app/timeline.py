@@ -0,0 +1,227 @@
+import threading
+import sqlalchemy as sa
+
+
+# precomputed home timelines (fan-out on write). Publishing a post adds it to the timeline
+# of its author and of every follower, so reading a timeline no longer joins posts, authors
+# and followers. Authors with more than TIMELINE_FANOUT_LIMIT followers are not fanned out;
+# their posts are pulled in when a follower reads (fan-out on read).
+# TIMELINE_BACKEND selects where timelines live:
+#   'database' - the timeline_entry table (the default)
+#   'memory'   - a ring of the newest TIMELINE_LENGTH posts per user in this process,
+#                rebuilt from the follow graph the first time a user is read
+class Timeline:
+    def __init__(self, app=None):
+        self.app = None
+        self.backend = None
+        self._listening = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('TIMELINE_BACKEND', 'database')
+        app.config.setdefault('TIMELINE_LENGTH', 800)
+        app.config.setdefault('TIMELINE_FANOUT_LIMIT', 1000)
+        backends = {'database': DatabaseTimeline, 'memory': MemoryTimeline}
+        if app.config['TIMELINE_BACKEND'] not in backends:
+            raise ValueError('Unknown TIMELINE_BACKEND {}'.format(app.config['TIMELINE_BACKEND']))
+        self.app = app
+        self.backend = backends[app.config['TIMELINE_BACKEND']](app.config['TIMELINE_LENGTH'])
+        if not self._listening:
+            from app import db
+            sa.event.listen(db.session, 'before_flush', self._before_flush)
+            sa.event.listen(db.session, 'after_flush', self._after_flush)
+            sa.event.listen(db.session, 'after_commit', self._after_commit)
+            sa.event.listen(db.session, 'after_soft_rollback', self._after_soft_rollback)
+            self._listening = True
+
+    @property
+    def fanout_limit(self):
+        return self.app.config['TIMELINE_FANOUT_LIMIT']
+
+    # called by User.follow()/unfollow()
+    def follow(self, follower_id, followed_id):
+        from app import db
+        self.backend.follow(db.session, follower_id, followed_id)
+
+    def unfollow(self, follower_id, followed_id):
+        from app import db
+        self.backend.unfollow(db.session, follower_id, followed_id)
+
+    # returns a select() of the user's timeline posts, newest first
+    def query(self, user_id):
+        from app import db
+        from app.models import User, followers
+        # followed authors that are too popular to be fanned out are read directly
+        pulled_ids = db.session.scalars(
+            sa.select(followers.c.followed_id).join(User, User.id == followers.c.followed_id)
+            .where(followers.c.follower_id == user_id, User.followers_total > self.fanout_limit)).all()
+        return self.backend.query(user_id, pulled_ids)
+
+    # bulk rebuild of every timeline from the follow graph, for `flask timeline rebuild`
+    def rebuild(self):
+        from app import db
+        self.backend.rebuild(db.session, self.fanout_limit)
+
+    # the entries go before the flush deletes the post, they reference it
+    def _before_flush(self, session, flush_context, instances):
+        from app.models import Post
+        for obj in session.deleted:
+            if isinstance(obj, Post):
+                self.backend.remove_post(session, obj.id)
+
+    def _after_flush(self, session, flush_context):
+        from app.models import Post
+        for obj in session.new:
+            if isinstance(obj, Post):
+                self.backend.add_post(session, obj.id, obj.user_id, obj.timestamp, self.fanout_limit)
+
+    def _after_commit(self, session):
+        for callback in session.info.pop('timeline', []):
+            callback()
+
+    def _after_soft_rollback(self, session, previous_transaction):
+        session.info.pop('timeline', None)
+
+
+class DatabaseTimeline:
+    def __init__(self, length):
+        self.length = length
+
+    def add_post(self, session, post_id, author_id, timestamp, fanout_limit):
+        from app.models import User, TimelineEntry, followers
+        connection = session.connection()
+        connection.execute(sa.insert(TimelineEntry).values(user_id=author_id, post_id=post_id, timestamp=timestamp))
+        # one INSERT ... SELECT over the author's followers, skipped for very popular authors
+        popular = (sa.select(User.followers_total).where(User.id == author_id).scalar_subquery() > fanout_limit)
+        recipients = sa.select(followers.c.follower_id, sa.literal(post_id), sa.literal(timestamp, sa.DateTime)) \
+            .where(followers.c.followed_id == author_id, followers.c.follower_id != author_id, sa.not_(popular))
+        connection.execute(sa.insert(TimelineEntry).from_select(['user_id', 'post_id', 'timestamp'], recipients))
+
+    def remove_post(self, session, post_id):
+        from app.models import TimelineEntry
+        session.connection().execute(sa.delete(TimelineEntry).where(TimelineEntry.post_id == post_id))
+
+    # the newest posts of the followed user are backfilled so the timeline is complete at once
+    def follow(self, session, follower_id, followed_id):
+        from app.models import Post, TimelineEntry
+        already_there = sa.select(TimelineEntry.post_id).where(
+            TimelineEntry.user_id == follower_id, TimelineEntry.post_id == Post.id).exists()
+        recent = sa.select(sa.literal(follower_id), Post.id, Post.timestamp) \
+            .where(Post.user_id == followed_id, ~already_there) \
+            .order_by(Post.timestamp.desc()).limit(self.length)
+        session.execute(sa.insert(TimelineEntry).from_select(['user_id', 'post_id', 'timestamp'], recent))
+
+    def unfollow(self, session, follower_id, followed_id):
+        from app.models import Post, TimelineEntry
+        session.execute(sa.delete(TimelineEntry).where(
+            TimelineEntry.user_id == follower_id,
+            TimelineEntry.post_id.in_(sa.select(Post.id).where(Post.user_id == followed_id))))
+
+    def query(self, user_id, pulled_ids):
+        from app.models import Post, TimelineEntry
+        if not pulled_ids:
+            # the common case: a range scan of ix_timeline_entry_user_id_timestamp
+            return (sa.select(Post).join(TimelineEntry, TimelineEntry.post_id == Post.id)
+                    .where(TimelineEntry.user_id == user_id)
+                    .order_by(TimelineEntry.timestamp.desc(), TimelineEntry.post_id.desc()))
+        entries = sa.select(TimelineEntry.post_id).where(TimelineEntry.user_id == user_id)
+        return (sa.select(Post).where(sa.or_(Post.id.in_(entries), Post.user_id.in_(pulled_ids)))
+                .order_by(Post.timestamp.desc(), Post.id.desc()))
+
+    def rebuild(self, session, fanout_limit):
+        from app.models import User, Post, TimelineEntry, followers
+        session.execute(sa.delete(TimelineEntry))
+        own = sa.select(Post.user_id, Post.id, Post.timestamp)
+        followed = sa.select(followers.c.follower_id, Post.id, Post.timestamp) \
+            .join(Post, Post.user_id == followers.c.followed_id) \
+            .join(User, User.id == followers.c.followed_id) \
+            .where(User.followers_total <= fanout_limit)
+        session.execute(sa.insert(TimelineEntry).from_select(
+            ['user_id', 'post_id', 'timestamp'], sa.union(own, followed)))
+
+
+class MemoryTimeline:
+    def __init__(self, length):
+        self.length = length
+        self._lock = threading.Lock()
+        self._rings = {}  # user id -> list of (timestamp, post id, author id), newest first
+
+    def add_post(self, session, post_id, author_id, timestamp, fanout_limit):
+        from app.models import User, followers
+        recipients = [author_id]
+        author_followers = session.connection().execute(sa.select(User.followers_total).where(User.id == author_id)).scalar()
+        if (author_followers or 0) <= fanout_limit:
+            recipients += session.connection().execute(
+                sa.select(followers.c.follower_id).where(followers.c.followed_id == author_id)).scalars().all()
+        entry = (_naive(timestamp), post_id, author_id)
+        self._defer(session, lambda: self._insert(recipients, [entry]))
+
+    def remove_post(self, session, post_id):
+        def remove():
+            with self._lock:
+                for user_id, ring in self._rings.items():
+                    self._rings[user_id] = [e for e in ring if e[1] != post_id]
+        self._defer(session, remove)
+
+    def follow(self, session, follower_id, followed_id):
+        from app.models import Post
+        recent = session.execute(sa.select(Post.timestamp, Post.id, Post.user_id).where(Post.user_id == followed_id)
+                                 .order_by(Post.timestamp.desc()).limit(self.length)).all()
+        entries = [(_naive(timestamp), id, user_id) for timestamp, id, user_id in recent]
+        self._defer(session, lambda: self._insert([follower_id], entries))
+
+    def unfollow(self, session, follower_id, followed_id):
+        def remove():
+            with self._lock:
+                if follower_id in self._rings:
+                    self._rings[follower_id] = [e for e in self._rings[follower_id] if e[2] != followed_id]
+        self._defer(session, remove)
+
+    def query(self, user_id, pulled_ids):
+        from app.models import Post
+        with self._lock:
+            ring = self._rings.get(user_id)
+        if ring is None:
+            ring = self._load(user_id)
+        post_ids = [post_id for _, post_id, _ in ring]
+        condition = Post.id.in_(post_ids)
+        if pulled_ids:
+            condition = sa.or_(condition, Post.user_id.in_(pulled_ids))
+        return sa.select(Post).where(condition).order_by(Post.timestamp.desc(), Post.id.desc())
+
+    def rebuild(self, session, fanout_limit):
+        with self._lock:
+            self._rings.clear()
+
+    # builds a user's ring from the follow graph, used after a restart
+    def _load(self, user_id):
+        from app import db
+        from app.models import User, Post, followers
+        followed = sa.select(followers.c.followed_id).join(User, User.id == followers.c.followed_id) \
+            .where(followers.c.follower_id == user_id)
+        rows = db.session.execute(sa.select(Post.timestamp, Post.id, Post.user_id)
+                                  .where(sa.or_(Post.user_id == user_id, Post.user_id.in_(followed)))
+                                  .order_by(Post.timestamp.desc(), Post.id.desc()).limit(self.length)).all()
+        ring = [(_naive(timestamp), id, author_id) for timestamp, id, author_id in rows]
+        with self._lock:
+            return self._rings.setdefault(user_id, ring)
+
+    def _insert(self, user_ids, entries):
+        with self._lock:
+            for user_id in user_ids:
+                ring = self._rings.get(user_id)
+                if ring is None: # not loaded yet, it will be read from the database
+                    continue
+                known = {e[1] for e in ring}
+                ring = sorted(ring + [e for e in entries if e[1] not in known], reverse=True)
+                self._rings[user_id] = ring[:self.length]
+
+    @staticmethod
+    def _defer(session, callback):
+        # applied once the transaction commits, dropped if it rolls back
+        session.info.setdefault('timeline', []).append(callback)
+
+
+def _naive(timestamp):
+    return timestamp.replace(tzinfo=None) if timestamp.tzinfo is not None else timestamp
@@ -1,19 +1,209 @@
-import requests
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+import hashlib
+import threading
+import time
+from flask import current_app
 from flask_babel import _
-from app import current_app
+import sqlalchemy as sa
+
+
+class TranslationError(Exception):
+    pass
+
+
+# translations go through three layers, each one skipped when the one before has the text:
+#   an in-process LRU of TRANSLATION_CACHE_SIZE entries that expire after TRANSLATION_CACHE_TTL seconds,
+#   the translation table when TRANSLATION_CACHE_PERSIST is set, shared by every process,
+#   the translator service, called with up to TRANSLATOR_BATCH_SIZE texts per request over a
+#   pooled keep-alive session. Identical texts requested at the same time share one call
+class Translator:
+    def __init__(self, app=None):
+        self.app = None
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()  # (text hash, source, dest) -> (expires at, text)
+        self._in_flight = {}  # (text hash, source, dest) -> Future
+        self._session = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('TRANSLATOR_URL', 'https://api.cognitive.microsofttranslator.com/translate')
+        app.config.setdefault('TRANSLATOR_REGION', 'westeurope')
+        app.config.setdefault('TRANSLATOR_TIMEOUT', (3.05, 10))
+        app.config.setdefault('TRANSLATOR_POOL_SIZE', 10)
+        app.config.setdefault('TRANSLATOR_BATCH_SIZE', 100)
+        app.config.setdefault('TRANSLATION_MAX_POSTS', 100)
+        app.config.setdefault('TRANSLATION_CACHE_SIZE', 10000)
+        app.config.setdefault('TRANSLATION_CACHE_TTL', 24 * 60 * 60)
+        app.config.setdefault('TRANSLATION_CACHE_PERSIST', True)
+        self.app = app
+        with self._lock:
+            self._cache.clear()
+            self._session = None
+
+    def translate(self, text, source_language, dest_language):
+        return self.translate_many([text], source_language, dest_language)[0]
+
+    # returns the translations in the order of texts; raises TranslationError if the service fails
+    def translate_many(self, texts, source_language, dest_language):
+        keys = [(_text_hash(text), source_language, dest_language) for text in texts]
+        found = self._cache_get(keys)
+        missing = {key: text for key, text in zip(keys, texts) if key not in found}
+        if missing and self.app.config['TRANSLATION_CACHE_PERSIST']:
+            stored = self._load(list(missing))
+            self._cache_put(stored)
+            found.update(stored)
+            missing = {key: text for key, text in missing.items() if key not in stored}
+        if missing:
+            found.update(self._translate_once(missing, source_language, dest_language))
+        return [found[key] for key in keys]
+
+    # calls the service for the texts no other thread is already translating, then waits for the rest
+    def _translate_once(self, missing, source_language, dest_language):
+        owned, waiting = {}, {}
+        with self._lock:
+            for key, text in missing.items():
+                if key in self._in_flight:
+                    waiting[key] = self._in_flight[key]
+                else:
+                    owned[key] = self._in_flight[key] = Future()
+        results = {}
+        try:
+            if owned:
+                translations = self._request([missing[key] for key in owned], source_language, dest_language)
+                results = dict(zip(owned, translations))
+                self._cache_put(results)
+                if self.app.config['TRANSLATION_CACHE_PERSIST']:
+                    self._store(results)
+                for key, future in owned.items():
+                    future.set_result(results[key])
+        except Exception as e:
+            for future in owned.values():
+                if not future.done():
+                    future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                for key in owned:
+                    self._in_flight.pop(key, None)
+        timeout = sum(self.app.config['TRANSLATOR_TIMEOUT'])
+        for key, future in waiting.items():
+            try:
+                results[key] = future.result(timeout=timeout)
+            except FutureTimeoutError as e:
+                raise TranslationError('gave up waiting for a translation made by another request') from e
+        return results
+
+    def _request(self, texts, source_language, dest_language):
+        import requests
+        config = self.app.config
+        headers = {
+            'Ocp-Apim-Subscription-Key': config['MS_TRANSLATOR_KEY'],
+            'Ocp-Apim-Subscription-Region': config['TRANSLATOR_REGION'],
+        }
+        params = {'api-version': '3.0', 'to': dest_language}
+        if source_language:
+            params['from'] = source_language
+        translations = []
+        batch_size = config['TRANSLATOR_BATCH_SIZE']
+        for i in range(0, len(texts), batch_size):
+            batch = texts[i:i + batch_size]
+            try:
+                r = self._get_session().post(config['TRANSLATOR_URL'], params=params, headers=headers,
+                                             json=[{'Text': text} for text in batch],
+                                             timeout=config['TRANSLATOR_TIMEOUT'])
+            except requests.RequestException as e:
+                raise TranslationError(str(e)) from e
+            if r.status_code != 200:
+                raise TranslationError('the translator answered {}'.format(r.status_code))
+            try: # a proxy's error page or a changed API is a failure like any other
+                items = [item['translations'][0]['text'] for item in r.json()]
+            except (ValueError, TypeError, KeyError, IndexError) as e:
+                raise TranslationError('unexpected answer from the translator: {!r}'.format(e)) from e
+            if len(items) != len(batch) or not all(isinstance(item, str) for item in items):
+                raise TranslationError('unexpected answer from the translator')
+            translations += items
+        return translations
+
+    def _get_session(self):
+        with self._lock:
+            if self._session is None:
+                # imported here so that processes which never translate do not load requests
+                import requests
+                from requests.adapters import HTTPAdapter
+                from urllib3.util.retry import Retry
+                # connections are kept alive and reused, failed calls are retried with a backoff
+                retry = Retry(total=2, backoff_factor=0.2, status_forcelist=(429, 500, 502, 503, 504),
+                              allowed_methods=None)
+                adapter = HTTPAdapter(pool_maxsize=self.app.config['TRANSLATOR_POOL_SIZE'], max_retries=retry)
+                self._session = requests.Session()
+                self._session.mount('https://', adapter)
+                self._session.mount('http://', adapter)
+            return self._session
+
+    def _cache_get(self, keys):
+        found = {}
+        now = time.monotonic()
+        with self._lock:
+            for key in keys:
+                entry = self._cache.get(key)
+                if entry is None:
+                    continue
+                if entry[0] < now:
+                    del self._cache[key]
+                    continue
+                self._cache.move_to_end(key)
+                found[key] = entry[1]
+        return found
+
+    def _cache_put(self, translations):
+        expires = time.monotonic() + self.app.config['TRANSLATION_CACHE_TTL']
+        with self._lock:
+            for key, text in translations.items():
+                self._cache[key] = (expires, text)
+                self._cache.move_to_end(key)
+            while len(self._cache) > self.app.config['TRANSLATION_CACHE_SIZE']:
+                self._cache.popitem(last=False)
+
+    def _load(self, keys):
+        from app import db
+        from app.models import Translation
+        source_language, dest_language = keys[0][1], keys[0][2]
+        rows = db.session.execute(sa.select(Translation.text_hash, Translation.text).where(
+            Translation.text_hash.in_([key[0] for key in keys]),
+            Translation.source_language == (source_language or ''),
+            Translation.dest_language == dest_language)).all()
+        return {(text_hash, source_language, dest_language): text for text_hash, text in rows}
+
+    def _store(self, translations):
+        from app import db
+        from app.models import Translation
+        rows = [{'text_hash': key[0], 'source_language': key[1] or '', 'dest_language': key[2], 'text': text}
+                for key, text in translations.items()]
+        try:
+            with db.session.begin_nested():
+                db.session.execute(sa.insert(Translation), rows)
+        except sa.exc.IntegrityError: # stored meanwhile by another process, the cached copy is enough
+            pass
+
+
+def _text_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
 
 def translate(text, source_language, dest_language):
+    return translate_many([text], source_language, dest_language)[0]
+
+
+# the views' entry point: returns the translated texts, or an error message in place of each
+def translate_many(texts, source_language, dest_language):
+    from app import translator
     #  checks if there is a key for the translation service in the configuration
     if 'MS_TRANSLATOR_KEY' not in current_app.config or not current_app.config['MS_TRANSLATOR_KEY']:
-        print(current_app.config['SECRET_KEY'])
-        return _('Error: the translation service is not configured')
-    auth = {
-        'Ocp-Apim-Subscription-Key': current_app.config['MS_TRANSLATOR_KEY'],
-        'Ocp-Apim-Subscription-Region': 'westeurope',
-    }
-    # sends an HTTP request with a POST method to the URL given as the first argument
-    r = requests.post('https://api.cognitive.microsofttranslator.com'
-                      '/translate?api-version=3.0&from={}&to={}'.format(source_language, dest_language), headers=auth, json=[{'Text': text}])
-    if r.status_code != 200:
-        return _('Error: the translation service failed')
-    return r.json()[0]['translations'][0]['text']
\ No newline at end of file
+        return [_('Error: the translation service is not configured')] * len(texts)
+    try:
+        return translator.translate_many(texts, source_language, dest_language)
+    except TranslationError:
+        current_app.logger.exception('Translation failed')
+        return [_('Error: the translation service failed')] * len(texts)
@@ -0,0 +1,276 @@
+import os
+import random
+import sys
+import time
+import timeit
+from datetime import datetime, timedelta, timezone
+from app import create_app, db, timeline
+from app.models import User, Post, Board, followers
+from config import Config
+import sqlalchemy as sa
+import sqlalchemy.orm as so
+
+
+# python benchmarks.py <name>, each benchmark runs against a throwaway in-memory database
+class BenchmarkConfig(Config):
+    SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    LAST_SEEN_BACKGROUND_FLUSH = False
+    TASK_BACKEND = 'sync'
+
+
+def report(name, seconds, runs):
+    print('{:<28} {:9.3f} ms'.format(name, seconds / runs * 1000))
+
+
+# random follow graph: users each following `follows` others and writing `posts` posts
+def generate_graph(users, follows, posts, seed=1):
+    rng = random.Random(seed)
+    Board.seed_defaults()
+    board = db.session.scalar(sa.select(Board).where(Board.name == 'Casual'))
+    db.session.execute(sa.insert(User), [{'id': i, 'username': 'user{}'.format(i),
+                                          'email': 'user{}@example.com'.format(i)} for i in range(1, users + 1)])
+    edges = {(i, j) for i in range(1, users + 1) for j in rng.sample(range(1, users + 1), follows) if i != j}
+    db.session.execute(sa.insert(followers), [{'follower_id': i, 'followed_id': j} for i, j in edges])
+    start = datetime.now(timezone.utc)
+    db.session.execute(sa.insert(Post), [{'body': 'post', 'user_id': rng.randint(1, users), 'board_id': board.id,
+                                          'timestamp': start - timedelta(seconds=rng.randint(0, 10 ** 7))}
+                                         for _ in range(users * posts)])
+    User.reconcile_follow_counters()
+    timeline.rebuild()
+    db.session.commit()
+
+
+# the home timeline query as it was before app/timeline.py
+def legacy_following_posts(user_id):
+    Author = so.aliased(User)
+    Follower = so.aliased(User)
+    return (sa.select(Post).join(Post.author.of_type(Author))
+            .join(Author.followers.of_type(Follower), isouter=True)
+            .where(sa.or_(Follower.id == user_id, Author.id == user_id))
+            .group_by(Post).order_by(Post.timestamp.desc()))
+
+
+def home_timeline(users=1000, follows=50, posts=20, runs=20):
+    """First page of the home timeline: old join query against the precomputed timeline."""
+    app = create_app(BenchmarkConfig)
+    with app.app_context():
+        db.create_all()
+        generate_graph(users, follows, posts)
+        per_page = app.config['POSTS_PER_PAGE']
+        sample = random.Random(2).sample(range(1, users + 1), runs)
+        for name, query in (('join + group by', legacy_following_posts),
+                            ('timeline (' + app.config['TIMELINE_BACKEND'] + ')', timeline.query)):
+            seconds = timeit.timeit(lambda: [db.session.scalars(query(user_id).limit(per_page)).all()
+                                             for user_id in sample], number=1)
+            report(name, seconds, runs)
+
+
+# short posts with their language, close to what the boards get
+LABELLED_POSTS = [
+    ('en', 'Just finished my first marathon, legs are gone but worth it'),
+    ('en', 'Does anyone know a good place for coffee near the station?'),
+    ('en', 'This board needs more pictures of cats'),
+    ('en', 'I think the new update broke the search again'),
+    ('en', 'Happy birthday to my little sister!'),
+    ('ru', 'Кто-нибудь знает хорошее кафе рядом с вокзалом?'),
+    ('ru', 'Сегодня наконец-то выпал первый снег'),
+    ('ru', 'Посмотрите, какого котика я встретила во дворе'),
+    ('ru', 'Не могу найти зарядку уже второй день'),
+    ('ru', 'Всем доброе утро и хороших выходных'),
+    ('es', '¿Alguien sabe dónde comprar pan sin gluten en el centro?'),
+    ('es', 'Hoy por fin terminé de leer el libro que me recomendaste'),
+    ('fr', 'Quelqu\'un connaît un bon restaurant près de la gare ?'),
+    ('fr', 'Il pleut encore, je reste à la maison aujourd\'hui'),
+    ('de', 'Weiß jemand, wann der nächste Zug nach Berlin fährt?'),
+    ('de', 'Heute endlich den ersten Schnee gesehen'),
+    ('', '😂😂😂'),
+    ('', 'ok'),
+    ('', 'https://example.com/photos/2024/summer'),
+    ('', '+1'),
+]
+
+
+def language_detection(runs=5):
+    """Per-call latency and accuracy of langdetect.detect() and the language detector."""
+    import langdetect
+    texts = [text for _, text in LABELLED_POSTS]
+
+    def plain_detect(text):
+        try:
+            return langdetect.detect(text)
+        except langdetect.LangDetectException:
+            return ''
+
+    start = time.perf_counter()
+    plain_detect('warm up') # langdetect loads its profiles on the first call
+    print('{:<28} {:9.3f} ms'.format('langdetect profile load', (time.perf_counter() - start) * 1000))
+    app = create_app(BenchmarkConfig)
+    with app.app_context():
+        from app import language_detector
+        language_detector.preload()
+        for name, detect, number in (('langdetect.detect', plain_detect, runs),
+                                     ('detector (first call)', language_detector.detect, 1),
+                                     ('detector (memoized)', language_detector.detect, runs)):
+            seconds = timeit.timeit(lambda: [detect(text) for text in texts], number=number)
+            report(name, seconds, len(texts) * number)
+            correct = sum(detect(text) == language for language, text in LABELLED_POSTS)
+            print('{:<28} {:9.0%}'.format('  accuracy', correct / len(LABELLED_POSTS)))
+
+
+def db_concurrency(readers=8, writers=4, seconds=3):
+    """Reads and writes per second from concurrent threads on a SQLite file, per DATABASE_PROFILE."""
+    import tempfile
+    import threading
+    for profile in ('default', 'tuned'):
+        with tempfile.TemporaryDirectory() as tmp:
+            config = type('ProfileConfig', (BenchmarkConfig,), {
+                'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(tmp, 'bench.db'), 'DATABASE_PROFILE': profile})
+            app = create_app(config)
+            with app.app_context():
+                db.create_all()
+                generate_graph(100, 10, 5)
+            counts = {'reads': 0, 'writes': 0, 'errors': 0}
+            lock = threading.Lock()
+            stop = time.monotonic() + seconds
+
+            def work(write):
+                with app.app_context():
+                    board = db.session.scalar(sa.select(Board).where(Board.name == 'Casual'))
+                    while time.monotonic() < stop:
+                        try:
+                            if write: # a post, then the last_seen update that used to follow every request
+                                db.session.add(Post(body='benchmark', user_id=random.randint(1, 100), board=board))
+                                db.session.commit()
+                                db.session.execute(sa.update(User).where(User.id == random.randint(1, 100))
+                                                   .values(last_seen=datetime.now(timezone.utc)))
+                                db.session.commit()
+                            else:
+                                db.session.scalars(sa.select(Post).where(Post.board_id == board.id)
+                                                   .order_by(Post.timestamp.desc()).limit(5)).all()
+                                db.session.commit()
+                            kind = 'writes' if write else 'reads'
+                        except sa.exc.OperationalError: # database is locked
+                            db.session.rollback()
+                            kind = 'errors'
+                        with lock:
+                            counts[kind] += 1
+                    db.session.remove()
+
+            threads = [threading.Thread(target=work, args=(i < writers,)) for i in range(readers + writers)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            with app.app_context():
+                db.engine.dispose()
+            print('{:<8} {:8.0f} reads/s {:8.0f} writes/s {:6d} locked errors'.format(
+                profile, counts['reads'] / seconds, counts['writes'] / seconds, counts['errors']))
+
+
+# run in a new interpreter, prints the seconds spent importing the app and in create_app()
+COLD_START = '''
+import time
+start = time.perf_counter()
+from app import create_app
+imported = time.perf_counter()
+create_app()
+print(imported - start, time.perf_counter() - imported)
+'''
+
+
+def cold_start(runs=10):
+    """Start-up of a new process on a SQLite file, without and with DATABASE_AUTO_INIT."""
+    import subprocess
+    import tempfile
+    root = os.path.dirname(os.path.abspath(__file__))
+    for name, auto_init in (('default', False), ('DATABASE_AUTO_INIT', True)):
+        with tempfile.TemporaryDirectory() as tmp: # also the working directory, for logs/
+            env = dict(os.environ, PYTHONPATH=root, DATABASE_URL='sqlite:///' + os.path.join(tmp, 'bench.db'))
+            env.pop('DATABASE_AUTO_INIT', None)
+            if auto_init:
+                env['DATABASE_AUTO_INIT'] = '1'
+            imports = startup = 0
+            for _ in range(runs):
+                output = subprocess.run([sys.executable, '-c', COLD_START], cwd=tmp, env=env,
+                                        capture_output=True, text=True, check=True).stdout
+                seconds = [float(value) for value in output.split()]
+                imports += seconds[0]
+                startup += seconds[1]
+            print(name)
+            report('  import app', imports, runs)
+            report('  create_app()', startup, runs)
+
+
+# modules a worker only needs for some requests, loaded on first use
+LAZY_MODULES = ('langdetect', 'PIL', 'requests', 'jwt')
+
+
+def import_time(runs=5):
+    """Import time of a new process creating the app, per package (python -X importtime)."""
+    import subprocess
+    import tempfile
+    root = os.path.dirname(os.path.abspath(__file__))
+    packages = {}
+    with tempfile.TemporaryDirectory() as tmp: # the working directory, for logs/
+        for _ in range(runs):
+            stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                                     'from app import create_app; create_app()'],
+                                    cwd=tmp, env=dict(os.environ, PYTHONPATH=root),
+                                    capture_output=True, text=True, check=True).stderr
+            for line in stderr.splitlines():
+                # "import time: self [us] | cumulative | imported module"
+                if not line.startswith('import time:') or 'cumulative' in line:
+                    continue
+                own, _, module = line[len('import time:'):].split('|')
+                package = module.strip().split('.')[0]
+                packages[package] = packages.get(package, 0) + int(own) / 10 ** 6
+    for name, seconds in sorted(packages.items(), key=lambda item: -item[1])[:15]:
+        report(name, seconds, runs)
+    report('total', sum(packages.values()), runs)
+    loaded = [name for name in LAZY_MODULES if name in packages]
+    print('lazy modules imported at start-up: {}'.format(', '.join(loaded) or 'none'))
+
+
+def identity_cache(users=200, runs=500):
+    """Requests of a logged-in user, loading them from the database or from IDENTITY_CACHE."""
+    for enabled in (False, True):
+        app = create_app(type('IdentityConfig', (BenchmarkConfig,), {
+            'SECRET_KEY': 'benchmark', 'IDENTITY_CACHE': enabled, 'CONDITIONAL_GET': False}))
+        with app.app_context():
+            db.create_all()
+            generate_graph(users, 10, 5)
+            engine = db.engine
+        loads = []
+
+        def count(conn, cursor, statement, *args):
+            if statement.startswith('SELECT user.id'):
+                loads.append(statement)
+        sa.event.listen(engine, 'before_cursor_execute', count)
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = '1'
+        print('IDENTITY_CACHE = {}'.format(enabled))
+        for url in ('/notifications', '/board/Casual'):
+            client.get(url) # fills the cache
+            del loads[:]
+            start = time.perf_counter()
+            for _ in range(runs):
+                client.get(url)
+            report('  ' + url, time.perf_counter() - start, runs)
+            print('  {:<26} {:9.2f}'.format('user SELECTs / request', len(loads) / runs))
+        sa.event.remove(engine, 'before_cursor_execute', count)
+
+
+BENCHMARKS = {
+    'home_timeline': home_timeline,
+    'language_detection': language_detection,
+    'db_concurrency': db_concurrency,
+    'cold_start': cold_start,
+    'import_time': import_time,
+    'identity_cache': identity_cache,
+}
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        sys.exit('usage: python benchmarks.py {{{}}}'.format('|'.join(BENCHMARKS)))
+    BENCHMARKS[sys.argv[1]]()
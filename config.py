@@ -10,6 +10,12 @@ class Config:
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
         'sqlite:///' + os.path.join(basedir, 'app.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # create the tables and the default boards when the app starts, see `flask init-db`
+    DATABASE_AUTO_INIT = os.environ.get('DATABASE_AUTO_INIT') is not None
+    # 'tuned' sets WAL and friends on SQLite and a connection pool elsewhere, 'default' leaves the engine alone
+    DATABASE_PROFILE = os.environ.get('DATABASE_PROFILE') or 'tuned'
+    DATABASE_POOL_SIZE = int(os.environ.get('DATABASE_POOL_SIZE') or 10)
+    DATABASE_MAX_OVERFLOW = int(os.environ.get('DATABASE_MAX_OVERFLOW') or 20)
     MAIL_SERVER = os.environ.get('MAIL_SERVER')
     MAIL_PORT = int(os.environ.get('MAIL_PORT') or 25)
     MAIL_USE_TLS = os.environ.get('MAIL_USE_TLS') is not None
@@ -19,18 +25,99 @@ class Config:
     SECURITY_EMAIL_SENDER = ''
     MAIL_DEFAULT_SENDER = os.environ.get('MAIL_DEFAULT_SENDER')
     MAIL_DEBUG = 1
+    # mail is sent by MAIL_WORKERS threads from a queue of MAIL_QUEUE_SIZE messages ('thread'),
+    # or inline ('sync')
+    MAIL_DISPATCH = os.environ.get('MAIL_DISPATCH') or 'thread'
+    MAIL_WORKERS = 2
+    MAIL_QUEUE_SIZE = 100
+    MAIL_RETRIES = 3
     LANGUAGES = ['en', 'ru']
     MS_TRANSLATOR_KEY = os.environ.get('MS_TRANSLATOR_KEY')
+    TRANSLATOR_URL = os.environ.get('TRANSLATOR_URL') or 'https://api.cognitive.microsofttranslator.com/translate'
+    TRANSLATOR_REGION = 'westeurope'
+    TRANSLATOR_TIMEOUT = (3.05, 10) # seconds to connect, seconds to read
+    TRANSLATOR_POOL_SIZE = 10
+    TRANSLATOR_BATCH_SIZE = 100
+    TRANSLATION_MAX_POSTS = 100 # posts translated per /translate request, the rest are ignored
+    # translations are cached in memory and, with TRANSLATION_CACHE_PERSIST, in the translation table
+    TRANSLATION_CACHE_SIZE = 10000
+    TRANSLATION_CACHE_TTL = 24 * 60 * 60
+    TRANSLATION_CACHE_PERSIST = True
     ELASTICSEARCH_URL = os.environ.get('ELASTICSEARCH_URL')
+    # 'sqlite' (FTS5), 'memory' or 'elasticsearch'; unset picks 'sqlite' on SQLite and 'memory' elsewhere
+    SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND')
+    SEARCH_RESULTS_PER_PAGE = 10
     REDIS_URL = os.environ.get('REDIS_URL') or 'redis://'
+    # User.last_seen is written at most once per LAST_SEEN_INTERVAL seconds per user,
+    # by a background flusher that runs every LAST_SEEN_FLUSH_INTERVAL seconds
+    LAST_SEEN_INTERVAL = 60
+    LAST_SEEN_FLUSH_INTERVAL = 10
+    LAST_SEEN_BACKGROUND_FLUSH = True
+    # notifications are pushed over Server-Sent Events; when disabled the browser polls /notifications.
+    # A stream is closed after NOTIFICATION_STREAM_TIMEOUT seconds and the browser reconnects
+    NOTIFICATION_STREAM = True
+    NOTIFICATION_STREAM_TIMEOUT = 300
+    NOTIFICATION_STREAM_KEEPALIVE = 15
+    # where background jobs run, 'thread' (a pool of TASK_WORKERS threads) or 'sync'
+    TASK_BACKEND = os.environ.get('TASK_BACKEND') or 'thread'
+    TASK_WORKERS = int(os.environ.get('TASK_WORKERS') or 2)
+    # home timelines are written when a post is published, to the timeline_entry table ('database')
+    # or to per-process rings of TIMELINE_LENGTH posts ('memory'). Posts of users with more than
+    # TIMELINE_FANOUT_LIMIT followers are not copied but read when a follower opens the timeline
+    TIMELINE_BACKEND = os.environ.get('TIMELINE_BACKEND') or 'database'
+    TIMELINE_LENGTH = 800
+    TIMELINE_FANOUT_LIMIT = 1000
+    # the language of new posts is detected while publishing ('sync') or by a background job ('background')
+    LANGUAGE_DETECTION = os.environ.get('LANGUAGE_DETECTION') or 'sync'
+    LANGUAGE_DETECTION_SEED = 0
+    # load the language profiles when the app is created rather than on the first post
+    LANGUAGE_DETECTION_PRELOAD = os.environ.get('LANGUAGE_DETECTION_PRELOAD') is not None
+    # rendered posts are cached in memory ('memory'), in Redis ('redis') or not at all (None)
+    FRAGMENT_CACHE = os.environ.get('FRAGMENT_CACHE', 'memory') or None
+    FRAGMENT_CACHE_SIZE = 2000
+    # the logged-in user is loaded from a per-process cache instead of a SELECT per request. A
+    # commit changing the user clears their entry here; other processes see it after the TTL
+    IDENTITY_CACHE = os.environ.get('IDENTITY_CACHE') is not None
+    IDENTITY_CACHE_TTL = 30
+    IDENTITY_CACHE_SIZE = 10000
+    # per-endpoint request, SQL and template timings served at /metrics to ADMINS or to a scraper
+    # sending METRICS_TOKEN. Requests slower than METRICS_SLOW_REQUEST seconds are logged; with
+    # METRICS_PROFILE_DIR a METRICS_PROFILE_SAMPLE share of requests is profiled and slow ones dumped there
+    METRICS = os.environ.get('METRICS') is not None
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+    METRICS_SLOW_REQUEST = 1.0
+    METRICS_PROFILE_DIR = os.environ.get('METRICS_PROFILE_DIR')
+    METRICS_PROFILE_SAMPLE = 0.01
+    # post pages answer conditional GETs with 304 Not Modified
+    CONDITIONAL_GET = True
     POSTS_PER_PAGE = 5
+    # a thread page shows THREAD_DEPTH levels of ancestors and replies, at most THREAD_MAX_POSTS posts
+    THREAD_DEPTH = 20
+    THREAD_MAX_POSTS = 500
+    THREAD_MAX_INDENT = 8
     NEW_POSTS_PER_PAGE = 2
     MAX_CONTENT_LENGTH = 5120 * 5120
+    # uploads with more pixels are rejected from their header, before anything decodes them
+    MAX_IMAGE_PIXELS = 40 * 1000 * 1000
     UPLOAD_EXTENSIONS = ['.JPG', '.jpg', '.jpeg', '.png', '.gif']
     IMAGE_EXTENSIONS = ['.JPG', '.jpg', '.jpeg', '.JPEG', '.png']
+    # resized copies made of every uploaded image and avatar, by name and longest side in px;
+    # the smallest one is the thumbnail. IMAGE_VARIANT_FORMAT = None keeps the upload's format
+    IMAGE_VARIANT_SIZES = {'thumbnail': 150, 'medium': 480, 'large': 1080}
+    IMAGE_VARIANT_FORMAT = 'WEBP'
+    IMAGE_VARIANT_QUALITY = 80
+    IMAGE_STRIP_METADATA = True
+    # uploads are stored once per content hash here, shared by posts and avatars
+    BLOB_UPLOAD_PATH = "app/static/uploads/blobs"
+    BLOB_STATIC_PATH = "uploads/blobs/"
     UPLOAD_PATH = "app/static/uploads/posts"
     AVATAR_UPLOAD_PATH = "app/static/avatars"
     AVATAR_DELETE_PATH = "app/static/"
+    # uploaded avatars are served resized to the next of AVATAR_SIZES, made on first request and
+    # kept in AVATAR_CACHE_PATH, whose least recently read files go beyond AVATAR_CACHE_MAX_BYTES
+    AVATAR_SIZES = (32, 64, 128, 256)
+    AVATAR_CACHE_PATH = os.environ.get('AVATAR_CACHE_PATH') or 'cache/avatars'
+    AVATAR_CACHE_MAX_BYTES = 64 * 1024 * 1024
     DOWNLOAD_PATH = "static/uploads/posts"
     IMAGE_DOWNLOAD_PATH = "static/uploads/images"
     STATIC_PATH = "uploads/posts/"
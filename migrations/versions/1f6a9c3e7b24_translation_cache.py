@@ -0,0 +1,33 @@
+"""translation cache
+
+Revision ID: 1f6a9c3e7b24
+Revises: e51f0c2d8a37
+Create Date: 2026-10-18 15:22:04.871936
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '1f6a9c3e7b24'
+down_revision = 'e51f0c2d8a37'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('translation',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('text_hash', sa.String(length=64), nullable=False),
+    sa.Column('source_language', sa.String(length=10), nullable=False),
+    sa.Column('dest_language', sa.String(length=10), nullable=False),
+    sa.Column('text', sa.Text(), nullable=False),
+    sa.Column('timestamp', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('text_hash', 'source_language', 'dest_language', name='uq_translation_key')
+    )
+
+
+def downgrade():
+    op.drop_table('translation')
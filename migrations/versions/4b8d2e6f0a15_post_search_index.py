@@ -0,0 +1,30 @@
+"""post search index
+
+Revision ID: 4b8d2e6f0a15
+Revises: 1f6a9c3e7b24
+Create Date: 2026-10-18 16:05:48.203317
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4b8d2e6f0a15'
+down_revision = '1f6a9c3e7b24'
+branch_labels = None
+depends_on = None
+
+
+# the FTS5 index only exists on SQLite, other databases use the memory or elasticsearch backends
+def upgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    op.execute('CREATE VIRTUAL TABLE post_fts USING fts5(body, board_id UNINDEXED)')
+    op.execute('INSERT INTO post_fts (rowid, body, board_id) SELECT id, body, board_id FROM post')
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    op.execute('DROP TABLE post_fts')
@@ -0,0 +1,37 @@
+"""image processing state
+
+Revision ID: 5c1e8f3a9b42
+Revises: 27bdd1975554
+Create Date: 2026-10-18 12:10:04.118213
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c1e8f3a9b42'
+down_revision = '27bdd1975554'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # existing rows already have their thumbnails, so they start out as ready
+    with op.batch_alter_table('image', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('status', sa.String(length=16), nullable=False, server_default='ready'))
+        batch_op.alter_column('thumbnail_path', existing_type=sa.String(length=50), nullable=True)
+
+    with op.batch_alter_table('avatar', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('status', sa.String(length=16), nullable=False, server_default='ready'))
+        batch_op.alter_column('thumbnail_path', existing_type=sa.String(length=50), nullable=True)
+
+
+def downgrade():
+    with op.batch_alter_table('avatar', schema=None) as batch_op:
+        batch_op.alter_column('thumbnail_path', existing_type=sa.String(length=50), nullable=False)
+        batch_op.drop_column('status')
+
+    with op.batch_alter_table('image', schema=None) as batch_op:
+        batch_op.alter_column('thumbnail_path', existing_type=sa.String(length=50), nullable=False)
+        batch_op.drop_column('status')
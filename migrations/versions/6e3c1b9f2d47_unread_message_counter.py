@@ -0,0 +1,31 @@
+"""unread message counter
+
+Revision ID: 6e3c1b9f2d47
+Revises: 4b8d2e6f0a15
+Create Date: 2026-10-18 15:02:41.518230
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6e3c1b9f2d47'
+down_revision = '4b8d2e6f0a15'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('unread_messages', sa.Integer(), server_default='0', nullable=False))
+
+    # backfill from the messages received since each user last opened their messages
+    op.execute('UPDATE "user" SET unread_messages = (SELECT count(*) FROM message '
+               'WHERE message.recipient_id = "user".id AND ("user".last_message_read_time IS NULL '
+               'OR message.timestamp > "user".last_message_read_time))')
+
+
+def downgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_column('unread_messages')
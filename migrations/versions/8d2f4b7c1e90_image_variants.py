@@ -0,0 +1,32 @@
+"""image variants
+
+Revision ID: 8d2f4b7c1e90
+Revises: 5c1e8f3a9b42
+Create Date: 2026-10-18 12:48:31.502947
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8d2f4b7c1e90'
+down_revision = '5c1e8f3a9b42'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('image', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('variants_json', sa.Text(), nullable=True))
+
+    with op.batch_alter_table('avatar', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('variants_json', sa.Text(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('avatar', schema=None) as batch_op:
+        batch_op.drop_column('variants_json')
+
+    with op.batch_alter_table('image', schema=None) as batch_op:
+        batch_op.drop_column('variants_json')
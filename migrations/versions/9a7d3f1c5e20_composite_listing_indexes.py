@@ -0,0 +1,59 @@
+"""composite listing indexes
+
+Revision ID: 9a7d3f1c5e20
+Revises: 6e3c1b9f2d47
+Create Date: 2026-10-18 16:20:09.731452
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9a7d3f1c5e20'
+down_revision = '6e3c1b9f2d47'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # the single-column indexes on user_id and recipient_id are prefixes of the new ones
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.create_index('ix_post_board_id_timestamp_id', ['board_id', 'timestamp', 'id'], unique=False)
+        batch_op.create_index('ix_post_user_id_timestamp', ['user_id', 'timestamp'], unique=False)
+        batch_op.drop_index('ix_post_user_id')
+
+    with op.batch_alter_table('message', schema=None) as batch_op:
+        batch_op.create_index('ix_message_recipient_id_timestamp', ['recipient_id', 'timestamp'], unique=False)
+        batch_op.drop_index('ix_message_recipient_id')
+
+    with op.batch_alter_table('notification', schema=None) as batch_op:
+        batch_op.create_index('ix_notification_user_id_name', ['user_id', 'name'], unique=False)
+        batch_op.drop_index('ix_notification_user_id')
+
+    with op.batch_alter_table('followers', schema=None) as batch_op:
+        batch_op.create_index('ix_followers_followed_id_follower_id', ['followed_id', 'follower_id'], unique=False)
+
+    with op.batch_alter_table('avatar', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_avatar_user_id'), ['user_id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('avatar', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_avatar_user_id'))
+
+    with op.batch_alter_table('followers', schema=None) as batch_op:
+        batch_op.drop_index('ix_followers_followed_id_follower_id')
+
+    with op.batch_alter_table('notification', schema=None) as batch_op:
+        batch_op.create_index('ix_notification_user_id', ['user_id'], unique=False)
+        batch_op.drop_index('ix_notification_user_id_name')
+
+    with op.batch_alter_table('message', schema=None) as batch_op:
+        batch_op.create_index('ix_message_recipient_id', ['recipient_id'], unique=False)
+        batch_op.drop_index('ix_message_recipient_id_timestamp')
+
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.create_index('ix_post_user_id', ['user_id'], unique=False)
+        batch_op.drop_index('ix_post_user_id_timestamp')
+        batch_op.drop_index('ix_post_board_id_timestamp_id')
@@ -0,0 +1,76 @@
+"""content addressed blobs
+
+Revision ID: a3b9d6e2f174
+Revises: 8d2f4b7c1e90
+Create Date: 2026-10-18 13:21:47.880413
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a3b9d6e2f174'
+down_revision = '8d2f4b7c1e90'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('blob',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('sha256', sa.String(length=64), nullable=False),
+    sa.Column('original_path', sa.String(length=255), nullable=False),
+    sa.Column('thumbnail_path', sa.String(length=255), nullable=True),
+    sa.Column('status', sa.String(length=16), nullable=False),
+    sa.Column('variants_json', sa.Text(), nullable=True),
+    sa.Column('ref_count', sa.Integer(), nullable=False),
+    sa.Column('timestamp', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('blob', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_blob_sha256'), ['sha256'], unique=True)
+
+    with op.batch_alter_table('image', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('blob_id', sa.Integer(), nullable=True))
+        batch_op.create_index(batch_op.f('ix_image_blob_id'), ['blob_id'], unique=False)
+        batch_op.create_foreign_key('fk_image_blob_id', 'blob', ['blob_id'], ['id'])
+        # room for uploads/blobs/<sha256>.<ext> and its variants
+        batch_op.alter_column('original_path', existing_type=sa.String(length=50), type_=sa.String(length=255),
+                              existing_nullable=False)
+        batch_op.alter_column('thumbnail_path', existing_type=sa.String(length=50), type_=sa.String(length=255),
+                              existing_nullable=True)
+
+    with op.batch_alter_table('avatar', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('blob_id', sa.Integer(), nullable=True))
+        batch_op.create_index(batch_op.f('ix_avatar_blob_id'), ['blob_id'], unique=False)
+        batch_op.create_foreign_key('fk_avatar_blob_id', 'blob', ['blob_id'], ['id'])
+        batch_op.alter_column('original_path', existing_type=sa.String(length=50), type_=sa.String(length=255),
+                              existing_nullable=False)
+        batch_op.alter_column('thumbnail_path', existing_type=sa.String(length=50), type_=sa.String(length=255),
+                              existing_nullable=True)
+
+
+def downgrade():
+    with op.batch_alter_table('avatar', schema=None) as batch_op:
+        batch_op.alter_column('thumbnail_path', existing_type=sa.String(length=255), type_=sa.String(length=50),
+                              existing_nullable=True)
+        batch_op.alter_column('original_path', existing_type=sa.String(length=255), type_=sa.String(length=50),
+                              existing_nullable=False)
+        batch_op.drop_constraint('fk_avatar_blob_id', type_='foreignkey')
+        batch_op.drop_index(batch_op.f('ix_avatar_blob_id'))
+        batch_op.drop_column('blob_id')
+
+    with op.batch_alter_table('image', schema=None) as batch_op:
+        batch_op.alter_column('thumbnail_path', existing_type=sa.String(length=255), type_=sa.String(length=50),
+                              existing_nullable=True)
+        batch_op.alter_column('original_path', existing_type=sa.String(length=255), type_=sa.String(length=50),
+                              existing_nullable=False)
+        batch_op.drop_constraint('fk_image_blob_id', type_='foreignkey')
+        batch_op.drop_index(batch_op.f('ix_image_blob_id'))
+        batch_op.drop_column('blob_id')
+
+    with op.batch_alter_table('blob', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_blob_sha256'))
+
+    op.drop_table('blob')
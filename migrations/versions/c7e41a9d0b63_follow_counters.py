@@ -0,0 +1,33 @@
+"""follow counters
+
+Revision ID: c7e41a9d0b63
+Revises: a3b9d6e2f174
+Create Date: 2026-10-18 13:58:12.264079
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c7e41a9d0b63'
+down_revision = 'a3b9d6e2f174'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('followers_total', sa.Integer(), server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('following_total', sa.Integer(), server_default='0', nullable=False))
+
+    # backfill from the followers table
+    op.execute('UPDATE "user" SET '
+               'followers_total = (SELECT count(*) FROM followers WHERE followers.followed_id = "user".id), '
+               'following_total = (SELECT count(*) FROM followers WHERE followers.follower_id = "user".id)')
+
+
+def downgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_column('following_total')
+        batch_op.drop_column('followers_total')
@@ -0,0 +1,29 @@
+"""post reply count
+
+Revision ID: d2b8e4a61c93
+Revises: 9a7d3f1c5e20
+Create Date: 2026-10-18 17:41:55.902318
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd2b8e4a61c93'
+down_revision = '9a7d3f1c5e20'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('reply_count', sa.Integer(), server_default='0', nullable=False))
+
+    # backfill from the replies
+    op.execute('UPDATE post SET reply_count = (SELECT count(*) FROM post AS reply WHERE reply.parent_post = post.id)')
+
+
+def downgrade():
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.drop_column('reply_count')
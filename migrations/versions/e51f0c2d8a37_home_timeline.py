@@ -0,0 +1,43 @@
+"""home timeline
+
+Revision ID: e51f0c2d8a37
+Revises: c7e41a9d0b63
+Create Date: 2026-10-18 14:41:27.518302
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e51f0c2d8a37'
+down_revision = 'c7e41a9d0b63'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('timeline_entry',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('post_id', sa.Integer(), nullable=False),
+    sa.Column('timestamp', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['post_id'], ['post.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('user_id', 'post_id')
+    )
+    with op.batch_alter_table('timeline_entry', schema=None) as batch_op:
+        batch_op.create_index('ix_timeline_entry_user_id_timestamp', ['user_id', 'timestamp', 'post_id'], unique=False)
+
+    # backfill: every user's own posts plus the posts of the users they follow
+    op.execute('INSERT INTO timeline_entry (user_id, post_id, timestamp) '
+               'SELECT post.user_id, post.id, post.timestamp FROM post '
+               'UNION '
+               'SELECT followers.follower_id, post.id, post.timestamp FROM followers '
+               'JOIN post ON post.user_id = followers.followed_id')
+
+
+def downgrade():
+    with op.batch_alter_table('timeline_entry', schema=None) as batch_op:
+        batch_op.drop_index('ix_timeline_entry_user_id_timestamp')
+
+    op.drop_table('timeline_entry')
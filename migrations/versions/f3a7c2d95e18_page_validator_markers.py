@@ -0,0 +1,34 @@
+"""page validator markers
+
+Revision ID: f3a7c2d95e18
+Revises: d2b8e4a61c93
+Create Date: 2026-10-18 19:12:40.518226
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f3a7c2d95e18'
+down_revision = 'd2b8e4a61c93'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('updated_at', sa.DateTime(), nullable=True))
+        batch_op.create_index(batch_op.f('ix_user_updated_at'), ['updated_at'], unique=False)
+
+    with op.batch_alter_table('image', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_image_status'), ['status'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('image', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_image_status'))
+
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_user_updated_at'))
+        batch_op.drop_column('updated_at')
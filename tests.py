@@ -1,14 +1,51 @@
+from concurrent.futures import Future
 from datetime import datetime, timezone, timedelta
+from time import time, sleep
+import http.server
+import io
+import json
+import os
+import queue
+import random
+import socketserver
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
 import unittest
-from app import create_app, db
-from app.models import User, Post
+import unittest.mock
+from app import create_app, db, last_seen, pubsub, tasks, timeline, translator, \
+    language_detector, mailer, post_search, fragment_cache, metrics, avatar_cache, identity_cache
+from app.avatars import gravatar_digest
+from app.email import send_email
+from app.translate import _text_hash
+from app.models import User, Post, Board, Image, Avatar, Notification, Blob, TimelineEntry, \
+    Translation, Message, followers, DEFAULT_BOARDS
+from app.pagination import keyset_paginate
+from app.engine_profile import EngineProfile
+from flask import Flask, g
+from upload import sniff_image
 from config import Config
+import sqlalchemy as sa
+import flask_babel
+import PIL.Image
 
 
 class TestConfig(Config):
     TESTING = True
     # directs SQLAlchemy to use an in-memory SQLite database during the tests:
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    SECRET_KEY = 'test'
+    WTF_CSRF_ENABLED = False
+    LAST_SEEN_BACKGROUND_FLUSH = False
+    TASK_BACKEND = 'sync'
+
+# what `flask init-db` does, create_app() leaves the database alone
+def create_schema():
+    db.create_all()
+    Board.seed_defaults()
+    db.session.commit()
 
 class UserModelCase(unittest.TestCase):
     # The special method that the unit testing framework executes before each test
@@ -17,7 +54,7 @@ class UserModelCase(unittest.TestCase):
         self.app = create_app(TestConfig)
         self.app_context = self.app.app_context()
         self.app_context.push()
-        db.create_all() # creates all the database tables
+        create_schema() # creates all the database tables and the default boards
 
     # The special method that the unit executes after each test
     def tearDown(self):
@@ -64,6 +101,56 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(u1.following_count(), 0)
         self.assertEqual(u2.followers_count(), 0)
 
+    def test_follow_counters_stay_consistent(self):
+        users = [User(username='user{}'.format(i), email='user{}@example.com'.format(i)) for i in range(6)]
+        db.session.add_all(users)
+        db.session.commit()
+        rng = random.Random(42)
+        for _ in range(200):
+            a, b = rng.sample(users, 2)
+            if rng.random() < 0.6:
+                a.follow(b)
+            else:
+                a.unfollow(b)
+            db.session.commit()
+        for u in users:
+            self.assertEqual(u.followers_count(), len(db.session.scalars(u.followers.select()).all()))
+            self.assertEqual(u.following_count(), len(db.session.scalars(u.following.select()).all()))
+        self.assertEqual(User.reconcile_follow_counters(), 0)
+
+    def test_reconcile_follow_counters(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        u1.follow(u2)
+        db.session.commit()
+        # drift the counters behind the model's back
+        db.session.execute(sa.update(User).values(followers_total=7, following_total=0))
+        db.session.commit()
+        result = self.app.test_cli_runner().invoke(args=['counters', 'reconcile'])
+        self.assertIn('2 users had drifted', result.output)
+        db.session.expire_all()
+        self.assertEqual((u1.followers_count(), u1.following_count()), (0, 1))
+        self.assertEqual((u2.followers_count(), u2.following_count()), (1, 0))
+
+    def test_reconcile_unread_counters(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com',
+                  last_message_read_time=datetime.now(timezone.utc) - timedelta(minutes=1))
+        db.session.add_all([u1, u2])
+        db.session.flush()
+        db.session.add_all([Message(author=u1, recipient=u2, body='old',
+                                    timestamp=datetime.now(timezone.utc) - timedelta(minutes=2)),
+                            Message(author=u1, recipient=u2, body='new'),
+                            Message(author=u2, recipient=u1, body='hi')])
+        db.session.execute(sa.update(User).values(unread_messages=5))
+        db.session.commit()
+        result = self.app.test_cli_runner().invoke(args=['counters', 'reconcile'])
+        self.assertIn('2 users had drifted unread message counters', result.output)
+        db.session.expire_all()
+        self.assertEqual((u1.unread_message_count(), u2.unread_message_count()), (1, 1))
+
     def test_follow_posts(self):
         # create four users
         u1 = User(username='john', email='john@example.com')
@@ -73,14 +160,15 @@ class UserModelCase(unittest.TestCase):
         db.session.add_all([u1, u2, u3, u4])
 
         # create four posts
+        board = db.session.scalar(sa.select(Board).where(Board.name == 'Casual'))
         now = datetime.now(timezone.utc)
-        p1 = Post(body="post from john", author=u1,
+        p1 = Post(body="post from john", author=u1, board=board,
                   timestamp=now + timedelta(seconds=1))
-        p2 = Post(body="post from susan", author=u2,
+        p2 = Post(body="post from susan", author=u2, board=board,
                   timestamp=now + timedelta(seconds=4))
-        p3 = Post(body="post from mary", author=u3,
+        p3 = Post(body="post from mary", author=u3, board=board,
                   timestamp=now + timedelta(seconds=3))
-        p4 = Post(body="post from david", author=u4,
+        p4 = Post(body="post from david", author=u4, board=board,
                   timestamp=now + timedelta(seconds=2))
         db.session.add_all([p1, p2, p3, p4])
         db.session.commit()
@@ -102,5 +190,1612 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f3, [p3, p4])
         self.assertEqual(f4, [p4])
 
-    if __name__ == '__main__':
-        unittest.main(verbosity=2)
+
+class UnreadMessagesCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        # a file, so that the concurrent senders each have their own connection
+        self.app = create_app(type('FileDatabaseConfig', (TestConfig,), {
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(self.tmp.name, 'test.db')}))
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        create_schema()
+        self.users = [User(username=name, email='{}@example.com'.format(name)) for name in ('john', 'susan')]
+        db.session.add_all(self.users)
+        db.session.commit()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        db.engine.dispose()
+        self.app_context.pop()
+        self.tmp.cleanup()
+
+    def login(self, user):
+        with self.client.session_transaction() as session:
+            session['_user_id'] = str(user.id)
+        g.pop('_login_user', None) # the requests share the test's app context
+
+    def notification(self, user):
+        return db.session.scalar(user.notifications.select().where(Notification.name == 'unread_message_count'))
+
+    def test_send_and_read(self):
+        john, susan = self.users
+        self.login(john)
+        for body in ('one', 'two'):
+            self.client.post('/send_message/susan', data={'message': body})
+        db.session.expire_all()
+        self.assertEqual(susan.unread_message_count(), 2)
+        self.assertEqual(self.notification(susan).get_data(), 2)
+        self.login(susan)
+        with QueryCounter() as counter:
+            self.client.get('/user/john')
+        self.assertFalse([s for s in counter.statements if 'FROM message' in s])
+        self.client.get('/messages')
+        db.session.expire_all()
+        self.assertEqual(susan.unread_message_count(), 0)
+        self.assertEqual(self.notification(susan).get_data(), 0)
+
+    def test_concurrent_sends(self):
+        john, susan = self.users
+        senders, messages = 8, 10
+
+        def send():
+            with self.app.app_context():
+                for i in range(messages):
+                    db.session.add(Message(sender_id=john.id, recipient_id=susan.id, body=str(i)))
+                    db.session.get(User, susan.id).add_unread_message()
+                    db.session.commit()
+                db.session.remove()
+        threads = [threading.Thread(target=send) for _ in range(senders)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        db.session.expire_all()
+        self.assertEqual(susan.unread_message_count(), senders * messages)
+        self.assertEqual(User.reconcile_unread_counters(), 0)
+
+
+class ThreadCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        create_schema()
+        self.user = User(username='john', email='john@example.com')
+        self.board = db.session.scalar(sa.select(Board).where(Board.name == 'Casual'))
+        db.session.add(self.user)
+        db.session.commit()
+        self.start = datetime.now(timezone.utc)
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def post(self, body, parent=None):
+        post = Post(body=body, author=self.user, board=self.board, parent_post=parent.id if parent else None,
+                    timestamp=self.start + timedelta(seconds=len(body) + 10 * Post.query.count()))
+        db.session.add(post)
+        db.session.commit()
+        return post
+
+    def test_reply_counts(self):
+        root = self.post('root')
+        a = self.post('a', root)
+        self.post('b', root)
+        a1 = self.post('a1', a)
+        self.assertEqual((root.reply_count, a.reply_count), (2, 1))
+        db.session.delete(a1)
+        db.session.commit()
+        self.assertEqual(a.reply_count, 0)
+        db.session.execute(sa.update(Post).values(reply_count=9))
+        db.session.commit()
+        result = self.app.test_cli_runner().invoke(args=['counters', 'reconcile'])
+        self.assertIn('3 posts had drifted reply counts', result.output)
+        db.session.expire_all()
+        self.assertEqual(db.session.scalars(sa.select(Post.reply_count).order_by(Post.id)).all(), [2, 0, 0])
+
+    def test_thread(self):
+        root = self.post('root')
+        a = self.post('a', root)
+        b = self.post('b', root)
+        a1 = self.post('a1', a)
+        a1x = self.post('a1x', a1)
+        a2 = self.post('a2', a)
+        self.post('other')
+        a_id = a.id
+        with StatementRecorder() as recorder:
+            thread = Post.thread(a_id)
+        self.assertEqual(len(recorder.statements), 1)
+        self.assertEqual(thread, [(root, -1), (a, 0), (a1, 1), (a1x, 2), (a2, 1)])
+        self.assertEqual(Post.thread(a.id, depth=1), [(root, -1), (a, 0), (a1, 1), (a2, 1)])
+        self.assertEqual(Post.thread(root.id, limit=3), [(root, 0), (a, 1), (b, 1)])
+        self.assertEqual(Post.thread(a1x.id, depth=2), [(a, -2), (a1, -1), (a1x, 0)])
+        self.assertEqual(Post.thread(12345), [])
+        statement, parameters = recorder.statements[0]
+        plan = [row[-1] for row in db.session.connection().exec_driver_sql(
+            'EXPLAIN QUERY PLAN ' + statement, parameters).all()]
+        self.assertTrue(any('ix_post_parent_post' in step for step in plan), plan)
+
+    def test_thread_page(self):
+        root = self.post('root')
+        reply = self.post('a reply', root)
+        response = self.client.get('/thread/{}'.format(reply.id))
+        self.assertEqual(response.status_code, 200)
+        html = response.get_data(as_text=True)
+        self.assertLess(html.index('id="post{}"'.format(root.id)), html.index('id="post{}"'.format(reply.id)))
+        self.assertIn('1 reply', self.client.get('/board/Casual').get_data(as_text=True))
+        self.assertEqual(self.client.get('/thread/12345').status_code, 404)
+
+
+class TimelineCase(unittest.TestCase):
+    config_class = TestConfig
+
+    def setUp(self):
+        self.app = create_app(self.config_class)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        create_schema()
+        self.board = db.session.scalar(sa.select(Board).where(Board.name == 'Casual'))
+        self.start = datetime.now(timezone.utc)
+        self.users = [User(username=name, email='{}@example.com'.format(name))
+                      for name in ('john', 'susan', 'mary', 'david')]
+        db.session.add_all(self.users)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def publish(self, author, seconds):
+        post = Post(body='post from {}'.format(author.username), author=author, board=self.board,
+                    timestamp=self.start + timedelta(seconds=seconds))
+        db.session.add(post)
+        db.session.commit()
+        return post
+
+    def home(self, user):
+        return db.session.scalars(user.following_posts()).all()
+
+    def test_posts_fan_out_to_followers(self):
+        john, susan, mary, david = self.users
+        john.follow(susan)
+        mary.follow(susan)
+        db.session.commit()
+        self.assertEqual(self.home(john), [])
+        p1 = self.publish(susan, 1)
+        p2 = self.publish(john, 2)
+        p3 = self.publish(david, 3)
+        self.assertEqual(self.home(john), [p2, p1])
+        self.assertEqual(self.home(mary), [p1])
+        self.assertEqual(self.home(david), [p3])
+
+    def test_unfollow_removes_posts(self):
+        john, susan, mary, david = self.users
+        p1 = self.publish(susan, 1)
+        john.follow(susan)
+        db.session.commit()
+        self.assertEqual(self.home(john), [p1])
+        john.unfollow(susan)
+        db.session.commit()
+        self.assertEqual(self.home(john), [])
+
+    def test_rolled_back_post_stays_out(self):
+        john, susan, mary, david = self.users
+        john.follow(susan)
+        db.session.commit()
+        db.session.add(Post(body='draft', author=susan, board=self.board))
+        db.session.flush()
+        db.session.rollback()
+        self.assertEqual(self.home(john), [])
+
+    def test_deleted_post_leaves_timelines(self):
+        john, susan, mary, david = self.users
+        john.follow(susan)
+        db.session.commit()
+        post = self.publish(susan, 1)
+        db.session.delete(post)
+        db.session.commit()
+        self.assertEqual(self.home(john), [])
+        # SQLite hands the freed id to the next post, which must not show up in john's timeline
+        self.publish(david, 2)
+        self.assertEqual(self.home(john), [])
+
+    def test_delete_with_foreign_keys_enforced(self):
+        john, susan, mary, david = self.users
+        john.follow(susan)
+        db.session.commit()
+        post = self.publish(susan, 1)
+        db.session.execute(sa.text('PRAGMA foreign_keys = ON')) # outside a transaction, or it is ignored
+        self.assertEqual(db.session.scalar(sa.text('PRAGMA foreign_keys')), 1)
+        db.session.delete(post)
+        db.session.commit()
+        self.assertEqual(self.home(john), [])
+
+    def test_popular_authors_are_read_on_demand(self):
+        self.app.config['TIMELINE_FANOUT_LIMIT'] = 1
+        john, susan, mary, david = self.users
+        john.follow(susan)
+        mary.follow(susan)
+        john.follow(david)
+        db.session.commit()
+        p1 = self.publish(susan, 1)
+        p2 = self.publish(david, 2)
+        self.assertEqual(self.home(john), [p2, p1])
+        self.assertEqual(self.home(mary), [p1])
+        if self.app.config['TIMELINE_BACKEND'] == 'database': # only susan's own entry was written
+            self.assertEqual(db.session.scalar(sa.select(sa.func.count()).select_from(TimelineEntry)
+                                               .where(TimelineEntry.post_id == p1.id)), 1)
+
+    def test_rebuild(self):
+        john, susan, mary, david = self.users
+        john.follow(susan)
+        db.session.commit()
+        p1 = self.publish(susan, 1)
+        p2 = self.publish(john, 2)
+        timeline.rebuild()
+        db.session.commit()
+        self.assertEqual(self.home(john), [p2, p1])
+
+
+class MemoryTimelineConfig(TestConfig):
+    TIMELINE_BACKEND = 'memory'
+
+class MemoryTimelineCase(TimelineCase):
+    config_class = MemoryTimelineConfig
+
+
+# counts the SQL statements sent to the database while the block runs
+class QueryCounter:
+    def __enter__(self):
+        self.statements = []
+        sa.event.listen(db.engine, 'before_cursor_execute', self._count)
+        return self
+
+    def __exit__(self, *args):
+        sa.event.remove(db.engine, 'before_cursor_execute', self._count)
+
+    def _count(self, conn, cursor, statement, *args):
+        self.statements.append(statement)
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def writes(self, table):
+        return [s for s in self.statements if s.startswith('UPDATE {} '.format(table))]
+
+
+class PostListCase(unittest.TestCase):
+    # a board page costs the board lookup, its validator, the page query
+    # and one query each for parents, authors, avatars and images
+    MAX_BOARD_PAGE_QUERIES = 7
+
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        create_schema()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def add_posts(self, n, prefix):
+        board = db.session.scalar(sa.select(Board).where(Board.name == 'Casual'))
+        now = datetime.now(timezone.utc)
+        for i in range(n):
+            u = User(username='{}{}'.format(prefix, i), email='{}{}@example.com'.format(prefix, i))
+            db.session.add(u)
+            db.session.flush()
+            db.session.add(Avatar(user_id=u.id, thumbnail_path='avatars/{}.png'.format(i),
+                                  original_path='avatars/{}_orig.png'.format(i)))
+            parent = Post(body='post {}'.format(i), author=u, board=board,
+                          timestamp=now + timedelta(seconds=2 * i))
+            db.session.add(parent)
+            db.session.flush()
+            reply = Post(body='reply {}'.format(i), author=u, board=board, parent_post=parent.id,
+                         timestamp=now + timedelta(seconds=2 * i + 1))
+            db.session.add(reply)
+            db.session.flush()
+            db.session.add(Image(post=reply, user_id=u.id, thumbnail_path='uploads/posts/{}_t.png'.format(i),
+                                 original_path='uploads/posts/{}.png'.format(i)))
+        db.session.commit()
+        db.session.remove()
+
+    def board_page_queries(self):
+        with QueryCounter() as counter:
+            response = self.client.get('/board/Casual')
+        self.assertEqual(response.status_code, 200)
+        return counter.count, response.get_data(as_text=True)
+
+    def test_board_page_query_count(self):
+        self.add_posts(1, 'john')
+        small_count, _ = self.board_page_queries()
+        self.add_posts(self.app.config['POSTS_PER_PAGE'], 'susan')
+        full_count, html = self.board_page_queries()
+        self.assertLessEqual(full_count, self.MAX_BOARD_PAGE_QUERIES)
+        self.assertEqual(small_count, full_count)
+        self.assertIn('@ susan', html)
+        self.assertIn('uploads/posts/', html)
+        self.assertIn('/avatar/', html)
+
+    def test_messages_page(self):
+        self.add_posts(1, 'john')
+        john = db.session.scalar(sa.select(User).where(User.username == 'john0'))
+        with self.client.session_transaction() as session:
+            session['_user_id'] = str(john.id)
+        self.client.post('/send_message/john0', data={'message': 'note to self'})
+        response = self.client.get('/messages')
+        self.assertEqual(response.status_code, 200)
+        # messages have no board, Reply answers with another message
+        self.assertIn('/send_message/john0', response.get_data(as_text=True))
+
+    def test_rendered_posts_are_cached(self):
+        self.add_posts(2, 'john')
+        _, first = self.board_page_queries()
+        self.assertEqual(fragment_cache.stats()['misses'], 4)
+        _, second = self.board_page_queries()
+        self.assertEqual(second, first)
+        self.assertEqual(fragment_cache.stats()['hits'], 4)
+        # a new avatar changes the key of every post of its owner
+        john = db.session.scalar(sa.select(User).where(User.username == 'john0'))
+        db.session.delete(db.session.scalar(sa.select(Avatar).where(Avatar.user_id == john.id)))
+        new = Avatar(user_id=john.id, original_path='avatars/new.png')
+        db.session.add(new)
+        db.session.commit()
+        _, third = self.board_page_queries()
+        self.assertTrue('/avatar/{}/128?v={}'.format(john.id, new.id) in third)
+        self.assertEqual(fragment_cache.stats()['misses'], 6)
+        # so does another language (Flask-Babel keeps the locale on the test's app context)
+        flask_babel.refresh()
+        self.client.get('/board/Casual', headers={'Accept-Language': 'ru'})
+        self.assertEqual(fragment_cache.stats()['misses'], 10)
+
+    def test_conditional_get(self):
+        self.add_posts(1, 'john')
+        response = self.client.get('/board/Casual')
+        etag = response.headers['ETag']
+        self.assertIn('no-cache', response.headers['Cache-Control'])
+        with QueryCounter() as counter:
+            response = self.client.get('/board/Casual', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.get_data(), b'')
+        self.assertEqual(counter.count, 2) # the board and the validator
+        # another page, another locale or a new post is a different version
+        self.assertEqual(self.client.get('/board/Movies', headers={'If-None-Match': etag}).status_code, 200)
+        self.assertEqual(self.client.get('/board/Casual', headers={'If-None-Match': etag,
+                                                                   'Accept-Language': 'ru'}).status_code, 200)
+        self.add_posts(1, 'susan')
+        self.assertEqual(self.client.get('/board/Casual', headers={'If-None-Match': etag}).status_code, 200)
+
+    def test_validator_follows_changes_around_posts(self):
+        self.add_posts(1, 'john')
+        john = db.session.scalar(sa.select(User).where(User.username == 'john0'))
+        with self.client.session_transaction() as session:
+            session['_user_id'] = str(john.id)
+
+        def get(url, etag=None):
+            g.pop('_login_user', None) # the requests share the test's app context
+            return self.client.get(url, headers={'If-None-Match': etag} if etag else {})
+
+        def etag(url):
+            etag = get(url).headers['ETag']
+            self.assertEqual(get(url, etag).status_code, 304)
+            return etag
+        # the background worker finishes an image
+        board_etag = etag('/board/Casual')
+        db.session.scalar(sa.select(Image)).status = 'ready'
+        db.session.commit()
+        self.assertEqual(get('/board/Casual', board_etag).status_code, 200)
+        # the author renames
+        board_etag = etag('/board/Casual')
+        self.client.post('/edit_profile', data={'username': 'johnny', 'about_me': ''})
+        get('/edit_profile') # shows the flashed message
+        self.assertEqual(get('/board/Casual', board_etag).status_code, 200)
+        # a reply on another board changes the count under the post on the profile page
+        user_etag = etag('/user/johnny')
+        post = db.session.scalar(sa.select(Post).where(Post.user_id == john.id, Post.parent_post.is_(None)))
+        movies = db.session.scalar(sa.select(Board).where(Board.name == 'Movies'))
+        db.session.add(Post(body='reply', author=User(username='mary', email='mary@example.com'), board=movies,
+                            parent_post=post.id))
+        db.session.commit()
+        self.assertEqual(get('/user/johnny', user_etag).status_code, 200)
+
+    def test_uploads_are_immutable(self):
+        static_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(static_dir.cleanup)
+        self.app.static_folder = static_dir.name
+        for folder in ('uploads', 'avatars'):
+            os.makedirs(os.path.join(static_dir.name, folder))
+            with open(os.path.join(static_dir.name, folder, 'a.png'), 'wb') as f:
+                f.write(b'png')
+            response = self.client.get('/static/{}/a.png'.format(folder))
+            self.assertIn('immutable', response.headers['Cache-Control'])
+            self.assertIn('max-age=31536000', response.headers['Cache-Control'])
+            response.close()
+        with open(os.path.join(static_dir.name, 'style.css'), 'w') as f:
+            f.write('body {}')
+        response = self.client.get('/static/style.css')
+        self.assertNotIn('immutable', response.headers.get('Cache-Control', ''))
+        response.close()
+
+
+class StatementRecorder:
+    def __enter__(self):
+        self.statements = []
+        sa.event.listen(db.engine, 'before_cursor_execute', self._record)
+        return self
+
+    def __exit__(self, *args):
+        sa.event.remove(db.engine, 'before_cursor_execute', self._record)
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith(('SELECT', 'WITH', 'DELETE', 'UPDATE', 'INSERT')):
+            self.statements.append((statement, parameters))
+
+
+# runs EXPLAIN QUERY PLAN on the statements the hot pages send and fails when one reads a
+# whole table or sorts rows in a temporary b-tree instead of walking an index in order
+class QueryPlanCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        create_schema()
+        board = db.session.scalar(sa.select(Board).where(Board.name == 'Casual'))
+        self.users = [User(username='user{}'.format(i), email='user{}@example.com'.format(i)) for i in range(20)]
+        db.session.add_all(self.users)
+        db.session.flush()
+        for i, u in enumerate(self.users):
+            db.session.add(Avatar(user_id=u.id, original_path='avatars/{}.png'.format(i)))
+            db.session.add_all([Post(body='post', author=u, board=board) for _ in range(5)])
+            db.session.add(Message(author=u, recipient=self.users[0], body='hi'))
+            self.users[0].follow(u)
+            u.follow(self.users[1])
+        db.session.commit()
+        db.session.execute(sa.text('ANALYZE'))
+        self.client = self.app.test_client()
+        with self.client.session_transaction() as session:
+            session['_user_id'] = str(self.users[0].id)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def plans(self, *urls, method='get', data=None):
+        with StatementRecorder() as recorder:
+            for url in urls:
+                response = getattr(self.client, method)(url, data=data)
+                self.assertLess(response.status_code, 400, url)
+        plans = []
+        with db.engine.connect() as connection:
+            for statement, parameters in recorder.statements:
+                rows = connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters).all()
+                plans.append((statement, [row[-1] for row in rows]))
+        return plans
+
+    def assertIndexed(self, plans, table):
+        checked = [(statement, plan) for statement, plan in plans if ' {} '.format(table) in statement + ' ']
+        self.assertTrue(checked, 'no statement on {}'.format(table))
+        for statement, plan in checked:
+            for step in plan:
+                self.assertFalse(step.startswith('SCAN ') and ' USING ' not in step and step != 'SCAN CONSTANT ROW',
+                                 'table scan in {}\n{}'.format(statement, '\n'.join(plan)))
+                self.assertNotIn('TEMP B-TREE', step, 'sort in {}\n{}'.format(statement, '\n'.join(plan)))
+
+    def test_board_page(self):
+        plans = self.plans('/board/Casual', '/board/Casual?after=2100-01-01T00:00:00_1',
+                           '/board/Casual?before=2000-01-01T00:00:00_1')
+        self.assertIndexed(plans, 'post')
+        self.assertIndexed(plans, 'avatar')
+        self.assertIndexed(plans, 'image')
+        self.assertTrue(any('ix_post_board_id_timestamp_id' in step for _, plan in plans for step in plan))
+
+    def test_index_page(self):
+        self.assertIndexed(self.plans('/index', '/index?after=2100-01-01T00:00:00_1'), 'post')
+
+    def test_user_page(self):
+        plans = self.plans('/user/user3', '/user/user3?after=2100-01-01T00:00:00_1')
+        self.assertIndexed(plans, 'post')
+        self.assertTrue(any('ix_post_user_id_timestamp' in step for _, plan in plans for step in plan))
+
+    def test_messages(self):
+        plans = self.plans('/messages', '/messages?after=2100-01-01T00:00:00_1')
+        self.assertIndexed(plans, 'message')
+        self.assertIndexed(plans, 'notification')
+        self.assertTrue(any('ix_message_recipient_id_timestamp' in step for _, plan in plans for step in plan))
+
+    def test_publish(self):
+        # the new post is copied to the home timelines of the author's followers
+        with self.client.session_transaction() as session:
+            session['_user_id'] = str(self.users[1].id)
+        plans = self.plans('/board/Casual', method='post', data={'post': 'hello'})
+        self.assertIndexed(plans, 'followers')
+        self.assertTrue(any('ix_followers_followed_id_follower_id' in step for _, plan in plans for step in plan))
+
+
+class KeysetPaginationCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        create_schema()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_walk_pages(self):
+        u = User(username='john', email='john@example.com')
+        board = db.session.scalar(sa.select(Board).where(Board.name == 'Casual'))
+        now = datetime.now(timezone.utc)
+        # two posts share a timestamp so the id has to break the tie
+        posts = [Post(body='post {}'.format(i), author=u, board=board,
+                      timestamp=now + timedelta(seconds=min(i, 5))) for i in range(7)]
+        db.session.add_all(posts)
+        db.session.commit()
+        expected = sorted(posts, key=lambda p: (p.timestamp, p.id), reverse=True)
+
+        query = sa.select(Post).where(Post.board_id == board.id)
+        with QueryCounter() as counter:
+            page1 = keyset_paginate(query, Post, 3)
+        self.assertEqual(counter.count, 1)
+        self.assertEqual(page1.items, expected[:3])
+        self.assertTrue(page1.has_next)
+        self.assertFalse(page1.has_prev)
+
+        page2 = keyset_paginate(query, Post, 3, after=page1.next_cursor)
+        self.assertEqual(page2.items, expected[3:6])
+        page3 = keyset_paginate(query, Post, 3, after=page2.next_cursor)
+        self.assertEqual(page3.items, expected[6:])
+        self.assertFalse(page3.has_next)
+        self.assertTrue(page3.has_prev)
+
+        back = keyset_paginate(query, Post, 3, before=page3.prev_cursor)
+        self.assertEqual(back.items, page2.items)
+        back = keyset_paginate(query, Post, 3, before=back.prev_cursor)
+        self.assertEqual(back.items, page1.items)
+        self.assertFalse(back.has_prev)
+
+        # a malformed cursor falls back to the first page
+        self.assertEqual(keyset_paginate(query, Post, 3, after='garbage').items, page1.items)
+
+
+class LastSeenCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        create_schema()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_requests_are_coalesced(self):
+        u = User(username='john', email='john@example.com',
+                 last_seen=datetime(2000, 1, 1))
+        db.session.add(u)
+        db.session.commit()
+        with self.client.session_transaction() as session:
+            session['_user_id'] = str(u.id)
+
+        with QueryCounter() as counter:
+            for _ in range(20):
+                self.client.get('/notifications')
+            self.assertEqual(last_seen.flush(), 1)
+            for _ in range(20):
+                self.client.get('/notifications')
+            # still inside the interval, nothing new to write
+            self.assertEqual(last_seen.flush(), 0)
+        self.assertEqual(len(counter.writes('user')), 1)
+        db.session.expire_all()
+        self.assertGreater(db.session.get(User, u.id).last_seen, datetime(2000, 1, 1))
+
+    def test_throttle_per_user(self):
+        self.app.config['LAST_SEEN_INTERVAL'] = 0
+        self.assertTrue(last_seen.record(1))
+        self.assertTrue(last_seen.record(1))
+        self.app.config['LAST_SEEN_INTERVAL'] = 60
+        self.assertFalse(last_seen.record(1))
+        self.assertTrue(last_seen.record(2))
+        last_seen.init_app(self.app) # drops what is pending for users that do not exist
+
+
+class NotificationStreamCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.config['NOTIFICATION_STREAM_TIMEOUT'] = 0.5
+        self.app.config['NOTIFICATION_STREAM_KEEPALIVE'] = 0.1
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        create_schema()
+        self.client = self.app.test_client()
+        self.user = User(username='john', email='john@example.com')
+        db.session.add(self.user)
+        db.session.commit()
+        self.user_id = self.user.id
+        with self.client.session_transaction() as session:
+            session['_user_id'] = str(self.user_id)
+
+    def tearDown(self):
+        last_seen.flush()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_add_notification_publishes_on_commit(self):
+        messages = pubsub.subscribe(self.user_id)
+        try:
+            self.user.add_notification('unread_message_count', 3)
+            self.assertTrue(messages.empty())
+            db.session.commit()
+            message = messages.get_nowait()
+            self.assertEqual(message['name'], 'unread_message_count')
+            self.assertEqual(message['data'], 3)
+
+            self.user.add_notification('unread_message_count', 4)
+            db.session.rollback()
+            self.assertTrue(messages.empty())
+        finally:
+            pubsub.unsubscribe(self.user_id, messages)
+
+    def test_stream_resumes_and_pushes(self):
+        self.user.add_notification('unread_message_count', 1)
+        db.session.commit()
+        since = db.session.scalar(sa.select(Notification.timestamp))
+        self.user.add_notification('task_progress', {'task_id': 1, 'progress': 50})
+        db.session.commit()
+
+        response = self.client.get('/notifications/stream?since={}'.format(since), buffered=False)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        pushed = {'name': 'unread_message_count', 'data': 7, 'timestamp': time() + 1}
+        threading.Timer(0.2, pubsub.publish, (self.user_id, pushed)).start()
+        # the stream itself does not query the database while it waits
+        with QueryCounter() as counter:
+            body = b''.join(response.response).decode()
+        response.close()
+        self.assertEqual(counter.count, 0)
+        events = [json.loads(line[len('data: '):]) for line in body.splitlines()
+                  if line.startswith('data: ')]
+        self.assertEqual([e['name'] for e in events], ['task_progress', 'unread_message_count'])
+        self.assertEqual(events[1]['data'], 7)
+        self.assertIn(': keepalive', body)
+        self.assertEqual(pubsub.subscriber_count(self.user_id), 0)
+
+    def test_poll_fallback(self):
+        self.user.add_notification('unread_message_count', 2)
+        db.session.commit()
+        notifications = self.client.get('/notifications?since=0').get_json()
+        self.assertEqual([(n['name'], n['data']) for n in notifications], [('unread_message_count', 2)])
+
+
+class ImageProcessingCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.config['TASK_BACKEND'] = 'thread'
+        # uploads go to a scratch static folder instead of app/static
+        self.static_dir = tempfile.TemporaryDirectory()
+        self.app.static_folder = self.static_dir.name
+        self.blob_dir = os.path.join(self.static_dir.name, 'uploads', 'blobs')
+        self.app.config['BLOB_UPLOAD_PATH'] = self.blob_dir
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        create_schema()
+        self.client = self.app.test_client()
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        with self.client.session_transaction() as session:
+            session['_user_id'] = str(u.id)
+
+    def tearDown(self):
+        tasks.join()
+        last_seen.flush()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.static_dir.cleanup()
+
+    def png(self, size=(400, 300)):
+        data = io.BytesIO()
+        exif = PIL.Image.Exif()
+        exif[0x010f] = 'PhoneMaker' # camera make, must not survive processing
+        PIL.Image.new('RGB', size, 'orange').save(data, 'PNG', exif=exif)
+        data.seek(0)
+        return data
+
+    def test_upload_is_processed_in_background(self):
+        response = self.client.post('/board/Casual', data={
+            'post': 'look', 'image': [(self.png(), 'a.png'), (self.png(), 'b.png')]})
+        self.assertEqual(response.status_code, 302)
+        tasks.join()
+        db.session.expire_all()
+        images = db.session.scalars(sa.select(Image)).all()
+        self.assertEqual(len(images), 2)
+        for image in images:
+            self.assertEqual(image.status, 'ready')
+            self.assertEqual(image.thumbnail(), image.thumbnail_path)
+            # 1080 would upscale the 400px original, so it stops at 480 capped to the original size
+            variants = image.get_variants()
+            self.assertEqual([(v['name'], v['width'], v['height']) for v in variants],
+                             [('thumbnail', 150, 113), ('medium', 400, 300)])
+            self.assertEqual(image.thumbnail_path, variants[0]['path'])
+            for variant in variants:
+                with PIL.Image.open(os.path.join(self.static_dir.name, variant['path'])) as file:
+                    self.assertEqual(file.format, 'WEBP')
+                    self.assertEqual(file.size, (variant['width'], variant['height']))
+                    self.assertNotIn('exif', file.info)
+            with self.app.test_request_context():
+                self.assertIn('_medium.webp 400w', image.srcset())
+
+        html = self.client.get('/board/Casual').get_data(as_text=True)
+        self.assertIn('srcset="', html)
+
+    def test_pending_image_falls_back_to_original(self):
+        image = Image(original_path='uploads/blobs/a.png')
+        self.assertEqual(image.thumbnail(), 'uploads/blobs/a.png')
+        image.thumbnail_path, image.status = 'uploads/blobs/a_thumbnail.png', 'ready'
+        self.assertEqual(image.thumbnail(), 'uploads/blobs/a_thumbnail.png')
+
+    def test_broken_upload_is_marked_failed(self):
+        # a valid header followed by garbage gets past the upload checks and fails in the worker
+        data = self.png().getvalue()[:40] + b'garbage'
+        response = self.client.post('/board/Casual', data={
+            'post': 'look', 'image': [(io.BytesIO(data), 'a.png')]})
+        self.assertEqual(response.status_code, 302)
+        tasks.join()
+        db.session.expire_all()
+        image = db.session.scalar(sa.select(Image))
+        self.assertEqual(image.status, 'failed')
+        self.assertEqual(image.thumbnail(), image.original_path)
+
+    def test_rejected_uploads(self):
+        self.app.config['MAX_IMAGE_PIXELS'] = 100 * 100
+        for data in (b'not an image', self.png((101, 100)).getvalue()):
+            response = self.client.post('/board/Casual', data={
+                'post': 'look', 'image': [(io.BytesIO(data), 'a.png')]}, follow_redirects=True)
+            self.assertIn('a.png is not a supported image', response.get_data(as_text=True))
+        self.assertEqual(db.session.scalar(sa.select(sa.func.count(Image.id))), 0)
+        self.assertFalse(os.path.exists(self.blob_dir) and os.listdir(self.blob_dir))
+
+    def test_jpeg_with_large_metadata(self):
+        # the size is past the first chunk and is read from the saved file instead
+        jpeg = io.BytesIO()
+        PIL.Image.new('RGB', (400, 300), 'orange').save(jpeg, 'JPEG')
+        comment = b'\xff\xfe' + struct.pack('>H', 40002) + b'x' * 40000
+        data = io.BytesIO(jpeg.getvalue()[:2] + comment * 2 + jpeg.getvalue()[2:])
+        self.assertGreater(data.getvalue().index(b'\xff\xc0'), 64 * 1024)
+        data.seek(0)
+        self.app.config['TASK_BACKEND'] = 'sync'
+        self.client.post('/board/Casual', data={'post': 'look', 'image': [(data, 'a.jpg')]})
+        image = db.session.scalar(sa.select(Image))
+        self.assertEqual(image.status, 'ready')
+        self.assertTrue(image.original_path.endswith('.jpg'))
+
+    def test_duplicate_uploads_share_a_blob(self):
+        self.client.post('/board/Casual', data={'post': 'one', 'image': [(self.png(), 'a.png')]})
+        tasks.join()
+        files = sorted(os.listdir(self.blob_dir))
+        self.assertEqual(len(files), 3) # the original and two variants
+
+        # the same bytes again, as a reply and as an avatar: nothing is written or processed
+        self.app.config['TASK_BACKEND'] = 'sync'
+        with unittest.mock.patch('app.images.save_image_variants') as save_variants:
+            self.client.post('/board/Casual', data={'post': 'two', 'image': [(self.png(), 'b.png')]})
+            self.client.post('/avatar_upload', data={'avatar': (self.png(), 'me.png')})
+        save_variants.assert_not_called()
+        self.assertEqual(sorted(os.listdir(self.blob_dir)), files)
+        db.session.expire_all()
+        blob = db.session.scalar(sa.select(Blob))
+        self.assertEqual(blob.ref_count, 3)
+        self.assertEqual(db.session.scalar(sa.select(sa.func.count(Blob.id))), 1)
+        for row in db.session.scalars(sa.select(Image)).all() + db.session.scalars(sa.select(Avatar)).all():
+            self.assertEqual(row.blob_id, blob.id)
+            self.assertEqual(row.status, 'ready')
+            self.assertEqual(row.thumbnail_path, blob.thumbnail_path)
+
+        # replacing the avatar drops its reference, the files stay for the posts
+        self.client.post('/avatar_upload', data={'avatar': (self.png((200, 200)), 'me.png')})
+        db.session.expire_all()
+        self.assertEqual(db.session.get(Blob, blob.id).ref_count, 2)
+        self.assertTrue(set(files) < set(os.listdir(self.blob_dir)))
+
+    def test_requeue_pending_blobs(self):
+        # the worker never ran: the process was restarted right after the upload
+        with unittest.mock.patch.object(tasks, 'enqueue'):
+            self.client.post('/board/Casual', data={'post': 'one', 'image': [(self.png(), 'a.png')]})
+            self.client.post('/avatar_upload', data={'avatar': (self.png((200, 200)), 'me.png')})
+        # processed, but the rows using it were not updated before the crash
+        self.app.config['TASK_BACKEND'] = 'sync'
+        self.client.post('/board/Casual', data={'post': 'two', 'image': [(self.png((300, 300)), 'b.png')]})
+        db.session.execute(sa.update(Image).where(Image.original_path.endswith('.png'))
+                           .values(status='pending', thumbnail_path=None))
+        db.session.commit()
+        self.assertEqual(db.session.scalar(sa.select(sa.func.count(Blob.id)).where(Blob.status == 'pending')), 2)
+
+        result = self.app.test_cli_runner().invoke(args=['images', 'requeue'])
+        self.assertIn('3 uploads queued', result.output)
+        db.session.expire_all()
+        for row in db.session.scalars(sa.select(Image)).all() + db.session.scalars(sa.select(Avatar)).all():
+            self.assertEqual(row.status, 'ready')
+            self.assertIsNotNone(row.thumbnail_path)
+        result = self.app.test_cli_runner().invoke(args=['images', 'requeue'])
+        self.assertIn('0 uploads queued', result.output)
+
+    def test_last_reference_deletes_files(self):
+        self.app.config['TASK_BACKEND'] = 'sync'
+        self.client.post('/avatar_upload', data={'avatar': (self.png(), 'me.png')})
+        first = set(os.listdir(self.blob_dir))
+        self.client.post('/avatar_upload', data={'avatar': (self.png((200, 200)), 'me.png')})
+        self.assertFalse(first & set(os.listdir(self.blob_dir)))
+        self.assertEqual(db.session.scalar(sa.select(sa.func.count(Blob.id))), 1)
+
+
+class AvatarCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.static_dir = tempfile.TemporaryDirectory()
+        self.app.static_folder = self.static_dir.name
+        self.app.config['AVATAR_CACHE_PATH'] = os.path.join(self.static_dir.name, 'cache')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        create_schema()
+        self.client = self.app.test_client()
+        self.user = User(username='john', email='john@example.com')
+        db.session.add(self.user)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.static_dir.cleanup()
+
+    def add_avatar(self, user, size=(600, 400)):
+        os.makedirs(os.path.join(self.static_dir.name, 'avatars'), exist_ok=True)
+        path = 'avatars/{}_{}.png'.format(user.id, size[0])
+        PIL.Image.new('RGB', size, 'orange').save(os.path.join(self.static_dir.name, path), 'PNG')
+        avatar = Avatar(user_id=user.id, original_path=path)
+        db.session.add(avatar)
+        db.session.commit()
+        return avatar
+
+    def avatar_url(self, user, size):
+        with self.app.test_request_context():
+            return user.avatar(size)
+
+    # requests `url` and returns the file it added to the cache
+    def fetch(self, url):
+        before = set(os.listdir(avatar_cache.directory)) if os.path.isdir(avatar_cache.directory) else set()
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        response.close()
+        added = set(os.listdir(avatar_cache.directory)) - before
+        return os.path.join(avatar_cache.directory, added.pop()) if added else None
+
+    def test_resized_on_first_request(self):
+        avatar = self.add_avatar(self.user)
+        url = self.avatar_url(self.user, 120)
+        self.assertEqual(url, '/avatar/{}/128?v={}'.format(self.user.id, avatar.id))
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'image/webp')
+        self.assertTrue(response.cache_control.immutable)
+        image = PIL.Image.open(io.BytesIO(response.get_data()))
+        self.assertEqual((image.format, image.size), ('WEBP', (128, 85)))
+        response.close()
+        # the second time it comes from the cache, the original is not read again
+        os.remove(os.path.join(self.static_dir.name, avatar.original_path))
+        self.assertIsNone(self.fetch(url))
+
+    def test_other_urls_redirect(self):
+        avatar = self.add_avatar(self.user)
+        canonical = '/avatar/{}/128?v={}'.format(self.user.id, avatar.id)
+        for url in ('/avatar/{}/100?v={}'.format(self.user.id, avatar.id),
+                    '/avatar/{}/128'.format(self.user.id),
+                    '/avatar/{}/128?v={}'.format(self.user.id, avatar.id - 1)):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 302)
+            self.assertEqual(response.location, canonical)
+        self.assertEqual(self.client.get('/avatar/{}/128'.format(self.user.id + 1)).status_code, 404)
+
+    def test_no_upload_redirects_to_gravatar(self):
+        response = self.client.get('/avatar/{}/64'.format(self.user.id))
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response.location.startswith('https://www.gravatar.com/avatar/'))
+        gravatar_digest.cache_clear()
+        self.avatar_url(self.user, 32)
+        self.avatar_url(self.user, 64)
+        self.assertEqual(gravatar_digest.cache_info().hits, 1)
+
+    def test_least_recently_read_are_evicted(self):
+        users = [self.user] + [User(username='u{}'.format(i), email='u{}@example.com'.format(i)) for i in range(3)]
+        db.session.add_all(users)
+        db.session.commit()
+        paths = []
+        for i, user in enumerate(users):
+            self.add_avatar(user)
+            paths.append(self.fetch(self.avatar_url(user, 256)))
+            os.utime(paths[-1], (1000 + i, 1000 + i))
+        # reading a file makes it recent again
+        self.assertIsNone(self.fetch(self.avatar_url(users[0], 256)))
+        # room for about two of them: the least recently read go first
+        self.app.config['AVATAR_CACHE_MAX_BYTES'] = int(max(map(os.path.getsize, paths)) * 2.5)
+        small = self.fetch(self.avatar_url(users[3], 32))
+        self.assertFalse(os.path.exists(paths[1]) or os.path.exists(paths[2]))
+        self.assertTrue(os.path.exists(paths[0]) and os.path.exists(small))
+
+class IdentityCacheConfig(TestConfig):
+    IDENTITY_CACHE = True
+
+
+class IdentityCacheCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(IdentityCacheConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        create_schema()
+        self.client = self.app.test_client()
+        users = [User(username=name, email=name + '@example.com') for name in ('john', 'susan')]
+        db.session.add_all(users)
+        db.session.commit()
+        self.john, self.susan = [user.id for user in users]
+        with self.client.session_transaction() as session:
+            session['_user_id'] = str(self.john)
+
+    def tearDown(self):
+        last_seen.flush()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    # a request as it runs in production, with nothing loaded yet
+    def get(self, url, method='GET', **kwargs):
+        g.pop('_login_user', None) # the requests share the test's app context and its session
+        db.session.expunge_all()
+        with StatementRecorder() as recorder:
+            response = self.client.open(url, method=method, **kwargs)
+        self.assertLess(response.status_code, 400)
+        return response, [statement for statement, _ in recorder.statements if statement.startswith('SELECT user.id')]
+
+    def test_no_user_query_once_cached(self):
+        _, loads = self.get('/notifications')
+        self.assertEqual(len(loads), 1)
+        _, loads = self.get('/notifications')
+        self.assertEqual(loads, [])
+        response, loads = self.get('/board/Casual')
+        self.assertEqual(loads, [])
+        self.assertIn('john', response.get_data(as_text=True))
+        self.assertEqual(identity_cache.stats()['hits'], 2)
+
+    def test_disabled(self):
+        self.app.config['IDENTITY_CACHE'] = False
+        self.get('/notifications')
+        _, loads = self.get('/notifications')
+        self.assertEqual(len(loads), 1)
+
+    def test_detached_user_reads(self):
+        self.get('/notifications')
+        self.get('/follow/susan', method='POST')
+        # the cached copy still compares equal to the loaded user and reads its relationships
+        html = self.get('/user/john')[0].get_data(as_text=True)
+        self.assertIn('Edit your profile', html)
+        self.assertNotIn('Unfollow', html)
+        html = self.get('/user/susan')[0].get_data(as_text=True)
+        self.assertIn('Unfollow', html)
+
+    def test_writes_invalidate(self):
+        self.get('/notifications')
+        response, loads = self.get('/edit_profile', method='POST', data={'username': 'johnny', 'about_me': 'hi'})
+        self.assertEqual(len(loads), 1 + 1) # bound for the write, then the form's username check
+        self.assertEqual(db.session.get(User, self.john).username, 'johnny')
+        response, loads = self.get('/index')
+        self.assertEqual(len(loads), 1)
+        self.assertIn('johnny', response.get_data(as_text=True))
+        # a message to a cached user shows up in their unread count
+        with self.client.session_transaction() as session:
+            session['_user_id'] = str(self.susan)
+        self.get('/notifications')
+        self.get('/send_message/susan', method='POST', data={'message': 'hi'})
+        self.assertIsNone(identity_cache._entries.get(self.susan))
+        # as does a new avatar
+        self.get('/notifications')
+        db.session.add(Avatar(user_id=self.susan, original_path='avatars/susan.png'))
+        db.session.commit()
+        self.assertIsNone(identity_cache._entries.get(self.susan))
+
+    def test_password_reset_invalidates(self):
+        self.get('/notifications')
+        user = db.session.get(User, self.john)
+        user.set_password('new')
+        db.session.commit()
+        self.assertIsNone(identity_cache._entries.get(self.john))
+
+    def test_bounded_and_expiring(self):
+        self.app.config['IDENTITY_CACHE_SIZE'] = 1
+        self.assertIsNotNone(identity_cache.load(self.john))
+        self.assertIsNotNone(identity_cache.load(self.susan))
+        self.assertEqual(list(identity_cache._entries), [self.susan])
+        self.app.config['IDENTITY_CACHE_TTL'] = 0
+        identity_cache.load(self.john)
+        user = identity_cache.load(self.john)
+        self.assertTrue(sa.inspect(user).persistent) # loaded again, from the session
+
+
+# a local stand-in for the translator service: upper-cases the texts and records the requests
+class StubTranslator(http.server.ThreadingHTTPServer):
+    def __init__(self, delay=0):
+        super().__init__(('127.0.0.1', 0), StubTranslatorHandler)
+        self.delay = delay
+        self.requests = []
+        self.status = 200
+        self.body = None # sent instead of the translations when set
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/translate'.format(self.server_address[1])
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+class StubTranslatorHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        texts = [item['Text'] for item in json.loads(self.rfile.read(int(self.headers['Content-Length'])))]
+        self.server.requests.append((self.path, texts))
+        sleep(self.server.delay)
+        body = self.server.body or json.dumps([{'translations': [{'text': text.upper(), 'to': 'en'}]}
+                                               for text in texts]).encode()
+        self.send_response(self.server.status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TranslationCase(unittest.TestCase):
+    def setUp(self):
+        self.stub = StubTranslator()
+        self.app = create_app(TestConfig)
+        self.app.config.update(MS_TRANSLATOR_KEY='test', TRANSLATOR_URL=self.stub.url)
+        translator.init_app(self.app)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        create_schema()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.stub.stop()
+
+    def post_translation(self, text):
+        response = self.client.post('/translate', json={'text': text, 'source_language': 'ru',
+                                                        'dest_language': 'en'})
+        return response.get_json()['text']
+
+    def test_cached_in_memory_and_database(self):
+        self.assertEqual(self.post_translation('privet'), 'PRIVET')
+        self.assertEqual(self.post_translation('privet'), 'PRIVET')
+        self.assertEqual(len(self.stub.requests), 1)
+        self.assertIn('from=ru', self.stub.requests[0][0])
+        # a new process only has the table
+        translator.init_app(self.app)
+        self.assertEqual(self.post_translation('privet'), 'PRIVET')
+        self.assertEqual(len(self.stub.requests), 1)
+        self.assertEqual(db.session.scalar(sa.select(sa.func.count()).select_from(Translation)), 1)
+
+    def test_cache_expires(self):
+        self.app.config['TRANSLATION_CACHE_TTL'] = 0
+        self.app.config['TRANSLATION_CACHE_PERSIST'] = False
+        self.post_translation('privet')
+        self.post_translation('privet')
+        self.assertEqual(len(self.stub.requests), 2)
+
+    def test_failures_are_not_cached(self):
+        self.stub.status = 400
+        self.assertIn('failed', self.post_translation('privet'))
+        self.stub.status = 200
+        self.assertEqual(self.post_translation('privet'), 'PRIVET')
+
+    def test_garbage_answers_are_failures(self):
+        for body in (b'<html>Bad gateway</html>', b'{"error": {"code": 1}}', b'[{"translations": []}]',
+                     b'[]', b'[{"translations": [{"text": null}]}]'):
+            self.stub.body = body
+            self.assertIn('failed', self.post_translation('privet'))
+            response = self.client.post('/translate', json={'post_ids': [], 'dest_language': 'en'})
+            self.assertEqual(response.status_code, 200)
+        self.stub.body = None
+        self.assertEqual(self.post_translation('privet'), 'PRIVET')
+
+    def test_concurrent_requests_share_one_call(self):
+        self.stub.delay = 0.2
+        results = []
+        def worker():
+            with self.app.app_context():
+                results.append(translator.translate('privet', 'ru', 'en'))
+                db.session.remove()
+        threads = [threading.Thread(target=worker) for _ in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, ['PRIVET'] * 5)
+        self.assertEqual(len(self.stub.requests), 1)
+
+    def test_batch_of_posts(self):
+        board = db.session.scalar(sa.select(Board).where(Board.name == 'Casual'))
+        u = User(username='john', email='john@example.com')
+        posts = [Post(body='post {}'.format(i), author=u, board=board, language='ru') for i in range(3)]
+        posts.append(Post(body='hola', author=u, board=board, language='es'))
+        db.session.add_all(posts)
+        db.session.commit()
+        translator.translate('post 0', 'ru', 'en')
+        response = self.client.post('/translate', json={'post_ids': [p.id for p in posts], 'dest_language': 'en'})
+        translations = response.get_json()['translations']
+        self.assertEqual(translations, {str(p.id): p.body.upper() for p in posts})
+        # one call for the cached text, then one per source language
+        self.assertEqual(sorted(texts for _, texts in self.stub.requests),
+                         [['hola'], ['post 0'], ['post 1', 'post 2']])
+
+    def test_malformed_requests(self):
+        for data in ({'post_ids': 5, 'dest_language': 'en'}, {'post_ids': ['1'], 'dest_language': 'en'},
+                     {'post_ids': [1]}, {'text': 'privet'}, {'text': None, 'dest_language': 'en'}, [1]):
+            self.assertEqual(self.client.post('/translate', json=data).status_code, 400)
+        self.assertEqual(self.client.post('/translate', data='privet').status_code, 400)
+        self.assertEqual(self.stub.requests, [])
+
+    def test_waiting_for_a_hung_call(self):
+        self.app.config['TRANSLATOR_TIMEOUT'] = (0.1, 0.1)
+        key = (_text_hash('privet'), 'ru', 'en')
+        translator._in_flight[key] = Future() # another request that never finishes
+        try:
+            self.assertIn('failed', self.post_translation('privet'))
+        finally:
+            translator._in_flight.pop(key)
+
+
+class LanguageDetectionCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        create_schema()
+        self.client = self.app.test_client()
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        with self.client.session_transaction() as session:
+            session['_user_id'] = str(u.id)
+
+    def tearDown(self):
+        last_seen.flush()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_detect(self):
+        self.assertEqual(language_detector.detect('The weather is lovely today, let us go for a walk'), 'en')
+        self.assertEqual(language_detector.detect('Сегодня прекрасная погода, пойдём гулять'), 'ru')
+        for body in ('', '   ', '😀🎉👍', 'ok', '12345 !!!', 'https://example.com/some/long/path @susan'):
+            self.assertEqual(language_detector.detect(body), '')
+
+    def test_memoized(self):
+        text = 'Ceci est un message assez long pour reconnaître la langue'
+        with unittest.mock.patch.object(language_detector._factory, 'create',
+                                        wraps=language_detector._factory.create) as create:
+            results = {language_detector.detect(text) for _ in range(5)}
+        self.assertEqual(results, {'fr'})
+        self.assertEqual(create.call_count, 1)
+
+    def test_detected_when_publishing(self):
+        self.client.post('/board/Casual', data={'post': 'The weather is lovely today, let us go for a walk'})
+        self.assertEqual(db.session.scalar(sa.select(Post.language)), 'en')
+
+    def test_detected_in_background(self):
+        self.app.config['LANGUAGE_DETECTION'] = 'background'
+        with unittest.mock.patch('app.main.routes.tasks.enqueue') as enqueue:
+            self.client.post('/board/Casual', data={'post': 'The weather is lovely today, let us go for a walk'})
+        post = db.session.scalar(sa.select(Post))
+        self.assertIsNone(post.language)
+        job, post_id = enqueue.call_args.args
+        tasks.enqueue(job, post_id)
+        db.session.expire_all()
+        self.assertEqual(post.language, 'en')
+
+
+# a local stand-in SMTP server that accepts every message and counts connections
+class StubSMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StubSMTPHandler)
+        self.connections = 0
+        self.messages = []
+        self.failures = 0 # the next messages to refuse with a temporary error
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+class StubSMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        self.server.connections += 1
+        self.reply('220 stub ready')
+        for line in self.rfile:
+            command = line.decode().strip().upper()
+            if command.startswith('DATA'):
+                self.reply('354 go ahead')
+                data = b''.join(iter(self.rfile.readline, b'.\r\n'))
+                if self.server.failures:
+                    self.server.failures -= 1
+                    self.reply('451 try again later')
+                else:
+                    self.server.messages.append(data)
+                    self.reply('250 queued')
+            elif command.startswith('QUIT'):
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('250 ok')
+
+
+class MailDispatcherCase(unittest.TestCase):
+    def setUp(self):
+        self.smtp = StubSMTPServer()
+        config = type('MailTestConfig', (TestConfig,), {
+            'MAIL_SERVER': '127.0.0.1', 'MAIL_PORT': self.smtp.server_address[1], 'MAIL_SUPPRESS_SEND': False,
+            'MAIL_DEBUG': 0, 'MAIL_DEFAULT_SENDER': 'noreply@example.com', 'MAIL_RETRY_BACKOFF': 0})
+        self.app = create_app(config)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+
+    def tearDown(self):
+        mailer.shutdown()
+        self.app_context.pop()
+        self.smtp.stop()
+
+    def send(self, n):
+        return [send_email('hello {}'.format(i), None, ['susan@example.com'], 'text', '<p>html</p>')
+                for i in range(n)]
+
+    def test_burst_reuses_connections(self):
+        self.assertEqual(self.send(20), [True] * 20)
+        mailer.join()
+        self.assertEqual(len(self.smtp.messages), 20)
+        self.assertLessEqual(self.smtp.connections, self.app.config['MAIL_WORKERS'])
+        mail_threads = [t for t in threading.enumerate() if t.name.startswith('mail-')]
+        self.assertEqual(len(mail_threads), self.app.config['MAIL_WORKERS'])
+
+    def test_retries_temporary_failures(self):
+        self.smtp.failures = 2
+        self.send(1)
+        mailer.join()
+        self.assertEqual(len(self.smtp.messages), 1)
+
+    def test_shutdown_drains_queue(self):
+        self.send(5)
+        mailer.shutdown()
+        self.assertEqual(len(self.smtp.messages), 5)
+
+    def test_full_queue_drops_message(self):
+        self.app.config.update(MAIL_QUEUE_TIMEOUT=0)
+        mailer.init_app(self.app)
+        with unittest.mock.patch.object(mailer, '_queue', queue.Queue(maxsize=1)), \
+                unittest.mock.patch.object(mailer, '_ensure_workers'): # nothing takes messages off the queue
+            self.assertEqual(self.send(2), [True, False])
+
+    def test_bad_message_keeps_workers(self):
+        bad = [send_email('no one', None, [], 'text', '<p>html</p>')
+               for _ in range(self.app.config['MAIL_WORKERS'])]
+        self.assertEqual(bad, [True] * self.app.config['MAIL_WORKERS'])
+        self.assertEqual(self.send(1), [True])
+        deadline = time() + 5 # not join(), which would wait forever if no worker was left
+        while not self.smtp.messages and time() < deadline:
+            sleep(0.01)
+        self.assertEqual(len(self.smtp.messages), 1)
+        self.assertTrue(all(worker.is_alive() for worker in mailer._workers))
+
+    def test_sync_dispatch(self):
+        self.app.config['MAIL_DISPATCH'] = 'sync'
+        self.send(2)
+        self.assertEqual(len(self.smtp.messages), 2)
+
+
+class SearchCase(unittest.TestCase):
+    config_class = TestConfig
+
+    def setUp(self):
+        self.app = create_app(self.config_class)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        create_schema()
+        self.client = self.app.test_client()
+        self.casual = db.session.scalar(sa.select(Board).where(Board.name == 'Casual'))
+        self.movies = db.session.scalar(sa.select(Board).where(Board.name == 'Movies'))
+        self.author = User(username='john', email='john@example.com')
+        db.session.add(self.author)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def add_post(self, body, board):
+        post = Post(body=body, author=self.author, board=board)
+        db.session.add(post)
+        db.session.commit()
+        return post
+
+    def test_ranked_and_filtered_by_board(self):
+        p1 = self.add_post('a cat and a dog', self.casual)
+        p2 = self.add_post('cat cat cat', self.casual)
+        p3 = self.add_post('the cat movie', self.movies)
+        self.add_post('only dogs here', self.casual)
+        # more occurrences and shorter posts rank higher
+        self.assertEqual(post_search.query('cat'), ([p2.id, p3.id, p1.id], False))
+        self.assertEqual(post_search.query('CAT', board_id=self.casual.id), ([p2.id, p1.id], False))
+        self.assertEqual(post_search.query('cat dog'), ([p1.id], False))
+        self.assertEqual(post_search.query('cat', per_page=2), ([p2.id, p3.id], True))
+        self.assertEqual(post_search.query('cat', page=2, per_page=2), ([p1.id], False))
+        self.assertEqual(post_search.query('cat* -"'), post_search.query('cat')) # no query syntax, just words
+        self.assertEqual(post_search.query('  '), ([], False))
+
+    def test_deleted_and_rolled_back_posts_are_not_found(self):
+        post = self.add_post('a cat', self.casual)
+        db.session.delete(post)
+        db.session.commit()
+        db.session.add(Post(body='another cat', author=self.author, board=self.casual))
+        db.session.flush()
+        db.session.rollback()
+        self.assertEqual(post_search.query('cat'), ([], False))
+
+    def test_reindex(self):
+        post = self.add_post('a cat', self.casual)
+        self.assertEqual(post_search.reindex(), 1)
+        db.session.commit()
+        self.assertEqual(post_search.query('cat'), ([post.id], False))
+
+    def test_search_page(self):
+        self.add_post('a cat on the casual board', self.casual)
+        self.add_post('a cat on the movies board', self.movies)
+        with QueryCounter() as counter:
+            response = self.client.get('/search?q=cat&board=Movies')
+        html = response.get_data(as_text=True)
+        self.assertIn('a cat on the movies board', html)
+        self.assertNotIn('a cat on the casual board', html)
+        self.assertFalse([s for s in counter.statements if 'LIKE' in s.upper()])
+
+
+class MemorySearchConfig(TestConfig):
+    SEARCH_BACKEND = 'memory'
+
+class MemorySearchCase(SearchCase):
+    config_class = MemorySearchConfig
+
+
+class EngineProfileCase(unittest.TestCase):
+    def test_sqlite_pragmas(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            config = type('FileDatabaseConfig', (TestConfig,), {
+                'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(tmp, 'test.db')})
+            app = create_app(config)
+            with app.app_context():
+                with db.engine.connect() as connection:
+                    pragma = lambda name: connection.exec_driver_sql('PRAGMA ' + name).scalar()
+                    self.assertEqual(pragma('journal_mode'), 'wal')
+                    self.assertEqual(pragma('synchronous'), 1) # NORMAL
+                    self.assertEqual(pragma('busy_timeout'), 5000)
+                    self.assertEqual(pragma('cache_size'), -65536)
+                db.session.remove()
+                db.engine.dispose()
+
+    def test_default_profile(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            config = type('FileDatabaseConfig', (TestConfig,), {
+                'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(tmp, 'test.db'), 'DATABASE_PROFILE': 'default'})
+            app = create_app(config)
+            with app.app_context():
+                with db.engine.connect() as connection:
+                    self.assertEqual(connection.exec_driver_sql('PRAGMA journal_mode').scalar(), 'delete')
+                db.session.remove()
+                db.engine.dispose()
+
+    def test_server_pool_options(self):
+        app = Flask(__name__)
+        app.config.update(SQLALCHEMY_DATABASE_URI='postgresql://localhost/mybubble',
+                          SQLALCHEMY_ENGINE_OPTIONS={'pool_size': 3})
+        EngineProfile(app)
+        self.assertEqual(app.config['SQLALCHEMY_ENGINE_OPTIONS'], {
+            'pool_size': 3, 'max_overflow': 20, 'pool_recycle': 1800, 'pool_pre_ping': True})
+
+
+class DatabaseInitCase(unittest.TestCase):
+    def test_create_app_does_not_touch_database(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'test.db')
+            create_app(type('FileDatabaseConfig', (TestConfig,), {'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + path}))
+            self.assertFalse(os.path.exists(path))
+
+    def test_seed_defaults(self):
+        app = create_app(TestConfig)
+        with app.app_context():
+            db.create_all()
+            self.assertEqual(Board.seed_defaults(), 5)
+            self.assertEqual(Board.seed_defaults(), 0)
+            self.assertEqual(Board.seed_defaults(['Casual', 'Art']), 1)
+            db.session.commit()
+            self.assertEqual(db.session.scalar(sa.select(sa.func.count()).select_from(Board)), 6)
+            db.session.remove()
+            db.drop_all()
+
+    def test_init_db_command(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            app = create_app(type('FileDatabaseConfig', (TestConfig,), {
+                'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(tmp, 'test.db')}))
+            runner = app.test_cli_runner()
+            result = runner.invoke(args=['init-db'])
+            self.assertIn('5 boards added', result.output)
+            self.assertIn('0 boards added', runner.invoke(args=['seed']).output)
+            with app.app_context():
+                self.assertEqual(db.session.scalars(sa.select(Board.name).order_by(Board.id)).all(), DEFAULT_BOARDS)
+                self.assertIsNotNone(db.session.scalar(sa.text('SELECT version_num FROM alembic_version')))
+                db.session.remove()
+                db.engine.dispose()
+
+    def test_auto_init(self):
+        app = create_app(type('AutoInitConfig', (TestConfig,), {'DATABASE_AUTO_INIT': True}))
+        with app.app_context():
+            self.assertEqual(db.session.scalar(sa.select(sa.func.count()).select_from(Board)), 5)
+            db.session.remove()
+            db.drop_all()
+
+
+class MetricsConfig(TestConfig):
+    METRICS = True
+    METRICS_TOKEN = 'scraper'
+    ADMINS = ['admin@example.com']
+
+
+class MetricsCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(MetricsConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        create_schema()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def login(self, email):
+        u = User(username=email.split('@')[0], email=email)
+        db.session.add(u)
+        db.session.commit()
+        with self.client.session_transaction() as session:
+            session['_user_id'] = str(u.id)
+        g.pop('_login_user', None) # the requests share the test's app context
+
+    def scrape(self):
+        response = self.client.get('/metrics', headers={'Authorization': 'Bearer scraper'})
+        self.assertEqual(response.status_code, 200)
+        return response.get_data(as_text=True).splitlines()
+
+    def test_admin_only(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        self.assertEqual(self.client.get('/metrics', headers={'Authorization': 'Bearer wrong'}).status_code, 403)
+        self.login('susan@example.com')
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        self.login('admin@example.com')
+        self.assertEqual(self.client.get('/metrics').status_code, 200)
+
+    def test_fragment_cache_stats_admin_only(self):
+        self.assertEqual(self.client.get('/stats/fragment_cache').status_code, 403)
+        self.login('susan@example.com')
+        self.assertEqual(self.client.get('/stats/fragment_cache').status_code, 403)
+        response = self.client.get('/stats/fragment_cache', headers={'Authorization': 'Bearer scraper'})
+        self.assertEqual(response.get_json()['backend'], 'memory')
+        self.login('admin@example.com')
+        self.assertEqual(self.client.get('/stats/fragment_cache').status_code, 200)
+
+    def test_disabled(self):
+        app = create_app(TestConfig)
+        self.assertEqual(app.test_client().get('/metrics', headers={'Authorization': 'Bearer scraper'}).status_code, 404)
+
+    def test_request_metrics(self):
+        self.client.get('/board/Casual')
+        self.client.get('/board/Casual')
+        self.client.get('/board/Nowhere')
+        lines = self.scrape()
+        self.assertIn('mybubble_requests_total{endpoint="main.board_posts",method="GET",status="200"} 2', lines)
+        self.assertIn('mybubble_requests_total{endpoint="main.board_posts",method="GET",status="404"} 1', lines)
+        self.assertIn('mybubble_request_duration_seconds_count{endpoint="main.board_posts"} 3', lines)
+        self.assertIn('mybubble_request_duration_seconds_bucket{endpoint="main.board_posts",le="+Inf"} 3', lines)
+        statements = [line for line in lines if line.startswith('mybubble_sql_statements_total{endpoint="main.board_posts"}')]
+        self.assertEqual(len(statements), 1)
+        self.assertGreater(int(statements[0].split()[-1]), 0)
+        self.assertIn('mybubble_template_render_seconds_count{template="board_posts.html"} 2', lines)
+
+    def test_operation_timing(self):
+        timed = metrics.timed('test_operation')(lambda: 42)
+        self.assertEqual(timed(), 42)
+        self.assertIn('mybubble_operation_seconds_count{operation="test_operation"} 1', self.scrape())
+
+    def test_slow_requests_are_profiled(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            self.app.config.update(METRICS_SLOW_REQUEST=0, METRICS_PROFILE_DIR=tmp, METRICS_PROFILE_SAMPLE=1)
+            self.client.get('/board/Casual')
+            self.assertEqual(len([name for name in os.listdir(tmp) if name.endswith('-main.board_posts.prof')]), 1)
+
+
+class StartupCase(unittest.TestCase):
+    # modules a worker only needs for some requests, see benchmarks.py import_time
+    LAZY_MODULES = ('langdetect', 'PIL', 'requests', 'jwt')
+
+    def loaded_at_startup(self, **environ):
+        code = ('import sys; from app import create_app; create_app(); '
+                'print(" ".join(name for name in {!r} if name in sys.modules))'.format(self.LAZY_MODULES))
+        root = os.path.dirname(os.path.abspath(__file__))
+        with tempfile.TemporaryDirectory() as tmp: # the working directory, for logs/
+            output = subprocess.run([sys.executable, '-c', code], cwd=tmp, capture_output=True, text=True,
+                                    env=dict(os.environ, PYTHONPATH=root, **environ), check=True).stdout
+        return output.split()
+
+    def test_heavy_modules_are_lazy(self):
+        self.assertEqual(self.loaded_at_startup(), [])
+
+    def test_language_profiles_preload(self):
+        self.assertEqual(self.loaded_at_startup(LANGUAGE_DETECTION_PRELOAD='1'), ['langdetect'])
+
+
+class UploadSniffingCase(unittest.TestCase):
+    def encode(self, image_format, size=(321, 123), **options):
+        data = io.BytesIO()
+        PIL.Image.new('RGB', size, 'orange').save(data, image_format, **options)
+        return data.getvalue()
+
+    def test_formats(self):
+        self.assertEqual(sniff_image(self.encode('PNG')), ('png', 321, 123))
+        self.assertEqual(sniff_image(self.encode('GIF')), ('gif', 321, 123))
+        self.assertEqual(sniff_image(self.encode('JPEG')), ('jpeg', 321, 123))
+        self.assertEqual(sniff_image(self.encode('WEBP')), ('webp', 321, 123))
+        self.assertEqual(sniff_image(self.encode('WEBP', lossless=True)), ('webp', 321, 123))
+        self.assertIsNone(sniff_image(b'GIF8'))
+        self.assertIsNone(sniff_image(b'<html></html>'))
+
+    def test_jpeg_size_beyond_header(self):
+        # a big comment segment pushes the start of frame past the first 512 bytes
+        data = self.encode('JPEG', comment=b'x' * 2000)
+        self.assertEqual(sniff_image(data[:512]), ('jpeg', None, None))
+        self.assertEqual(sniff_image(data), ('jpeg', 321, 123))
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -1,17 +1,75 @@
-import imghdr
+import struct
+
+# the extension each sniffed format is stored with
+FORMAT_EXTENSIONS = {'png': '.png', 'jpeg': '.jpg', 'gif': '.gif', 'webp': '.webp'}
+
+# JPEG start-of-frame markers, the segments that carry the image size
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+class UploadRejected(ValueError):
+    pass
+
+
+# reads the format and size of an image from the start of its file without decoding it.
+# Returns (format, width, height), with width and height None when the header is too short
+# to contain them (a JPEG with large metadata), or None if this is not a supported image.
+# header can be any bytes-like object, including a memory-mapped file
+def sniff_image(header):
+    if header[:8] == b'\x89PNG\r\n\x1a\n':
+        if len(header) >= 24 and header[12:16] == b'IHDR':
+            return ('png',) + struct.unpack('>II', header[16:24])
+        return 'png', None, None
+    if header[:6] in (b'GIF87a', b'GIF89a'):
+        if len(header) >= 10:
+            return ('gif',) + struct.unpack('<HH', header[6:10])
+        return 'gif', None, None
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return ('webp',) + _webp_size(header)
+    if header[:3] == b'\xff\xd8\xff':
+        return ('jpeg',) + _jpeg_size(header)
+    return None
+
+
+def _webp_size(header):
+    chunk = header[12:16]
+    if chunk == b'VP8 ' and len(header) >= 30:
+        width, height = struct.unpack('<HH', header[26:30])
+        return width & 0x3fff, height & 0x3fff
+    if chunk == b'VP8L' and len(header) >= 25:
+        bits = int.from_bytes(header[21:25], 'little')
+        return (bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1
+    if chunk == b'VP8X' and len(header) >= 30:
+        return int.from_bytes(header[24:27], 'little') + 1, int.from_bytes(header[27:30], 'little') + 1
+    return None, None
+
+
+# walks the JPEG segments up to the first start-of-frame
+def _jpeg_size(header):
+    i = 2
+    while i + 4 <= len(header):
+        if header[i] != 0xFF:
+            return None, None
+        marker = header[i + 1]
+        if marker == 0xFF: # padding
+            i += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8: # markers without a length
+            i += 2
+            continue
+        if marker in JPEG_SOF_MARKERS:
+            if i + 9 > len(header):
+                return None, None
+            height, width = struct.unpack('>HH', header[i + 5:i + 9])
+            return width, height
+        i += 2 + struct.unpack('>H', header[i + 2:i + 4])[0]
+    return None, None
 
 
 def validate_image(stream):
     header = stream.read(512)
     stream.seek(0)
-    format = imghdr.what(None, header)
-    if not format:
+    sniffed = sniff_image(header)
+    if not sniffed:
         return None
-    return '.' + (format if format != 'jpeg' else 'jpg')
-
-# defines if files exist
-def file_exist(stream):
-    header = str(stream.read(512))
-    stream.seek(0)
-    if header != "b''":
-        return 'Ok'
\ No newline at end of file
+    return FORMAT_EXTENSIONS[sniffed[0]]